@@ -1,6 +1,6 @@
 # agents/executor_agent.py
 from crewai import Agent, LLM
-from tools.scene_detection import DetectScenesTool, ExtractSceneFramesTool
+from tools.scene_detection import DetectScenesTool, ExtractSceneFramesTool, DetectAndExtractTool
 from tools.frame_analysis import AnalyzeFrameTool, BatchAnalyzeFramesTool
 import os
 import litellm
@@ -13,6 +13,7 @@ class ExecutorAgent:
         # 创建工具实例
         scene_detection_tool = DetectScenesTool()
         extract_frames_tool = ExtractSceneFramesTool()
+        detect_and_extract_tool = DetectAndExtractTool()
         analyze_frame_tool = AnalyzeFrameTool()
         batch_analyze_frames_tool = BatchAnalyzeFramesTool()
         
@@ -25,7 +26,7 @@ class ExecutorAgent:
             to transform their creative vision into concrete video segments and descriptions.""",
             verbose=True,
             allow_delegation=False,
-            tools=[scene_detection_tool, extract_frames_tool, analyze_frame_tool, batch_analyze_frames_tool],
+            tools=[scene_detection_tool, extract_frames_tool, detect_and_extract_tool, analyze_frame_tool, batch_analyze_frames_tool],
             llm=LLM(
                 model="gemini-1.5-flash",
                 api_key=os.environ.get('OPENAI_API_KEY'),
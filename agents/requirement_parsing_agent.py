@@ -6,6 +6,25 @@ import os
 import json
 import datetime
 
+# 需求解析使用的模型和温度
+REQUIREMENT_PARSING_MODEL = "gemini-1.5-pro"
+REQUIREMENT_PARSING_TEMPERATURE = 0.1
+
+# 需求解析专家的背景设定，Agent和直接调用LLM时共用
+REQUIREMENT_PARSING_BACKSTORY = """你是一名资深的视频需求分析专家，擅长将用户的自然语言需求转化为精确的视频制作指令。
+            你熟悉短视频制作的各个方面，包括镜头语言、剪辑风格、音频处理和后期制作。
+            你能够理解用户的意图，即使在需求不完整或模糊的情况下，也能根据上下文和最佳实践补充必要的细节。
+            你的任务是将各种形式的用户需求转化为标准化的中间表示格式，以便后续系统组件能够准确执行。
+            
+            你特别擅长分析以下方面：
+            1. 视频整体结构（开场、主体、结尾等）
+            2. 音频需求（配音、背景音乐、原声、音效等）
+            3. 视觉风格要求（色调、镜头类型、节奏等）
+            4. 场景转换和情感表达
+            5. 品牌和产品特性展示方式
+            
+            对于不明确的要求，你会根据汽车视频制作的最佳实践做出合理推断，确保生成的指令全面且可执行。"""
+
 class RequirementParsingInput(BaseModel):
     """需求解析工具的输入模式"""
     user_requirement: str = Field(..., description="用户输入的自然语言需求描述")
@@ -55,27 +74,15 @@ class RequirementParsingAgent:
         requirement_parsing_agent = Agent(
             role="视频需求分析专家",
             goal="分析用户需求，生成标准化视频制作指令",
-            backstory="""你是一名资深的视频需求分析专家，擅长将用户的自然语言需求转化为精确的视频制作指令。
-            你熟悉短视频制作的各个方面，包括镜头语言、剪辑风格、音频处理和后期制作。
-            你能够理解用户的意图，即使在需求不完整或模糊的情况下，也能根据上下文和最佳实践补充必要的细节。
-            你的任务是将各种形式的用户需求转化为标准化的中间表示格式，以便后续系统组件能够准确执行。
-            
-            你特别擅长分析以下方面：
-            1. 视频整体结构（开场、主体、结尾等）
-            2. 音频需求（配音、背景音乐、原声、音效等）
-            3. 视觉风格要求（色调、镜头类型、节奏等）
-            4. 场景转换和情感表达
-            5. 品牌和产品特性展示方式
-            
-            对于不明确的要求，你会根据汽车视频制作的最佳实践做出合理推断，确保生成的指令全面且可执行。""",
+            backstory=REQUIREMENT_PARSING_BACKSTORY,
             verbose=True,
             allow_delegation=False,
             tools=[requirement_parsing_tool],
             llm=LLM(
-                model="gemini-1.5-pro",
+                model=REQUIREMENT_PARSING_MODEL,
                 api_key=os.environ.get('OPENAI_API_KEY'),
                 base_url=os.environ.get('OPENAI_BASE_URL'),
-                temperature=0.1,
+                temperature=REQUIREMENT_PARSING_TEMPERATURE,
                 custom_llm_provider="openai"
             ),
             response_template="""
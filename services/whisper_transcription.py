@@ -1,16 +1,89 @@
 import os
 import json
+import hashlib
 import tempfile
 import subprocess
-from typing import Dict, Any, Optional
+from pathlib import Path
+from typing import Dict, Any, Optional, Union
+import numpy as np
 import httpx
 from openai import OpenAI
 
+try:
+    # 可选依赖：faster-whisper 基于CTranslate2在本地用int8量化模型转录
+    import ctranslate2
+    from faster_whisper import WhisperModel
+except ImportError:
+    WhisperModel = None
+
+try:
+    # 可选依赖：blake3 用于更快地计算音频内容哈希
+    import blake3
+except ImportError:
+    blake3 = None
+
+# 本地转录使用的模型（如 large-v3），未设置时使用Whisper API
+WHISPER_LOCAL_MODEL = os.environ.get('WHISPER_LOCAL_MODEL')
+
+# 转录提示词
+WHISPER_PROMPT = "请解析以下简体中文内容。"
+
+# 转录结果缓存目录，按音频内容哈希缓存，改名或重复处理的视频不再重新转录
+WHISPER_CACHE_DIR = Path(os.environ.get('WHISPER_CACHE_DIR', '~/.cache/whisper_transcription')).expanduser()
+
+# 计算音频哈希时每次读取的字节数
+WHISPER_HASH_CHUNK_SIZE = 64 * 1024
+
+# Whisper模型输入的采样率
+WHISPER_SAMPLE_RATE = 16000
+
+
+def _audio_cache_key(audio: Union[str, np.ndarray], model_name: str, language: str) -> str:
+    """计算提取出的音频（文件路径或PCM数组）的内容哈希，与模型和语言一起作为转录结果缓存的键（128位）"""
+    hasher = blake3.blake3() if blake3 is not None else hashlib.blake2b(digest_size=16)
+    if isinstance(audio, np.ndarray):
+        hasher.update(memoryview(audio).cast('B'))
+    else:
+        with open(audio, "rb") as audio_file:
+            while True:
+                chunk = audio_file.read(WHISPER_HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+    return f"{hasher.hexdigest()[:32]}_{model_name.replace('/', '_')}_{language}"
+
+
+def _load_cached_transcription(cache_key: str) -> Optional[Dict[str, Any]]:
+    """读取缓存的转录结果，未命中时返回 None"""
+    try:
+        return json.loads((WHISPER_CACHE_DIR / f"{cache_key}.json").read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
+
+
+def _save_cached_transcription(cache_key: str, transcription: Dict[str, Any]) -> None:
+    """原子地写入转录结果缓存"""
+    try:
+        WHISPER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=WHISPER_CACHE_DIR,
+                                         suffix=".tmp", delete=False) as f:
+            json.dump(transcription, f, ensure_ascii=False)
+            tmp_path = f.name
+        os.replace(tmp_path, WHISPER_CACHE_DIR / f"{cache_key}.json")
+    except OSError as e:
+        print(f"写入转录缓存失败: {str(e)}")
+
+
 class WhisperTranscriptionService:
     """使用Whisper API进行视频语音转录的服务"""
     
     def __init__(self):
         """初始化Whisper转录服务"""
+        # 设置了本地模型且安装了faster-whisper时在本地转录
+        self.local_model = None
+        if WHISPER_LOCAL_MODEL and WhisperModel is not None:
+            self.local_model = self._load_local_model(WHISPER_LOCAL_MODEL)
+        
         # 设置 OpenAI API
         self.api_key = os.environ.get('OPENAI_API_KEY')
         if not self.api_key:
@@ -39,6 +112,108 @@ class WhisperTranscriptionService:
         except (subprocess.SubprocessError, FileNotFoundError):
             raise RuntimeError("Error: FFmpeg is not installed or not in PATH. Please install FFmpeg.")
     
+    @staticmethod
+    def _load_local_model(model_name: str):
+        """
+        加载faster-whisper模型：GPU上使用int8_float16，CPU上使用int8
+        
+        参数:
+        model_name: 模型名称或本地模型目录
+        
+        返回:
+        WhisperModel实例
+        """
+        if ctranslate2.get_cuda_device_count() > 0:
+            print(f"使用GPU加载本地转录模型: {model_name}")
+            return WhisperModel(model_name, device="cuda", compute_type="int8_float16")
+        
+        print(f"使用CPU加载本地转录模型: {model_name}")
+        return WhisperModel(model_name, device="cpu", compute_type="int8",
+                            cpu_threads=max(1, (os.cpu_count() or 2) // 2))
+    
+    def _transcribe_local(self, video_path: str, language: str) -> Dict[str, Any]:
+        """
+        使用本地faster-whisper模型转录，结果格式与API转录相同
+        
+        参数:
+        video_path: 视频文件路径
+        language: 视频主要语言
+        
+        返回:
+        转录结果，包含文本和时间戳
+        """
+        # 音频只解码一次，PCM数组直接交给模型，不写临时文件
+        audio = self.extract_audio_array(video_path)
+        if audio is None:
+            print("视频没有音频，返回空转录结果")
+            return {
+                "text": "",
+                "segments": [],
+                "no_audio": True
+            }
+        
+        # 相同音频内容、模型和语言直接返回缓存结果
+        cache_key = _audio_cache_key(audio, WHISPER_LOCAL_MODEL, language)
+        cached = _load_cached_transcription(cache_key)
+        if cached is not None:
+            print(f"命中转录缓存，共 {len(cached['segments'])} 个分段")
+            return cached
+        
+        print("开始本地转录提取的音频...")
+        # vad_filter跳过静音部分，减少解码次数
+        segments, _ = self.local_model.transcribe(
+            audio,
+            language=language,
+            initial_prompt=WHISPER_PROMPT,
+            vad_filter=True,
+            beam_size=5
+        )
+        
+        segment_list = [
+            {
+                "id": segment.id,
+                "start": segment.start,
+                "end": segment.end,
+                "text": segment.text
+            }
+            for segment in segments
+        ]
+        transcription = {
+            "text": "".join(segment["text"] for segment in segment_list),
+            "segments": segment_list
+        }
+        
+        print(f"本地转录完成，共 {len(transcription['segments'])} 个分段")
+        _save_cached_transcription(cache_key, transcription)
+        return transcription
+    
+    def extract_audio_array(self, video_path: str) -> Optional[np.ndarray]:
+        """
+        用一次ffmpeg调用将视频中的音频解码为16kHz单声道float32 PCM
+        
+        参数:
+        video_path: 视频文件路径
+        
+        返回:
+        PCM数组，视频没有音频时返回None
+        """
+        cmd = [
+            'ffmpeg', '-nostdin', '-v', 'error',
+            '-i', video_path,
+            '-vn', '-ac', '1', '-ar', str(WHISPER_SAMPLE_RATE),
+            '-f', 'f32le', '-'
+        ]
+        process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            error_output = process.stderr.decode(errors='replace')
+            # 没有音频流时ffmpeg没有可输出的流
+            if "does not contain any stream" in error_output or "matches no streams" in error_output:
+                return None
+            raise RuntimeError(f"提取音频失败: {error_output}")
+        
+        audio = np.frombuffer(process.stdout, dtype=np.float32)
+        return audio if audio.size else None
+    
     def extract_audio_from_video(self, video_path: str) -> Optional[str]:
         """
         从视频中提取音频
@@ -141,6 +316,9 @@ class WhisperTranscriptionService:
                     
             # except Exception as direct_error:
             #     print(f"直接转录视频失败: {str(direct_error)}，尝试提取音频...")
+            
+            if self.local_model is not None:
+                return self._transcribe_local(video_path, language)
                 
             # 如果直接转录失败，尝试提取音频
             audio_path = self.extract_audio_from_video(video_path)
@@ -154,39 +332,48 @@ class WhisperTranscriptionService:
                     "no_audio": True
                 }
             
-            # 打开音频文件
-            with open(audio_path, "rb") as audio_file:
-                # 转录视频
-                print("开始转录提取的音频...")
-                response = self.client.audio.transcriptions.create(
-                    model="whisper",
-                    prompt="请解析以下简体中文内容。",
-                    file=audio_file,
-                    language=language,
-                    response_format="verbose_json"
-                )
-            
-            # 清理临时音频文件
-            if os.path.exists(audio_path):
-                os.unlink(audio_path)
-            
-            # 提取结果
-            transcription = {
-                "text": response.text,
-                "segments": response.segments
-            }
-            
-            # # 提取分段信息
-            # for segment in response.segments:
-            #     transcription["segments"].append({
-            #         "id": segment.id,
-            #         "start": segment.start,
-            #         "end": segment.end,
-            #         "text": segment.text
-            #     })
-            
-            print(f"音频转录完成，共 {len(transcription['segments'])} 个分段")
-            return transcription
+            try:
+                # 相同音频内容、模型和语言直接返回缓存结果
+                cache_key = _audio_cache_key(audio_path, "whisper", language)
+                cached = _load_cached_transcription(cache_key)
+                if cached is not None:
+                    print(f"命中转录缓存，共 {len(cached['segments'])} 个分段")
+                    return cached
+                
+                # 打开音频文件
+                with open(audio_path, "rb") as audio_file:
+                    # 转录视频
+                    print("开始转录提取的音频...")
+                    response = self.client.audio.transcriptions.create(
+                        model="whisper",
+                        prompt=WHISPER_PROMPT,
+                        file=audio_file,
+                        language=language,
+                        response_format="verbose_json"
+                    )
+                
+                # 提取结果，分段转为字典以便缓存
+                transcription = {
+                    "text": response.text,
+                    "segments": [
+                        {
+                            "id": segment.id,
+                            "start": segment.start,
+                            "end": segment.end,
+                            "text": segment.text
+                        }
+                        for segment in response.segments
+                    ]
+                }
+                
+                print(f"音频转录完成，共 {len(transcription['segments'])} 个分段")
+                
+                _save_cached_transcription(cache_key, transcription)
+                return transcription
+            finally:
+                # 清理临时音频文件
+                if os.path.exists(audio_path):
+                    os.unlink(audio_path)
                 
         except Exception as e:
             raise Exception(f"Error transcribing video: {str(e)}") 
\ No newline at end of file
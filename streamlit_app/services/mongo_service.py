@@ -1,13 +1,15 @@
 import sys
 import os
+import time
 from datetime import datetime
 from typing import Dict, List, Any, Optional, Union
 
 # 添加项目根目录到路径
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
-from pymongo import MongoClient, DESCENDING
+from pymongo import MongoClient, DESCENDING, ASCENDING, ReturnDocument
 from bson import ObjectId
+from pymongo.errors import OperationFailure
 import logging
 
 # 导入现有的MongoDB服务以重用连接
@@ -18,6 +20,20 @@ from streamlit_app.config import MONGODB_URI, MONGODB_DB, TASK_COLLECTION
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 任务优先级对应的排序值，数值越小越先处理
+TASK_PRIORITY_VALUES = {"high": 0, "normal": 1, "low": 2}
+
+# 监听任务变更时单次等待的最长时间（毫秒）
+TASK_WATCH_MAX_AWAIT_MS = 1000
+
+# 新建或重置为待处理的任务
+PENDING_TASK_PIPELINE = [
+    {"$match": {"$or": [
+        {"operationType": "insert", "fullDocument.status": "pending"},
+        {"operationType": "update", "updateDescription.updatedFields.status": "pending"}
+    ]}}
+]
+
 class TaskManagerService:
     """视频分析任务管理服务"""
     
@@ -28,6 +44,8 @@ class TaskManagerService:
             self.mongodb_service = MongoDBService()
             self.db = self.mongodb_service.db
             self.task_collection = self.db[TASK_COLLECTION]
+            # 单机部署的MongoDB不支持change stream，首次失败后改为定时等待
+            self._change_streams_supported = True
             logger.info("任务管理服务初始化成功")
         except Exception as e:
             logger.error(f"初始化任务管理服务时出错: {str(e)}")
@@ -52,6 +70,7 @@ class TaskManagerService:
                 "created_at": datetime.now().isoformat(),
                 "updated_at": datetime.now().isoformat(),
                 "status": "pending",
+                "priority_value": TASK_PRIORITY_VALUES.get(config.get("priority", "normal"), 2),
                 "progress": 0,
                 "total_videos": len(videos),
                 "processed_videos": 0,
@@ -144,6 +163,97 @@ class TaskManagerService:
             logger.error(f"获取任务列表时出错: {str(e)}")
             return []
     
+    def prepare_task_queue(self) -> None:
+        """
+        工作机启动时调用一次：创建领取任务用的索引，并为缺少priority_value的旧任务补齐排序值
+        
+        priority_value按config.priority换算（未设置时视为normal，未知优先级按low处理），
+        缺少该字段的任务按null排序会排在所有优先级之前
+        """
+        # 领取任务时按状态、优先级和创建顺序查找
+        self.task_collection.create_index([("status", ASCENDING), ("priority_value", ASCENDING), ("_id", ASCENDING)])
+        
+        priority = {"$ifNull": ["$config.priority", "normal"]}
+        result = self.task_collection.update_many(
+            {"priority_value": {"$exists": False}},
+            [{"$set": {"priority_value": {"$switch": {
+                "branches": [
+                    {"case": {"$eq": [priority, name]}, "then": value}
+                    for name, value in TASK_PRIORITY_VALUES.items()
+                ],
+                "default": TASK_PRIORITY_VALUES["low"]
+            }}}}]
+        )
+        if result.modified_count:
+            logger.info(f"已为 {result.modified_count} 个任务补齐优先级排序值")
+    
+    def claim_next_task(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        """
+        原子地领取优先级最高、创建最早的待处理任务，并将其标记为处理中
+        
+        参数:
+        worker_id: 领取任务的工作机ID
+        
+        返回:
+        领取到的任务信息，没有待处理任务时返回None；领取出错时抛出异常，
+        以免调用方把出错当作没有任务而立即重试
+        """
+        try:
+            now = datetime.now().isoformat()
+            task = self.task_collection.find_one_and_update(
+                {"status": "pending"},
+                {"$set": {
+                    "status": "processing",
+                    "worker_id": worker_id,
+                    "started_at": now,
+                    "updated_at": now
+                }},
+                sort=[("priority_value", ASCENDING), ("_id", ASCENDING)],
+                return_document=ReturnDocument.AFTER
+            )
+            
+            if task:
+                # 添加ID字段为字符串
+                task["_id"] = str(task["_id"])
+                logger.info(f"工作机 {worker_id} 领取任务: {task['_id']}")
+            return task
+            
+        except Exception as e:
+            logger.error(f"领取任务时出错: {str(e)}")
+            raise
+    
+    def wait_for_pending_task(self, timeout: float) -> bool:
+        """
+        阻塞等待出现待处理任务：通过change stream监听任务集合，不支持时退化为休眠
+        
+        参数:
+        timeout: 最长等待时间（秒）
+        
+        返回:
+        是否可能有待处理任务（返回False表示超时）
+        """
+        if not self._change_streams_supported:
+            time.sleep(timeout)
+            return False
+        
+        deadline = time.monotonic() + timeout
+        try:
+            with self.task_collection.watch(PENDING_TASK_PIPELINE, max_await_time_ms=TASK_WATCH_MAX_AWAIT_MS) as stream:
+                # 打开监听前插入的任务不会出现在stream中，先检查一次
+                if self.task_collection.find_one({"status": "pending"}, {"_id": 1}):
+                    return True
+                
+                while time.monotonic() < deadline:
+                    if stream.try_next() is not None:
+                        return True
+            return False
+            
+        except OperationFailure as e:
+            logger.warning(f"MongoDB不支持change stream，改为定时轮询任务: {str(e)}")
+            self._change_streams_supported = False
+            time.sleep(max(0, deadline - time.monotonic()))
+            return False
+    
     def update_task_status(self, task_id: str, status: str, progress: int = None) -> bool:
         """
         更新任务状态
@@ -169,9 +279,9 @@ class TaskManagerService:
             if progress is not None:
                 update["progress"] = progress
             
-            # 如果状态为completed，检查是否有失败的视频
+            # 如果状态为completed，检查是否有失败的视频（只取failed_videos字段，不读回整个任务文档）
             if status == "completed":
-                task = self.get_task(task_id)
+                task = self.task_collection.find_one({"_id": object_id}, {"failed_videos": 1})
                 if task and task.get("failed_videos", 0) > 0:
                     update["status"] = "completed_with_errors"
             
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from bson import ObjectId
+from streamlit_app.services.mongo_service import TaskManagerService
+
+def test_legacy_task_does_not_preempt_high_priority():
+    """测试没有priority_value的旧任务不会排在高优先级任务之前"""
+    task_manager = TaskManagerService()
+    # 使用临时集合，避免领取或改写真实的任务
+    task_manager.task_collection = task_manager.db["test_task_priority"]
+    task_manager.task_collection.drop()
+    
+    try:
+        # 旧任务：创建较早，没有priority_value字段
+        legacy_id = task_manager.task_collection.insert_one({
+            "_id": ObjectId(),
+            "task_name": "旧任务",
+            "status": "pending",
+            "config": {"priority": "normal"}
+        }).inserted_id
+        # 工作机启动时补齐旧任务的排序值
+        task_manager.prepare_task_queue()
+        high_id = task_manager.create_task("高优先级任务", [], {"priority": "high"})
+        
+        first = task_manager.claim_next_task("test_worker")
+        second = task_manager.claim_next_task("test_worker")
+        
+        print(f"第一个领取: {first['task_name']}，第二个领取: {second['task_name']}")
+        assert first["_id"] == high_id
+        assert second["_id"] == str(legacy_id)
+        assert second["priority_value"] == 1
+    finally:
+        task_manager.task_collection.drop()
+
+if __name__ == "__main__":
+    test_legacy_task_does_not_preempt_high_priority()
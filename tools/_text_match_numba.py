@@ -0,0 +1,80 @@
+"""
+rapidfuzz 不可用时的文本相似度批量计算
+
+相似度与 rapidfuzz.fuzz.ratio 一致：2 * 最长公共子序列长度 / 两段文本总长度。
+文本以UTF-32码点存放在一个连续的int32数组中，通过偏移量区分各段文本，
+由 numba 编译并在多个segment之间并行计算。
+"""
+from typing import List, Tuple
+
+import numpy as np
+
+try:
+    # 可选依赖：numba 用于编译相似度计算
+    import numba
+except ImportError:
+    numba = None
+
+
+def encode_texts(texts: List[str], lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    将文本列表编码为连续的码点数组
+
+    参数:
+    texts: 文本列表
+    lengths: 每段文本的长度（字符数）
+
+    返回:
+    (码点数组, 偏移量数组)，第i段文本为 codes[offsets[i]:offsets[i + 1]]
+    """
+    codes = np.frombuffer("".join(texts).encode("utf-32-le", "surrogatepass"), dtype=np.int32)
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return codes, offsets
+
+
+def encode_text(text: str) -> np.ndarray:
+    """将单段文本编码为码点数组"""
+    return np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.int32)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def batch_ratio(query, codes, offsets, candidates):
+        """
+        计算查询文本与候选segment的相似度
+
+        参数:
+        query: 查询文本码点数组
+        codes: 所有segment文本的码点数组
+        offsets: 每段文本在codes中的偏移量
+        candidates: 需要计算的segment下标
+
+        返回:
+        与candidates一一对应的相似度数组（0-1）
+        """
+        query_len = query.shape[0]
+        scores = np.zeros(candidates.shape[0], dtype=np.float32)
+        for i in numba.prange(candidates.shape[0]):
+            segment_idx = candidates[i]
+            start = offsets[segment_idx]
+            end = offsets[segment_idx + 1]
+            total = query_len + end - start
+            if total == 0:
+                continue
+            # 单行滚动的最长公共子序列DP
+            row = np.zeros(query_len + 1, dtype=np.int32)
+            for j in range(start, end):
+                code = codes[j]
+                diagonal = 0
+                for k in range(query_len):
+                    above = row[k + 1]
+                    if query[k] == code:
+                        row[k + 1] = diagonal + 1
+                    elif row[k] > above:
+                        row[k + 1] = row[k]
+                    diagonal = above
+            scores[i] = 2.0 * row[query_len] / total
+        return scores
+else:
+    batch_ratio = None
@@ -1,20 +1,268 @@
 # tools/scene_detection.py
 import os
 import cv2
+import numpy as np
 from scenedetect import VideoManager, SceneManager
+from scenedetect.scene_detector import SceneDetector
 from scenedetect.detectors import ContentDetector, ThresholdDetector
-from scenedetect.scene_manager import save_images
+from scenedetect.scene_manager import save_images, compute_downscale_factor
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Type, List
 from pydantic import BaseModel, Field
 from crewai.tools import BaseTool, tool
 
+try:
+    # 可选依赖：ffmpegcv 可通过 NVDEC 在GPU上解码
+    import ffmpegcv
+except ImportError:
+    ffmpegcv = None
+
+try:
+    # 可选依赖：numba 用于编译帧差计算
+    import numba
+except ImportError:
+    numba = None
+
+# 关键帧JPEG编码参数
+JPEG_ENCODE_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 85]
+# 后台JPEG编码/写盘线程数
+JPEG_WRITER_WORKERS = 4
+
+def _write_frame_jpeg(frame, paths) -> list:
+    """
+    将一帧编码为JPEG并写入所有目标路径
+    
+    同一帧只编码一次，多个目标路径直接写入已编码的字节
+    
+    返回:
+    写入成功的路径列表
+    """
+    ok, buf = cv2.imencode('.jpg', frame, JPEG_ENCODE_PARAMS)
+    if not ok:
+        return []
+    data = buf.tobytes()
+    for path in paths:
+        with open(path, 'wb') as f:
+            f.write(data)
+    return list(paths)
+
+# 快速内容检测器比较帧差时使用的缩小尺寸 (宽, 高)
+FAST_DETECTOR_FRAME_SIZE = (120, 68)
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _hsv_mean_abs_diff(prev, cur):
+        """两帧HSV图像逐通道平均绝对差"""
+        height, width, channels = prev.shape
+        total = 0.0
+        for y in numba.prange(height):
+            for x in range(width):
+                for c in range(channels):
+                    total += abs(np.float32(prev[y, x, c]) - np.float32(cur[y, x, c]))
+        return total / (height * width * channels)
+else:
+    def _hsv_mean_abs_diff(prev, cur):
+        """两帧HSV图像逐通道平均绝对差"""
+        return float(np.mean(np.abs(prev.astype(np.int16) - cur.astype(np.int16))))
+
+class FastContentDetector(SceneDetector):
+    """
+    基于缩小帧HSV平均差的内容检测器
+    
+    与 ContentDetector 的判定方式相同（HSV三通道平均绝对差超过阈值即为切点），
+    但先将帧缩小到 FAST_DETECTOR_FRAME_SIZE，并在安装了 numba 时使用编译后的内核计算帧差
+    """
+    
+    def __init__(self, threshold: float = 27.0, min_scene_len: int = 15):
+        super().__init__()
+        self.threshold = threshold
+        self.min_scene_len = min_scene_len
+        self._last_hsv = None
+        self._last_cut = None
+    
+    def process_frame(self, frame_num, frame_img):
+        cuts = []
+        if frame_img is None:
+            return cuts
+        
+        small = cv2.resize(frame_img, FAST_DETECTOR_FRAME_SIZE, interpolation=cv2.INTER_AREA)
+        hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+        
+        if self._last_cut is None:
+            self._last_cut = frame_num
+        
+        if self._last_hsv is not None:
+            content_val = _hsv_mean_abs_diff(self._last_hsv, hsv)
+            if content_val >= self.threshold and (frame_num - self._last_cut) >= self.min_scene_len:
+                cuts.append(frame_num)
+                self._last_cut = frame_num
+        
+        self._last_hsv = hsv
+        return cuts
+    
+    def post_process(self, frame_num):
+        return []
+
+def _create_detector(detector_type: str, threshold: float, min_scene_len: int):
+    """根据类型创建场景检测器，类型未知时返回 None"""
+    if detector_type.lower() == 'content':
+        return ContentDetector(threshold=threshold, min_scene_len=min_scene_len)
+    elif detector_type.lower() == 'threshold':
+        return ThresholdDetector(threshold=threshold, min_scene_len=min_scene_len)
+    elif detector_type.lower() == 'fast':
+        return FastContentDetector(threshold=threshold, min_scene_len=min_scene_len)
+    return None
+
+def _scenes_to_dicts(scene_list, fps: float) -> List[dict]:
+    """将 PySceneDetect 的场景列表转换为带时间信息的字典列表（帧号到时间的换算一次性向量化完成）"""
+    start_frames = np.fromiter((scene[0].frame_num for scene in scene_list), dtype=np.int64, count=len(scene_list))
+    end_frames = np.fromiter((scene[1].frame_num for scene in scene_list), dtype=np.int64, count=len(scene_list))
+    start_times = start_frames / fps
+    end_times = end_frames / fps
+    durations = end_times - start_times
+    start_minutes, start_seconds = np.divmod(start_times, 60)
+    end_minutes, end_seconds = np.divmod(end_times, 60)
+    
+    return [
+        {
+            "scene_number": i + 1,
+            "start_frame": start_frame,
+            "end_frame": end_frame,
+            "start_time": f"{int(start_min):02d}:{start_sec:06.3f}",
+            "end_time": f"{int(end_min):02d}:{end_sec:06.3f}",
+            "duration": f"{duration:.3f}",
+        }
+        for i, (start_frame, end_frame, start_min, start_sec, end_min, end_sec, duration) in enumerate(zip(
+            start_frames.tolist(), end_frames.tolist(),
+            start_minutes.tolist(), start_seconds.tolist(),
+            end_minutes.tolist(), end_seconds.tolist(),
+            durations.tolist()
+        ))
+    ]
+
+def _plan_scene_frames(scenes: List[dict], output_dir: str):
+    """
+    规划每个场景需要保存的帧：中间帧作为代表帧，另外保存起始和结束帧
+    
+    返回:
+    (plans, targets)，plans 为每个场景的 (中间帧路径, 起始帧路径, 结束帧路径)，
+    targets 为帧号到输出路径列表的映射
+    """
+    plans = []
+    targets = {}
+    for scene in scenes:
+        scene_num = scene['scene_number']
+        start_frame = scene['start_frame']
+        end_frame = scene['end_frame']
+        
+        # 获取场景中间的帧
+        middle_frame = (start_frame + end_frame) // 2
+        
+        frame_path = os.path.join(output_dir, f"scene_{scene_num:03d}_frame_{middle_frame}.jpg")
+        start_frame_path = os.path.join(output_dir, f"scene_{scene_num:03d}_start.jpg")
+        targets.setdefault(middle_frame, []).append(frame_path)
+        targets.setdefault(start_frame, []).append(start_frame_path)
+        
+        # 确保结束帧不超出视频范围
+        end_frame_path = None
+        if end_frame > 0:
+            end_frame_path = os.path.join(output_dir, f"scene_{scene_num:03d}_end.jpg")
+            targets.setdefault(end_frame - 1, []).append(end_frame_path)
+        
+        plans.append((frame_path, start_frame_path, end_frame_path))
+    return plans, targets
+
+def _collect_frame_paths(plans, written: set) -> List[str]:
+    """按场景顺序汇总已保存的帧路径，中间帧保存失败的场景整体跳过"""
+    frame_paths = []
+    for frame_path, start_frame_path, end_frame_path in plans:
+        if frame_path in written:
+            if start_frame_path in written:
+                frame_paths.append(start_frame_path)
+            if end_frame_path and end_frame_path in written:
+                frame_paths.append(end_frame_path)
+            frame_paths.append(frame_path)
+    return frame_paths
+
+class _BoundaryFrameCaptureDetector(SceneDetector):
+    """
+    包装一个场景检测器，在检测过程中顺便编码场景边界帧
+    
+    检测器在当前帧报告切点时，当前帧即新场景的起始帧，上一帧即前一场景的结束帧，
+    因此边界帧无需在检测完成后再次解码视频获取
+    
+    SceneManager 需要关闭自动缩小以便保存原始分辨率的边界帧，缩小改在这里按相同的系数和插值方式完成，
+    被包装的检测器看到的帧与 DetectScenesTool 中相同
+    """
+    
+    def __init__(self, detector, downscale_factor: int = 1, interpolation: Optional[int] = None):
+        """
+        参数:
+        detector: 被包装的场景检测器
+        downscale_factor: 传给检测器前的缩小系数，1 表示不缩小
+        interpolation: cv2.resize 的插值方式，为 None 时按步长取像素（旧版 PySceneDetect 的缩小方式）
+        """
+        super().__init__()
+        self._detector = detector
+        self._downscale_factor = downscale_factor
+        self._interpolation = interpolation
+        self._prev_frame_num = None
+        self._prev_frame = None
+        # 帧号 -> 已编码的JPEG字节
+        self.frames = {}
+    
+    def _capture(self, frame_num, frame_img):
+        if frame_num not in self.frames:
+            ok, buf = cv2.imencode('.jpg', frame_img, JPEG_ENCODE_PARAMS)
+            if ok:
+                self.frames[frame_num] = buf.tobytes()
+    
+    def get_metrics(self):
+        return self._detector.get_metrics()
+    
+    def is_processing_required(self, frame_num):
+        return True
+    
+    def _downscale(self, frame_img):
+        factor = self._downscale_factor
+        if factor <= 1:
+            return frame_img
+        if self._interpolation is None:
+            return frame_img[::factor, ::factor, :]
+        return cv2.resize(frame_img, (round(frame_img.shape[1] / factor), round(frame_img.shape[0] / factor)),
+                          interpolation=self._interpolation)
+    
+    def process_frame(self, frame_num, frame_img):
+        cuts = self._detector.process_frame(frame_num, self._downscale(frame_img))
+        
+        # 第一帧是第一个场景的起始帧
+        if self._prev_frame_num is None:
+            self._capture(frame_num, frame_img)
+        
+        for cut in cuts or []:
+            if cut == frame_num:
+                self._capture(frame_num, frame_img)
+                if self._prev_frame_num == frame_num - 1:
+                    self._capture(self._prev_frame_num, self._prev_frame)
+        
+        self._prev_frame_num = frame_num
+        self._prev_frame = frame_img
+        return cuts
+    
+    def post_process(self, frame_num):
+        # 最后一帧是最后一个场景的结束帧
+        if self._prev_frame_num is not None:
+            self._capture(self._prev_frame_num, self._prev_frame)
+            self._prev_frame = None
+        return self._detector.post_process(frame_num)
+
 class SceneDetectionInput(BaseModel):
     """场景检测工具的输入模式"""
     video_path: str = Field(..., description="视频文件的路径")
     threshold: float = Field(27.0, description="检测阈值，越小越敏感,阈值范围为5-30")
     min_scene_len: int = Field(15, description="最小场景长度（帧数）")
-    detector_type: str = Field("content", description="检测器类型 - 'content' 或 'threshold'")
+    detector_type: str = Field("content", description="检测器类型 - 'content'、'threshold' 或 'fast'（缩小帧的快速内容检测）")
 
 class ExtractSceneFramesInput(BaseModel):
     """提取场景关键帧工具的输入模式"""
@@ -22,6 +270,14 @@ class ExtractSceneFramesInput(BaseModel):
     scenes_info: dict = Field(..., description="场景信息（来自 detect_scenes 工具）")
     output_dir: Optional[str] = Field(None, description="关键帧输出目录")
 
+class DetectAndExtractInput(BaseModel):
+    """场景检测并提取关键帧工具的输入模式"""
+    video_path: str = Field(..., description="视频文件的路径")
+    threshold: float = Field(27.0, description="检测阈值，越小越敏感,阈值范围为5-30")
+    min_scene_len: int = Field(15, description="最小场景长度（帧数）")
+    detector_type: str = Field("content", description="检测器类型 - 'content'、'threshold' 或 'fast'（缩小帧的快速内容检测）")
+    output_dir: Optional[str] = Field(None, description="关键帧输出目录")
+
 class DetectScenesTool(BaseTool):
     name: str = "DetectScenes"
     description: str = "使用 PySceneDetect 检测视频中的场景，可调整阈值,阈值范围为5-30"
@@ -35,7 +291,7 @@ class DetectScenesTool(BaseTool):
         video_path: 视频文件路径
         threshold: 检测阈值，越小越敏感
         min_scene_len: 最小场景长度（帧数）
-        detector_type: 检测器类型 - 'content' 或 'threshold'
+        detector_type: 检测器类型 - 'content'、'threshold' 或 'fast'
         
         返回:
         场景列表，每个场景包含开始和结束帧号
@@ -49,12 +305,10 @@ class DetectScenesTool(BaseTool):
             scene_manager = SceneManager()
             
             # 添加检测器
-            if detector_type.lower() == 'content':
-                scene_manager.add_detector(ContentDetector(threshold=threshold, min_scene_len=min_scene_len))
-            elif detector_type.lower() == 'threshold':
-                scene_manager.add_detector(ThresholdDetector(threshold=threshold, min_scene_len=min_scene_len))
-            else:
+            detector = _create_detector(detector_type, threshold, min_scene_len)
+            if detector is None:
                 return f"Error: Unknown detector type '{detector_type}'"
+            scene_manager.add_detector(detector)
             
             # 启动视频管理器
             video_manager.start()
@@ -71,22 +325,7 @@ class DetectScenesTool(BaseTool):
             cap.release()
             
             # 转换场景列表为时间格式
-            scenes = []
-            for i, scene in enumerate(scene_list):
-                start_frame = scene[0].frame_num
-                end_frame = scene[1].frame_num
-                start_time = start_frame / fps
-                end_time = end_frame / fps
-                duration = end_time - start_time
-                
-                scenes.append({
-                    "scene_number": i + 1,
-                    "start_frame": start_frame,
-                    "end_frame": end_frame,
-                    "start_time": f"{int(start_time // 60):02d}:{start_time % 60:06.3f}",
-                    "end_time": f"{int(end_time // 60):02d}:{end_time % 60:06.3f}",
-                    "duration": f"{duration:.3f}",
-                })
+            scenes = _scenes_to_dicts(scene_list, fps)
             
             return {"scenes": scenes, "total_scenes": len(scenes)}
             
@@ -123,56 +362,205 @@ class ExtractSceneFramesTool(BaseTool):
             if not scenes:
                 return "Error: No scenes provided in scenes_info"
             
-            cap = cv2.VideoCapture(video_path)
-            if not cap.isOpened():
-                return f"Error: Could not open video: {video_path}"
-            
-            frame_paths = []
-            
-            # 为每个场景提取中间帧作为代表帧
-            for scene in scenes:
-                scene_num = scene['scene_number']
-                start_frame = scene['start_frame']
-                end_frame = scene['end_frame']
-                
-                # 获取场景中间的帧
-                middle_frame = (start_frame + end_frame) // 2
-                
-                # 设置位置并读取帧
-                cap.set(cv2.CAP_PROP_POS_FRAMES, middle_frame)
-                ret, frame = cap.read()
-                
-                if ret:
-                    # 保存帧
-                    frame_path = os.path.join(output_dir, f"scene_{scene_num:03d}_frame_{middle_frame}.jpg")
-                    cv2.imwrite(frame_path, frame)
-                    
-                    # 还可以保存场景的起始和结束帧
-                    cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
-                    ret, start_frame_img = cap.read()
-                    if ret:
-                        start_frame_path = os.path.join(output_dir, f"scene_{scene_num:03d}_start.jpg")
-                        cv2.imwrite(start_frame_path, start_frame_img)
-                        frame_paths.append(start_frame_path)
-                    
-                    # 确保结束帧不超出视频范围
-                    if end_frame > 0:
-                        cap.set(cv2.CAP_PROP_POS_FRAMES, end_frame - 1)
-                        ret, end_frame_img = cap.read()
-                        if ret:
-                            end_frame_path = os.path.join(output_dir, f"scene_{scene_num:03d}_end.jpg")
-                            cv2.imwrite(end_frame_path, end_frame_img)
-                            frame_paths.append(end_frame_path)
-                    
-                    frame_paths.append(frame_path)
+            # 规划每个场景需要保存的帧
+            plans, targets = _plan_scene_frames(scenes, output_dir)
+            
+            written = None
+            if ffmpegcv is not None:
+                written = self._save_frames_nv(video_path, targets)
+            
+            # GPU 解码不可用或中途停止（如编解码器没有 cuvid 解码器）时，未保存的帧用 OpenCV 补齐
+            missing = targets if written is None else {
+                frame_idx: paths for frame_idx, paths in targets.items() if not written.issuperset(paths)
+            }
+            if missing:
+                missing_written = self._save_frames_cv2(video_path, missing)
+                if missing_written is None:
+                    if not written:
+                        return f"Error: Could not open video: {video_path}"
+                else:
+                    written = (written or set()) | missing_written
+            
+            frame_paths = _collect_frame_paths(plans, written)
             
+            return {
+                "frame_paths": frame_paths,
+                "output_directory": output_dir,
+                "total_frames_extracted": len(frame_paths)
+            }
+            
+        except Exception as e:
+            return f"Error extracting scene frames: {str(e)}"
+    
+    @staticmethod
+    def _save_frames_nv(video_path: str, targets: dict) -> Optional[set]:
+        """
+        使用 ffmpegcv 的 NVDEC 解码顺序读取视频并保存目标帧
+        
+        NVDEC 解码顺序读取比逐帧随机定位更快，且 ffmpegcv 直接输出 bgr24，省去 OpenCV 的额外转换
+        
+        返回:
+        已保存的帧路径集合（解码中途失败时只包含已保存的部分），GPU 解码不可用时返回 None
+        """
+        try:
+            cap = ffmpegcv.VideoCaptureNV(video_path, pix_fmt='bgr24')
+        except Exception:
+            return None
+        
+        last_frame = max(targets)
+        futures = []
+        # JPEG编码和写盘交给后台线程（cv2.imencode会释放GIL），解码可以继续读取后续帧
+        with ThreadPoolExecutor(max_workers=JPEG_WRITER_WORKERS) as executor:
+            try:
+                for frame_idx in range(last_frame + 1):
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    paths = targets.get(frame_idx)
+                    if paths:
+                        futures.append(executor.submit(_write_frame_jpeg, frame.copy(), paths))
+            except Exception as e:
+                print(f"NVDEC 解码中断，剩余帧将使用 OpenCV 读取: {str(e)}")
+            finally:
+                cap.release()
+        
+        written = set()
+        for future in futures:
+            written.update(future.result())
+        return written
+    
+    @staticmethod
+    def _save_frames_cv2(video_path: str, targets: dict) -> Optional[set]:
+        """
+        使用 OpenCV 定位并保存目标帧
+        
+        返回:
+        已保存的帧路径集合，无法打开视频时返回 None
+        """
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            return None
+        
+        futures = []
+        # JPEG编码和写盘交给后台线程（cv2.imencode会释放GIL），解码可以继续读取后续帧
+        with ThreadPoolExecutor(max_workers=JPEG_WRITER_WORKERS) as executor:
+            try:
+                for frame_idx in sorted(targets):
+                    # 设置位置并读取帧
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+                    ret, frame = cap.read()
+                    if not ret:
+                        continue
+                    futures.append(executor.submit(_write_frame_jpeg, frame.copy(), targets[frame_idx]))
+            finally:
+                cap.release()
+        
+        written = set()
+        for future in futures:
+            written.update(future.result())
+        return written
+
+class DetectAndExtractTool(BaseTool):
+    name: str = "DetectAndExtractScenes"
+    description: str = "检测视频场景并同时提取每个场景的关键帧（只解码一遍视频），可调整阈值,阈值范围为5-30"
+    args_schema: Type[BaseModel] = DetectAndExtractInput
+    
+    def _run(self, video_path: str, threshold: float = 27.0, min_scene_len: int = 15,
+             detector_type: str = 'content', output_dir: Optional[str] = None) -> dict:
+        """
+        检测视频场景并提取关键帧
+        
+        场景边界帧在检测的同一次解码中保存，只有场景中间帧需要额外定位读取
+        
+        参数:
+        video_path: 视频文件路径
+        threshold: 检测阈值，越小越敏感
+        min_scene_len: 最小场景长度（帧数）
+        detector_type: 检测器类型 - 'content'、'threshold' 或 'fast'
+        output_dir: 关键帧输出目录
+        
+        返回:
+        场景列表及关键帧路径列表
+        """
+        if not os.path.exists(video_path):
+            return f"Error: Video file not found: {video_path}"
+        
+        if output_dir is None:
+            output_dir = tempfile.mkdtemp()
+        elif not os.path.exists(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+        
+        try:
+            # 创建视频管理器
+            video_manager = VideoManager([video_path])
+            scene_manager = SceneManager()
+            
+            # 添加检测器，并包装以在检测时保存边界帧
+            detector = _create_detector(detector_type, threshold, min_scene_len)
+            if detector is None:
+                return f"Error: Unknown detector type '{detector_type}'"
+            
+            # 保存的边界帧需要是原始分辨率：SceneManager 不再缩小帧，
+            # 改由包装检测器按 SceneManager 默认的自动缩小系数缩小后再交给检测器
+            downscale_factor = compute_downscale_factor(video_manager.get_framesize()[0])
+            interpolation = getattr(scene_manager, 'interpolation', None)
+            capture_detector = _BoundaryFrameCaptureDetector(
+                detector, downscale_factor, interpolation.value if interpolation is not None else None)
+            scene_manager.add_detector(capture_detector)
+            if hasattr(scene_manager, 'auto_downscale'):
+                scene_manager.auto_downscale = False
+                scene_manager.downscale = 1
+            
+            # 启动视频管理器
+            video_manager.start()
+            
+            # 检测场景
+            scene_manager.detect_scenes(frame_source=video_manager)
+            
+            # 获取场景列表
+            scene_list = scene_manager.get_scene_list()
+            
+            # 获取视频信息
+            cap = cv2.VideoCapture(video_path)
+            fps = cap.get(cv2.CAP_PROP_FPS)
             cap.release()
             
+            # 转换场景列表为时间格式
+            scenes = _scenes_to_dicts(scene_list, fps)
+            
+            # 规划每个场景需要保存的帧
+            plans, targets = _plan_scene_frames(scenes, output_dir)
+            
+            # 写入检测时已编码的边界帧
+            written = set()
+            remaining = {}
+            for frame_idx, paths in targets.items():
+                data = capture_detector.frames.get(frame_idx)
+                if data is None:
+                    remaining[frame_idx] = paths
+                    continue
+                for path in paths:
+                    with open(path, 'wb') as f:
+                        f.write(data)
+                written.update(paths)
+            capture_detector.frames.clear()
+            
+            # 中间帧（以及未能在检测中获取的帧）定位读取
+            if remaining:
+                remaining_written = ExtractSceneFramesTool._save_frames_cv2(video_path, remaining)
+                if remaining_written is None:
+                    return f"Error: Could not open video: {video_path}"
+                written.update(remaining_written)
+            
+            frame_paths = _collect_frame_paths(plans, written)
+            
             return {
+                "scenes": scenes,
+                "total_scenes": len(scenes),
                 "frame_paths": frame_paths,
                 "output_directory": output_dir,
                 "total_frames_extracted": len(frame_paths)
             }
             
         except Exception as e:
-            return f"Error extracting scene frames: {str(e)}"
\ No newline at end of file
+            return f"Error detecting scenes and extracting frames: {str(e)}"
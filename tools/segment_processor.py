@@ -3,16 +3,70 @@
 
 import os
 import json
+import functools
 import subprocess
+from collections import deque
 from pathlib import Path
 from typing import List, Dict, Any, Optional
 import tempfile
 import logging
 
+try:
+    # 可选依赖：PyAV 可在进程内读取视频容器信息
+    import av
+except ImportError:
+    av = None
+
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=1)
+def _check_ffmpeg() -> bool:
+    """检查ffmpeg是否可用，结果缓存，避免每次创建SegmentProcessor都启动子进程"""
+    try:
+        subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        return True
+    except (subprocess.SubprocessError, FileNotFoundError):
+        return False
+
+@functools.lru_cache(maxsize=1)
+def _detect_nvenc() -> bool:
+    """检查ffmpeg是否支持h264_nvenc编码器"""
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        )
+        return result.returncode == 0 and "h264_nvenc" in result.stdout
+    except (subprocess.SubprocessError, FileNotFoundError):
+        return False
+
+def _has_video_stream(path: str) -> bool:
+    """
+    检查文件是否包含视频流
+    
+    安装了PyAV时直接在进程内读取容器头信息，避免为每个片段启动一次ffprobe子进程
+    """
+    if av is not None:
+        try:
+            with av.open(path) as container:
+                return any(stream.type == 'video' for stream in container.streams)
+        except Exception as e:
+            logger.error(f"PyAV无法打开视频片段 {path}: {str(e)}")
+            return False
+    
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',  # 选择第一个视频流
+        '-show_entries', 'stream=codec_type',
+        '-of', 'default=noprint_wrappers=1:nokey=1',
+        path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    return result.returncode == 0 and 'video' in result.stdout
+
 class SegmentProcessor:
     """视频片段处理工具：提取、合并等操作"""
     
@@ -30,13 +84,85 @@ class SegmentProcessor:
             self.temp_dir = tempfile.TemporaryDirectory()
             self.output_dir = Path(self.temp_dir.name)
         
-        # 检查ffmpeg是否可用
+        # 检查ffmpeg是否可用（结果在进程内缓存）
+        if not _check_ffmpeg():
+            raise RuntimeError("Error: FFmpeg is not installed or not in PATH. Please install FFmpeg.")
+        
+        # 检查是否可以使用NVENC硬件编码（仅在需要重新编码时使用）
+        self.nvenc_available = _detect_nvenc()
+    
+    @staticmethod
+    def _probe_video_codec(input_path: str) -> Optional[str]:
+        """获取输入文件第一个视频流的编码格式"""
+        cmd = [
+            'ffprobe',
+            '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'stream=codec_name',
+            '-of', 'default=noprint_wrappers=1:nokey=1',
+            input_path
+        ]
         try:
-            subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            if result.returncode == 0:
+                return result.stdout.strip() or None
         except (subprocess.SubprocessError, FileNotFoundError):
-            raise RuntimeError("Error: FFmpeg is not installed or not in PATH. Please install FFmpeg.")
+            pass
+        return None
     
-    def extract_segment(self, segment_info: Dict[str, Any], output_path: Optional[str] = None, keep_audio: bool = True) -> str:
+    def _build_cmd(self, input_path: str, output_path: str, start_time: float, duration: float,
+                   keep_audio: bool = True, reencode: bool = False) -> List[str]:
+        """
+        构建片段提取的ffmpeg命令
+        
+        参数:
+        input_path: 输入文件路径
+        output_path: 输出文件路径
+        start_time: 开始时间（秒）
+        duration: 时长（秒）
+        keep_audio: 是否保留原始音频
+        reencode: 是否需要重新编码视频（例如后续添加滤镜时），为False时直接复制流
+        
+        返回:
+        ffmpeg命令参数列表
+        """
+        cmd = ['ffmpeg', '-y']
+        
+        use_nvenc = reencode and self.nvenc_available
+        if use_nvenc:
+            # 使用NVDEC硬件解码；AV1在较旧的GPU上不支持硬件解码，此时仅使用NVENC编码
+            if self._probe_video_codec(input_path) != 'av1':
+                cmd.extend(['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda'])
+        
+        # -ss 放在 -i 之前使用输入端定位，ffmpeg 直接借助容器索引跳到起点之前的关键帧，
+        # 无需从文件开头解码并丢弃帧；配合 -c copy 时切点对齐到关键帧
+        cmd.extend([
+            '-ss', str(start_time),
+            '-i', input_path,
+            '-t', str(duration)
+        ])
+        
+        # 视频编码参数
+        if use_nvenc:
+            cmd.extend(['-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'hq'])
+        elif reencode:
+            cmd.extend(['-c:v', 'libx264'])
+        else:
+            cmd.extend(['-c:v', 'copy'])
+        
+        # 根据keep_audio参数决定是否保留音频
+        if keep_audio:
+            # 保留音频，直接复制流
+            cmd.extend(['-c:a', 'copy'])
+        else:
+            # 不保留音频
+            cmd.append('-an')
+        
+        cmd.append(output_path)
+        return cmd
+    
+    def extract_segment(self, segment_info: Dict[str, Any], output_path: Optional[str] = None, keep_audio: bool = True,
+                        reencode: bool = False) -> str:
         """
         提取视频片段
         
@@ -44,20 +170,19 @@ class SegmentProcessor:
         segment_info: 片段信息，包含segment_path或original_video_path、start_time、end_time等
         output_path: 输出文件路径，如果不指定则自动生成
         keep_audio: 是否保留原始音频
+        reencode: 是否重新编码视频，可用时使用NVDEC/NVENC硬件加速
         
         返回:
         输出文件路径
         """
-        # 确定输入文件路径
-        input_path = segment_info.get("video_path")
-        if not input_path or not os.path.exists(input_path):
-            # 如果video_path不存在，尝试使用segment_path
-            input_path = segment_info.get("segment_path")
-            if not input_path or not os.path.exists(input_path):
-                # 如果segment_path不存在，尝试使用original_video_path
-                input_path = segment_info.get("original_video_path")
-                if not input_path or not os.path.exists(input_path):
-                    raise FileNotFoundError(f"视频文件不存在: {input_path}")
+        # 确定输入文件路径：依次尝试video_path、segment_path、original_video_path，找到存在的文件即停止
+        input_path = None
+        for key in ("video_path", "segment_path", "original_video_path"):
+            input_path = segment_info.get(key)
+            if input_path and os.path.exists(input_path):
+                break
+        else:
+            raise FileNotFoundError(f"视频文件不存在: {input_path}")
         
         # 确定输出文件路径
         if not output_path:
@@ -70,8 +195,8 @@ class SegmentProcessor:
             segment_info["original_path"] = input_path
             segment_info["extracted_path"] = output_path
         
-        # 如果使用segment_path，并且是已经切好的片段，直接复制文件
-        if input_path == segment_info.get("segment_path") and os.path.exists(input_path):
+        # 如果使用segment_path，并且是已经切好的片段，直接复制文件（上面已确认文件存在）
+        if input_path == segment_info.get("segment_path"):
             logger.info(f"直接使用已切片的视频: {input_path}")
             # 复制文件
             with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
@@ -87,31 +212,11 @@ class SegmentProcessor:
             raise ValueError(f"无效的时间范围: {start_time} - {end_time}")
         
         # 构建ffmpeg命令
-        cmd = [
-            'ffmpeg', '-y',
-            '-i', input_path,
-            '-ss', str(start_time),
-            '-t', str(duration)
-        ]
-        
-        # 根据keep_audio参数决定是否保留音频
-        if keep_audio:
-            # 保留音频，直接复制流
-            cmd.extend([
-                '-c:v', 'copy',
-                '-c:a', 'copy'
-            ])
-        else:
-            # 不保留音频，只复制视频流
-            cmd.extend([
-                '-c:v', 'copy',
-                '-an'  # 禁用音频
-            ])
-        
-        cmd.append(output_path)
+        cmd = self._build_cmd(input_path, output_path, start_time, duration,
+                              keep_audio=keep_audio, reencode=reencode)
         
         try:
-            logger.info(f"提取视频片段: {start_time:.2f}s - {end_time:.2f}s -> {output_path} (保留音频: {keep_audio})")
+            logger.info(f"提取视频片段: {start_time:.2f}s - {end_time:.2f}s -> {output_path} (保留音频: {keep_audio}, 重新编码: {reencode})")
             subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             return output_path
         except subprocess.CalledProcessError as e:
@@ -146,16 +251,7 @@ class SegmentProcessor:
                 
             # 验证文件是否包含有效的视频流
             try:
-                cmd = [
-                    'ffprobe',
-                    '-v', 'error',
-                    '-select_streams', 'v:0',  # 选择第一个视频流
-                    '-show_entries', 'stream=codec_type',
-                    '-of', 'default=noprint_wrappers=1:nokey=1',
-                    path
-                ]
-                result = subprocess.run(cmd, capture_output=True, text=True)
-                if result.returncode == 0 and 'video' in result.stdout:
+                if _has_video_stream(path):
                     valid_segment_paths.append(path)
                     logger.info(f"有效的视频片段: {path}")
                 else:
@@ -188,35 +284,41 @@ class SegmentProcessor:
                     logger.error(f"使用ffmpeg复制单个片段时出错: {str(e2)}")
                     raise
         
-        # 创建一个临时文件，包含所有要合并的文件
-        concat_file = self.output_dir / "concat_list.txt"
+        # 使用FFmpeg concat demuxer要求的格式，仅使用简单的file路径格式
+        concat_lines = [f"file '{path}'\n" for path in valid_segment_paths]
         
-        # 使用FFmpeg concat demuxer要求的格式
-        with open(concat_file, 'w', encoding='utf-8') as f:
-            for path in valid_segment_paths:
-                # 仅使用简单的file路径格式
-                f.write(f"file '{path}'\n")
+        # 创建一个临时文件，包含所有要合并的文件（合并结束后删除）
+        with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', suffix='.txt', prefix='concat_list_',
+                                         dir=self.output_dir, delete=False) as f:
+            f.writelines(concat_lines)
+            concat_file = f.name
         
-        # 输出concat_list.txt内容以供调试
-        logger.info(f"concat_list.txt 内容 ({len(valid_segment_paths)} 个有效片段):")
-        with open(concat_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                logger.info(f"  {line.strip()}")
+        # 输出concat列表内容以供调试
+        logger.info(f"concat列表内容 ({len(valid_segment_paths)} 个有效片段):")
+        for line in concat_lines:
+            logger.info(f"  {line.strip()}")
         
         # 使用简单的ffmpeg命令合并视频
         ffmpeg_cmd = [
             'ffmpeg', '-y',
             '-f', 'concat',
             '-safe', '0',
-            '-i', str(concat_file),
+            '-i', concat_file,
             '-c', 'copy',
             output_path
         ]
         
         try:
             logger.info(f"执行合并命令: {' '.join(ffmpeg_cmd)}")
-            # 注意：切换到输出目录工作环境，确保路径能够正确解析
-            process = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, check=True)
+            # 逐行读取stderr，只保留最后的输出用于出错时记录，避免长时间合并时进度输出占用大量内存
+            process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                       text=True, errors='replace')
+            stderr_tail = deque(maxlen=512)
+            for line in process.stderr:
+                stderr_tail.append(line)
+            returncode = process.wait()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, ffmpeg_cmd, stderr=''.join(stderr_tail))
             logger.info("视频合并成功!")
             return output_path
         except subprocess.CalledProcessError as e:
@@ -235,6 +337,11 @@ class SegmentProcessor:
                     return valid_segment_paths[0]  # 直接返回原始路径
             else:
                 raise ValueError("视频合并失败，且没有有效片段")
+        finally:
+            try:
+                os.unlink(concat_file)
+            except OSError:
+                pass
     
     def process_search_results(self, search_results: str, output_path: str, keep_audio: bool = True) -> str:
         """
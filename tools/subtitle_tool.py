@@ -1,11 +1,209 @@
 import os
-import json
+import re
+import asyncio
+import hashlib
+import functools
+import struct
+import tempfile
+import threading
 import subprocess
 import platform
 import traceback
-from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Union
 import httpx
-import ormsgpack
+import numpy as np
+import msgspec
+import orjson
+
+try:
+    # 可选依赖：h2 用于 httpx 的 HTTP/2 支持
+    import h2
+except ImportError:
+    h2 = None
+
+try:
+    # 可选依赖：xxhash 用于更快地计算音频内容哈希
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+class ASRSegment(msgspec.Struct):
+    """Fish Audio ASR 返回的单个分段"""
+    start: float
+    end: float
+    text: str
+
+
+class ASRResponse(msgspec.Struct):
+    """Fish Audio ASR 响应"""
+    segments: List[ASRSegment]
+    duration: float
+
+
+# 用于拆分字幕的中英文标点符号
+PUNCTUATION_MARKS = frozenset(['。', '！', '？', '；', '，', '!', '?', ';', ','])
+PUNCTUATION_PATTERN = re.compile(f"[{re.escape(''.join(sorted(PUNCTUATION_MARKS)))}]")
+
+# 并发转写时的最大连接数
+ASR_MAX_CONNECTIONS = 16
+
+# 上传音频时每次读取的字节数
+AUDIO_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def _stream_msgpack_request(audio_file_path: str, fields: Dict[str, Any]):
+    """
+    以流的方式构造 {"audio": <音频字节>, **fields} 的msgpack请求体
+    
+    msgpack的bin类型只需在数据前写入长度，因此可以先写map头和audio的bin头，
+    再分块读取音频文件，最后写入其余字段，无需把整个音频读入内存
+    
+    返回:
+    (请求体总长度, 请求体字节块异步迭代器)
+    """
+    audio_size = os.path.getsize(audio_file_path)
+    # fixmap头（字段数小于16）+ "audio"键 + bin32头
+    prefix = (
+        bytes([0x80 | (len(fields) + 1)])
+        + msgspec.msgpack.encode("audio")
+        + b"\xc6" + audio_size.to_bytes(4, "big")
+    )
+    suffix = b"".join(
+        msgspec.msgpack.encode(key) + msgspec.msgpack.encode(value)
+        for key, value in fields.items()
+    )
+    
+    async def iter_content():
+        yield prefix
+        with open(audio_file_path, "rb") as audio_file:
+            while True:
+                chunk = audio_file.read(AUDIO_UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        yield suffix
+    
+    return len(prefix) + audio_size + len(suffix), iter_content()
+
+
+# ASR结果缓存目录及大小上限
+ASR_CACHE_DIR = Path(os.environ.get('FISH_ASR_CACHE_DIR', '~/.cache/fish_asr')).expanduser()
+ASR_CACHE_MAX_BYTES = int(os.environ.get('FISH_ASR_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+# 每写入多少条缓存（或累计写入超过上限的十分之一）才扫描一次缓存目录进行淘汰
+ASR_CACHE_PRUNE_INTERVAL = 32
+ASR_CACHE_PRUNE_BYTES = ASR_CACHE_MAX_BYTES // 10
+
+# 距上次淘汰以来的写入计数，初始值使进程内第一次写入时先淘汰一次
+_asr_cache_lock = threading.Lock()
+_asr_cache_writes = ASR_CACHE_PRUNE_INTERVAL
+_asr_cache_written_bytes = 0
+
+
+def _hash_audio_file(audio_file_path: str) -> str:
+    """分块计算音频文件内容的哈希值，作为ASR结果缓存的键"""
+    hasher = xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    with open(audio_file_path, "rb") as audio_file:
+        while True:
+            chunk = audio_file.read(AUDIO_UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _hash_audio_bytes(audio_data: bytes) -> str:
+    """计算内存中音频数据的哈希值，与 _hash_audio_file 对相同内容给出相同结果"""
+    hasher = xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    hasher.update(audio_data)
+    return hasher.hexdigest()
+
+
+def _pcm_to_wav(pcm_data: bytes, sample_rate: int, channels: int, sample_width: int = 2) -> bytes:
+    """为PCM数据加上44字节的WAV文件头"""
+    header = struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + len(pcm_data), b'WAVE',
+        b'fmt ', 16, 1, channels, sample_rate,
+        sample_rate * channels * sample_width, channels * sample_width, sample_width * 8,
+        b'data', len(pcm_data)
+    )
+    return header + pcm_data
+
+
+def _load_cached_asr(cache_key: str):
+    """读取缓存的ASR结果，未命中时返回 None"""
+    cache_path = ASR_CACHE_DIR / f"{cache_key}.mpk"
+    try:
+        result = msgspec.msgpack.decode(cache_path.read_bytes(), type=ASRResponse)
+    except (OSError, msgspec.DecodeError):
+        return None
+    # 更新修改时间，用于LRU淘汰
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return result
+
+
+def _prune_asr_cache() -> None:
+    """缓存目录超过大小上限时淘汰最久未使用的条目"""
+    entries = []
+    total_size = 0
+    for entry in os.scandir(ASR_CACHE_DIR):
+        if entry.name.endswith(".mpk"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+    if total_size > ASR_CACHE_MAX_BYTES:
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            if total_size <= ASR_CACHE_MAX_BYTES:
+                break
+
+
+def _save_cached_asr(cache_key: str, result: ASRResponse) -> None:
+    """原子地写入ASR结果缓存，每隔若干次写入检查一次大小上限"""
+    global _asr_cache_writes, _asr_cache_written_bytes
+    try:
+        ASR_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        data = msgspec.msgpack.encode(result)
+        with tempfile.NamedTemporaryFile(dir=ASR_CACHE_DIR, suffix=".tmp", delete=False) as f:
+            f.write(data)
+            tmp_path = f.name
+        os.replace(tmp_path, ASR_CACHE_DIR / f"{cache_key}.mpk")
+        
+        with _asr_cache_lock:
+            _asr_cache_writes += 1
+            _asr_cache_written_bytes += len(data)
+            if _asr_cache_writes < ASR_CACHE_PRUNE_INTERVAL and _asr_cache_written_bytes < ASR_CACHE_PRUNE_BYTES:
+                return
+            _asr_cache_writes = 0
+            _asr_cache_written_bytes = 0
+        _prune_asr_cache()
+    except OSError as e:
+        print(f"写入ASR缓存失败: {str(e)}")
+
+
+@functools.lru_cache(maxsize=32)
+def _subtitle_force_style(font_name: str, font_size: int, primary_colour: str, outline_colour: str,
+                          margin_v: int, outline: int, spacing: int) -> str:
+    """构建subtitles滤镜的force_style部分，相同样式只构建一次"""
+    # 转换颜色格式
+    primary_colour_ffmpeg = f"&H{primary_colour[1:]}&"
+    outline_colour_ffmpeg = f"&H{outline_colour[1:]}&"
+    
+    return (
+        f"force_style='Fontname={font_name},Fontsize={font_size},"
+        f"PrimaryColour={primary_colour_ffmpeg},OutlineColour={outline_colour_ffmpeg},"
+        f"MarginV={margin_v},Outline={outline},Spacing={spacing}'"
+    )
 
 
 class FishSpeechRecognizer:
@@ -20,72 +218,143 @@ class FishSpeechRecognizer:
         
         self.api_url = "https://api.fish.audio/v1/asr"
     
-    def transcribe_audio(self, audio_file_path: str):
-        """同步调用 Fish Audio ASR API 进行音频转写"""
+    def _create_async_client(self) -> httpx.AsyncClient:
+        """创建异步HTTP客户端，安装了h2时启用HTTP/2多路复用"""
+        return httpx.AsyncClient(
+            http2=h2 is not None,
+            limits=httpx.Limits(max_connections=ASR_MAX_CONNECTIONS),
+            timeout=None  # 对于长音频，可能需要较长时间
+        )
+    
+    async def _transcribe_async(self, client: httpx.AsyncClient, audio: Union[str, bytes]) -> ASRResponse:
+        """
+        异步调用 Fish Audio ASR API 进行音频转写
+        
+        参数:
+        client: 异步HTTP客户端
+        audio: 音频文件路径，或已在内存中的音频数据（WAV）
+        """
         try:
-            # 读取音频文件
-            with open(audio_file_path, "rb") as audio_file:
-                audio_data = audio_file.read()
+            # 相同内容的音频直接使用缓存结果
+            if isinstance(audio, bytes):
+                cache_key = _hash_audio_bytes(audio)
+            else:
+                cache_key = await asyncio.to_thread(_hash_audio_file, audio)
+            cached = await asyncio.to_thread(_load_cached_asr, cache_key)
+            if cached is not None:
+                print(f"使用缓存的 Fish Audio ASR 结果: {audio if isinstance(audio, str) else cache_key}")
+                return cached
             
             # 准备请求数据
-            request_data = {
-                "audio": audio_data,
+            request_fields = {
                 "language": "zh",  # 指定语言为中文
                 "ignore_timestamps": False  # 获取精确时间戳
             }
+            if isinstance(audio, bytes):
+                content = msgspec.msgpack.encode({"audio": audio, **request_fields})
+                content_length = len(content)
+            else:
+                # 音频文件以流的方式发送，不整体读入内存
+                content_length, content = _stream_msgpack_request(audio, request_fields)
             
             # 发送请求
-            with httpx.Client() as client:
-                response = client.post(
-                    self.api_url,
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/msgpack",
-                    },
-                    content=ormsgpack.packb(request_data),
-                    timeout=None  # 对于长音频，可能需要较长时间
-                )
-                
-                # 检查响应状态
-                response.raise_for_status()
-                
-                # 解析响应
-                result = response.json()
-                
-                print("Fish Audio ASR 响应:", result)
-                return result
-                
+            response = await client.post(
+                self.api_url,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/msgpack",
+                    "Accept": "application/msgpack",
+                    "Content-Length": str(content_length),
+                },
+                content=content
+            )
+            
+            # 检查响应状态
+            response.raise_for_status()
+            
+            # 解析响应（服务端可能忽略Accept仍返回JSON）
+            if "msgpack" in response.headers.get("content-type", ""):
+                result = msgspec.msgpack.decode(response.content, type=ASRResponse)
+            else:
+                result = msgspec.json.decode(response.content, type=ASRResponse)
+            
+            print("Fish Audio ASR 响应:", result)
+            await asyncio.to_thread(_save_cached_asr, cache_key, result)
+            return result
+            
         except Exception as e:
             raise RuntimeError(f"Fish Audio ASR API 调用失败: {str(e)}")
     
-    def transcribe_video_audio(self, audio_path: str, output_dir: str):
-        """处理音频文件并保存结果"""
+    async def _transcribe_batch_async(self, audio_file_paths: List[Union[str, bytes]]) -> List[ASRResponse]:
+        """使用同一个异步客户端并发转写多个音频文件"""
+        async with self._create_async_client() as client:
+            return await asyncio.gather(
+                *(self._transcribe_async(client, path) for path in audio_file_paths)
+            )
+    
+    def transcribe_batch(self, audio_file_paths: List[Union[str, bytes]]) -> List[ASRResponse]:
+        """
+        并发转写多个音频文件
+        
+        参数:
+        audio_file_paths: 音频文件路径列表，也可以是内存中的音频数据（WAV）
+        
+        返回:
+        转写结果列表，与输入顺序一致
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._transcribe_batch_async(audio_file_paths))
+        
+        # 在已有事件循环中被调用（如异步工具或异步宿主）时不能再调用asyncio.run，
+        # 改在单独的线程中运行新的事件循环
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self._transcribe_batch_async(audio_file_paths)).result()
+    
+    def transcribe_audio(self, audio_file_path: str) -> ASRResponse:
+        """同步调用 Fish Audio ASR API 进行音频转写"""
+        return self.transcribe_batch([audio_file_path])[0]
+    
+    def transcribe_bytes(self, audio_data: bytes) -> ASRResponse:
+        """同步调用 Fish Audio ASR API 转写内存中的音频数据（WAV）"""
+        return self.transcribe_batch([audio_data])[0]
+    
+    def transcribe_video_audio(self, audio_path: str, output_dir: str, audio_data: Optional[bytes] = None):
+        """
+        处理音频文件并保存结果
+        
+        参数:
+        audio_path: 音频文件路径，同时用于命名结果文件
+        output_dir: 结果输出目录
+        audio_data: 已在内存中的音频数据（WAV），提供时直接转写该数据，不读取audio_path
+        """
         try:
             # 直接转写音频
-            transcription = self.transcribe_audio(audio_path)
+            if audio_data is not None:
+                transcription = self.transcribe_bytes(audio_data)
+            else:
+                transcription = self.transcribe_audio(audio_path)
             print("Transcription type:", type(transcription))  # 添加调试信息
             
             # 初始化结果列表
             simplified_segments = []
             
             # 处理音频开始的静音部分
-            if 'segments' in transcription and len(transcription['segments']) > 0:
-                first_segment = transcription['segments'][0]
-                if first_segment['start'] > 0:
+            if transcription.segments:
+                first_segment = transcription.segments[0]
+                if first_segment.start > 0:
                     simplified_segments.append({
                         "start": 0,
-                        "end": first_segment['start'],
+                        "end": first_segment.start,
                         "text": ""
                     })
             
-            # 定义中文标点符号列表
-            punctuation_marks = ['。', '！', '？', '；', '，',  '!', '?', ';', ',']
-            
             # 处理所有segments和它们之间的间隔
-            for i, segment in enumerate(transcription['segments']):
-                text = segment['text']
-                start_time = segment['start']
-                end_time = segment['end']
+            for i, segment in enumerate(transcription.segments):
+                text = segment.text
+                start_time = segment.start
+                end_time = segment.end
                 duration = end_time - start_time
                 
                 # 如果文本为空，直接添加原始segment
@@ -101,31 +370,28 @@ class FishSpeechRecognizer:
                 chars_count = len(text)
                 time_per_char = duration / chars_count if chars_count > 0 else 0
                 
-                # 根据标点符号拆分文本
-                sub_segments = []
-                last_cut = 0
+                # 查找所有标点符号位置，切分点为标点之后的位置，最后一个字符之后总是切分
+                cut_positions = [match.end() for match in PUNCTUATION_PATTERN.finditer(text)]
+                if not cut_positions or cut_positions[-1] != len(text):
+                    cut_positions.append(len(text))
+                cuts = np.array(cut_positions, dtype=np.int64)
                 
-                # 查找所有标点符号位置
-                for j, char in enumerate(text):
-                    if char in punctuation_marks or j == len(text) - 1:
-                        # 如果是最后一个字符且不是标点，需要包含这个字符
-                        end_idx = j + 1
-                        sub_text = text[last_cut:end_idx]
-                        
-                        # 计算这部分文本的时长和时间戳
-                        sub_duration = len(sub_text) * time_per_char
-                        sub_start = start_time + last_cut * time_per_char
-                        sub_end = sub_start + sub_duration
-                        
-                        # 添加到子segments列表
-                        sub_segments.append({
-                            "start": sub_start,
-                            "end": sub_end,
-                            "text": sub_text
-                        })
-                        
-                        # 更新下一段的起始位置
-                        last_cut = end_idx
+                # 一次性计算所有子段的时间戳
+                cut_starts = np.concatenate(([0], cuts[:-1]))
+                sub_starts = start_time + cut_starts * time_per_char
+                sub_ends = start_time + cuts * time_per_char
+                
+                # 根据标点符号拆分文本
+                sub_segments = [
+                    {
+                        "start": sub_start,
+                        "end": sub_end,
+                        "text": text[cut_start:cut_end]
+                    }
+                    for cut_start, cut_end, sub_start, sub_end in zip(
+                        cut_starts.tolist(), cuts.tolist(), sub_starts.tolist(), sub_ends.tolist()
+                    )
+                ]
                 
                 # 如果没有找到任何标点符号，使用原始segment
                 if not sub_segments:
@@ -176,22 +442,22 @@ class FishSpeechRecognizer:
                     simplified_segments.extend(final_segments)
                 
                 # 检查与下一个segment之间是否有间隔
-                if i < len(transcription['segments']) - 1:
-                    next_segment = transcription['segments'][i + 1]
-                    if next_segment['start'] > segment['end']:
+                if i < len(transcription.segments) - 1:
+                    next_segment = transcription.segments[i + 1]
+                    if next_segment.start > segment.end:
                         simplified_segments.append({
-                            "start": segment['end'],
-                            "end": next_segment['start'],
+                            "start": segment.end,
+                            "end": next_segment.start,
                             "text": ""
                         })
             
             # 处理最后一个segment之后的静音部分
-            if transcription['segments']:
-                last_segment = transcription['segments'][-1]
-                if last_segment['end'] < transcription['duration']:
+            if transcription.segments:
+                last_segment = transcription.segments[-1]
+                if last_segment.end < transcription.duration:
                     simplified_segments.append({
-                        "start": last_segment['end'],
-                        "end": transcription['duration'],
+                        "start": last_segment.end,
+                        "end": transcription.duration,
                         "text": ""
                     })
             
@@ -200,8 +466,8 @@ class FishSpeechRecognizer:
             output_path = os.path.join(output_dir, f"{audio_name}_fish_analysis_results.json")
             
             # 同步写入 JSON 文件
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(simplified_segments, f, ensure_ascii=False, indent=2)
+            with open(output_path, 'wb') as f:
+                f.write(orjson.dumps(simplified_segments, option=orjson.OPT_INDENT_2))
             
             return simplified_segments
         except Exception as e:
@@ -258,6 +524,41 @@ class SubtitleTool:
         except Exception as e:
             raise RuntimeError(f"从视频提取音频失败: {str(e)}")
     
+    def extract_audio_bytes(self, video_path: str, sample_rate: int = 16000) -> bytes:
+        """
+        从视频中提取音频到内存，不写入临时文件
+        
+        参数:
+        video_path: 视频文件路径
+        sample_rate: 采样率
+        
+        返回:
+        单声道16位WAV数据
+        """
+        try:
+            print(f"从视频中提取音频到内存: {video_path}")
+            
+            # 使用ffmpeg将原始PCM输出到管道
+            cmd = [
+                'ffmpeg', '-nostdin', '-loglevel', 'error',
+                '-i', video_path,
+                '-vn',
+                '-acodec', 'pcm_s16le',
+                '-ar', str(sample_rate),
+                '-ac', '1',
+                '-f', 's16le',
+                '-'
+            ]
+            
+            result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.decode(errors='replace').strip())
+            print("音频提取完成")
+            return _pcm_to_wav(result.stdout, sample_rate=sample_rate, channels=1)
+            
+        except Exception as e:
+            raise RuntimeError(f"从视频提取音频失败: {str(e)}")
+    
     def generate_srt_file(self, segments: List[Dict[str, Any]], output_file: str) -> None:
         """
         生成SRT字幕文件
@@ -269,32 +570,24 @@ class SubtitleTool:
         try:
             print(f"生成SRT字幕文件: {output_file}")
             
-            # 将segments转换为字幕格式
-            subtitle_entries = []
-            subtitle_index = 1
+            # 过滤空字幕
+            subtitle_segments = [
+                segment for segment in segments
+                if segment.get('text') and not segment['text'].isspace()
+            ]
             
-            for segment in segments:
-                if not segment.get('text') or segment['text'].isspace():
-                    continue
-                    
-                # 生成字幕条目
-                entry = {
-                    'index': subtitle_index,
-                    'start': self._format_time(float(segment['start'])),
-                    'end': self._format_time(float(segment['end'])),
-                    'text': segment['text']
-                }
-                subtitle_entries.append(entry)
-                subtitle_index += 1
-            
-            # 写入SRT文件
-            with open(output_file, 'w', encoding='utf-8') as f:
-                for entry in subtitle_entries:
-                    f.write(f"{entry['index']}\n")
-                    f.write(f"{entry['start']} --> {entry['end']}\n")
-                    f.write(f"{entry['text']}\n\n")
-                    
-            print(f"SRT文件生成完成，共{len(subtitle_entries)}条字幕")
+            # 一次性计算所有字幕的起止时间
+            start_times = self._format_times(np.array([float(segment['start']) for segment in subtitle_segments]))
+            end_times = self._format_times(np.array([float(segment['end']) for segment in subtitle_segments]))
+            
+            # 将segments转换为字幕格式，整体拼接后一次写入SRT文件
+            srt_content = "".join(
+                f"{index}\n{start} --> {end}\n{segment['text']}\n\n"
+                for index, (segment, start, end) in enumerate(zip(subtitle_segments, start_times, end_times), start=1)
+            )
+            with open(output_file, 'w', encoding='utf-8', buffering=1 << 20) as f:
+                f.write(srt_content)
+            print(f"SRT文件生成完成，共{len(subtitle_segments)}条字幕")
             
         except Exception as e:
             raise RuntimeError(f"生成SRT文件失败: {str(e)}")
@@ -316,6 +609,51 @@ class SubtitleTool:
         
         return f"{hours:02d}:{minutes:02d}:{int(seconds):02d},{milliseconds:03d}"
     
+    def _format_times(self, seconds: np.ndarray) -> List[str]:
+        """
+        批量将秒数格式化为SRT时间格式 (HH:MM:SS,mmm)，与 _format_time 结果一致
+        
+        参数:
+        seconds: 秒数数组
+        
+        返回:
+        格式化的时间字符串列表
+        """
+        hours = (seconds // 3600).astype(np.int64)
+        minutes = ((seconds % 3600) // 60).astype(np.int64)
+        secs = seconds % 60
+        whole_secs = np.trunc(secs)
+        milliseconds = ((secs - whole_secs) * 1000).astype(np.int64)
+        
+        return [
+            f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
+            for h, m, s, ms in zip(hours.tolist(), minutes.tolist(), whole_secs.astype(np.int64).tolist(),
+                                   milliseconds.tolist())
+        ]
+    
+    def _build_subtitle_filter(self, subtitle_file: str, font_name: str, font_size: int,
+                               primary_colour: str, outline_colour: str, margin_v: int,
+                               outline: int, spacing: int) -> str:
+        """
+        构建subtitles滤镜字符串
+        
+        参数:
+        subtitle_file: SRT字幕文件路径
+        其余参数同add_subtitles
+        
+        返回:
+        FFmpeg subtitles滤镜字符串
+        """
+        # 处理Windows路径
+        subtitle_path = subtitle_file
+        if platform.system() == "Windows":
+            subtitle_path = subtitle_path.replace("\\", "\\\\\\\\")
+            subtitle_path = subtitle_path.replace(":", "\\\\:")
+        
+        force_style = _subtitle_force_style(font_name, font_size, primary_colour, outline_colour,
+                                            margin_v, outline, spacing)
+        return f"subtitles={subtitle_path}:fontsdir={self.font_dir}:{force_style}"
+    
     def add_subtitles(self, video_file: str, subtitle_file: str, output_file: str, 
                       font_name: str = '文悦新青年体 (须授权)', 
                       font_size: int = 14,
@@ -345,23 +683,9 @@ class SubtitleTool:
         try:
             print(f"为视频添加字幕: {video_file}")
             
-            # 处理Windows路径
-            subtitle_path = subtitle_file
-            if platform.system() == "Windows":
-                subtitle_path = subtitle_path.replace("\\", "\\\\\\\\")
-                subtitle_path = subtitle_path.replace(":", "\\\\:")
-            
-            # 转换颜色格式
-            primary_colour_ffmpeg = f"&H{primary_colour[1:]}&"
-            outline_colour_ffmpeg = f"&H{outline_colour[1:]}&"
-            
             # 构建字幕滤镜
-            vf_text = (
-                f"subtitles={subtitle_path}:fontsdir={self.font_dir}:"
-                f"force_style='Fontname={font_name},Fontsize={font_size},"
-                f"PrimaryColour={primary_colour_ffmpeg},OutlineColour={outline_colour_ffmpeg},"
-                f"MarginV={margin_v},Outline={outline},Spacing={spacing}'"
-            )
+            vf_text = self._build_subtitle_filter(subtitle_file, font_name, font_size, primary_colour,
+                                                  outline_colour, margin_v, outline, spacing)
             
             # 构建FFmpeg命令
             cmd = [
@@ -384,6 +708,45 @@ class SubtitleTool:
             traceback.print_exc()
             return video_file  # 如果失败，返回原始视频文件路径
     
+    def _prepare_subtitles(self, video_file: str, output_dir: str, output_filename: str = None):
+        """
+        提取音频、转写并生成SRT字幕文件（字幕流程的前三步）
+        
+        参数:
+        video_file: 视频文件路径
+        output_dir: 输出目录
+        output_filename: 输出文件名（不含扩展名），默认使用原文件名加上"_subtitled"
+        
+        返回:
+        (SRT文件路径, 最终视频输出路径)
+        """
+        # 确保输出目录存在
+        os.makedirs(output_dir, exist_ok=True)
+        
+        # 设置输出文件名
+        if output_filename is None:
+            base_name = os.path.splitext(os.path.basename(video_file))[0]
+            output_filename = f"{base_name}_subtitled"
+        
+        # 设置输出文件路径（音频路径只用于命名转写结果，音频本身不落盘）
+        audio_file = os.path.join(output_dir, f"{output_filename}_audio.wav")
+        srt_file = os.path.join(output_dir, f"{output_filename}.srt")
+        final_video = os.path.join(output_dir, f"{output_filename}.mp4")
+        
+        # 1. 从视频中提取音频
+        print("步骤1: 从视频中提取音频...")
+        audio_data = self.extract_audio_bytes(video_file)
+        
+        # 2. 使用Fish Speech Recognizer进行音频转写
+        print("步骤2: 转写音频...")
+        segments = self.recognizer.transcribe_video_audio(audio_file, output_dir, audio_data=audio_data)
+        
+        # 3. 生成SRT文件
+        print("步骤3: 生成SRT字幕文件...")
+        self.generate_srt_file(segments, srt_file)
+        
+        return srt_file, final_video
+    
     def process_video_with_subtitles(self, video_file: str, output_dir: str, output_filename: str = None) -> str:
         """
         处理视频并添加字幕（完整流程）
@@ -397,30 +760,7 @@ class SubtitleTool:
         添加字幕后的视频文件路径
         """
         try:
-            # 确保输出目录存在
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # 设置输出文件名
-            if output_filename is None:
-                base_name = os.path.splitext(os.path.basename(video_file))[0]
-                output_filename = f"{base_name}_subtitled"
-            
-            # 设置临时文件和最终输出文件路径
-            audio_file = os.path.join(output_dir, f"{output_filename}_audio.wav")
-            srt_file = os.path.join(output_dir, f"{output_filename}.srt")
-            final_video = os.path.join(output_dir, f"{output_filename}.mp4")
-            
-            # 1. 从视频中提取音频
-            print("步骤1: 从视频中提取音频...")
-            self.extract_audio_from_video(video_file, audio_file)
-            
-            # 2. 使用Fish Speech Recognizer进行音频转写
-            print("步骤2: 转写音频...")
-            segments = self.recognizer.transcribe_video_audio(audio_file, output_dir)
-            
-            # 3. 生成SRT文件
-            print("步骤3: 生成SRT字幕文件...")
-            self.generate_srt_file(segments, srt_file)
+            srt_file, final_video = self._prepare_subtitles(video_file, output_dir, output_filename)
             
             # 4. 添加字幕到视频
             print("步骤4: 为视频添加字幕...")
@@ -432,4 +772,4 @@ class SubtitleTool:
         except Exception as e:
             print(f"处理视频字幕时出错: {str(e)}")
             traceback.print_exc()
-            return video_file  # 如果失败，返回原始视频文件路径 
\ No newline at end of file
+            return video_file  # 如果失败，返回原始视频文件路径
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 import os
 import sys
-import json
+import orjson
 import time
 import argparse
 from pathlib import Path
@@ -91,8 +91,8 @@ def main():
                     print("未找到匹配片段")
         
         # 保存结果
-        with open(args.output, 'w', encoding='utf-8') as f:
-            json.dump(result, f, ensure_ascii=False, indent=2)
+        with open(args.output, 'wb') as f:
+            f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
         print(f"匹配结果已保存到: {args.output}")
         
         return 0
@@ -1,13 +1,43 @@
 from crewai.tools import BaseTool, tool
-from typing import Type, Dict, Any, List, Optional
+from typing import Type, Dict, Any, List, Optional, ClassVar, Tuple
 from pydantic import BaseModel, Field
 import os
-import json
+import functools
+import orjson
 import re
 from difflib import SequenceMatcher
-import jieba
+try:
+    # jieba_fast 是C实现的jieba，接口一致
+    import jieba_fast as jieba
+except ImportError:
+    import jieba
 import numpy as np
 from collections import defaultdict
+from itertools import islice
+
+try:
+    # 可选依赖：rapidfuzz 提供C++实现的批量相似度计算
+    from rapidfuzz import process, fuzz
+except ImportError:
+    process = None
+    fuzz = None
+
+from tools._text_match_numba import batch_ratio, encode_text, encode_texts
+
+# 句子与片段相似度的最低阈值
+SIMILARITY_THRESHOLD = 0.1
+
+# 按中英文标点和换行切分句子
+_SENTENCE_SPLIT = re.compile(r'[，。！？,.!?;；\n]+')
+
+
+@functools.lru_cache(maxsize=8192)
+def _abs_path(base_dir: str, path: str) -> str:
+    """将相对路径拼接到基础目录下，绝对路径和空路径原样返回"""
+    if not path or os.path.isabs(path):
+        return path
+    return os.path.join(base_dir, path)
+
 
 class TextMatchingInput(BaseModel):
     """文本匹配工具的输入模式"""
@@ -21,62 +51,168 @@ class TextMatchingTool(BaseTool):
     
     # 添加必要的字段
     json_file_path: str = Field(default="", description="segments JSON文件路径")
+    video_base_dir: str = Field(default="", description="视频相对路径的基础目录")
     segments: List[Dict[str, Any]] = Field(default_factory=list, description="加载的segments数据")
+    segment_texts: List[str] = Field(default_factory=list, description="segments文本列表，与segments一一对应")
+    keyword_index: Dict[str, List[int]] = Field(default_factory=dict, description="分词到segment下标的倒排索引")
+    segment_lengths: Any = Field(default=None, description="segments文本长度数组")
+    segment_charsets: List[frozenset] = Field(default_factory=list, description="segments文本字符集合")
+    segment_paths: List[str] = Field(default_factory=list, description="segments切片路径列表，与segments一一对应")
+    segment_video_paths: List[str] = Field(default_factory=list, description="segments原始视频路径列表，与segments一一对应")
+    segment_codes: Any = Field(default=None, description="segments文本的UTF-32码点数组（仅numba相似度计算使用）")
+    segment_offsets: Any = Field(default=None, description="每段文本在segment_codes中的偏移量")
     
     model_config = {"arbitrary_types_allowed": True}  # 允许任意类型
     
+    # 进程内共享的segments缓存：路径 -> ((路径, mtime_ns, 文件大小), 解析后的字段值)
+    _segments_cache: ClassVar[Dict[str, Tuple[tuple, tuple]]] = {}
+    _SEGMENT_FIELDS: ClassVar[Tuple[str, ...]] = (
+        "segments", "segment_texts", "segment_lengths", "segment_charsets",
+        "segment_paths", "segment_video_paths", "segment_codes", "segment_offsets", "keyword_index",
+    )
+    
     def __init__(self):
         super().__init__()
         # 设置JSON文件路径
         self.json_file_path = os.environ.get('SEGMENTS_JSON_PATH', '/home/jinpeng/multi-agent/segments/segments_info.json')
+        # 从环境变量获取基础目录，如果没有设置，使用默认值
+        self.video_base_dir = os.environ.get('VIDEO_BASE_DIR', '/home/jinpeng/multi-agent')
+        # 预先加载jieba词典，避免首次查询时才加载
+        jieba.initialize()
         # 加载segments数据
         self._load_segments()
     
     def _load_segments(self):
-        """加载segments数据"""
+        """加载segments数据，文件未变化时复用其他实例已解析的结果"""
+        try:
+            stat = os.stat(self.json_file_path)
+        except OSError:
+            print(f"警告: segments文件不存在: {self.json_file_path}")
+            self._set_segments([])
+            return
+        
+        cache_key = (self.json_file_path, stat.st_mtime_ns, stat.st_size)
+        cached = type(self)._segments_cache.get(self.json_file_path)
+        if cached is not None and cached[0] == cache_key:
+            for field_name, value in zip(self._SEGMENT_FIELDS, cached[1]):
+                setattr(self, field_name, value)
+            return
+        
         try:
-            if os.path.exists(self.json_file_path):
-                with open(self.json_file_path, 'r', encoding='utf-8') as f:
-                    self.segments = json.load(f)
-                print(f"已加载 {len(self.segments)} 个视频片段")
-            else:
-                print(f"警告: segments文件不存在: {self.json_file_path}")
-                self.segments = []
+            with open(self.json_file_path, 'rb') as f:
+                segments = orjson.loads(f.read())
+            print(f"已加载 {len(segments)} 个视频片段")
         except Exception as e:
             print(f"加载segments文件时出错: {str(e)}")
-            self.segments = []
+            self._set_segments([])
+            return
+        
+        self._set_segments(segments)
+        type(self)._segments_cache[self.json_file_path] = (
+            cache_key,
+            tuple(getattr(self, field_name) for field_name in self._SEGMENT_FIELDS)
+        )
+    
+    def _set_segments(self, segments: List[Dict[str, Any]]):
+        """设置segments数据，并按字段拆分为并行列表（文本、长度、字符集合、路径）及倒排索引"""
+        self.segments = segments
+        self.segment_texts = [segment.get("text") or "" for segment in self.segments]
+        self.segment_paths = [segment.get("segment_path") or "" for segment in self.segments]
+        self.segment_video_paths = [segment.get("video_path") or "" for segment in self.segments]
+        self.segment_lengths = np.fromiter((len(text) for text in self.segment_texts), dtype=np.int64,
+                                           count=len(self.segment_texts))
+        self.segment_charsets = [frozenset(text) for text in self.segment_texts]
+        if process is None and batch_ratio is not None:
+            self.segment_codes, self.segment_offsets = encode_texts(self.segment_texts, self.segment_lengths)
+        self.keyword_index = self._build_keyword_index(self.segment_texts)
+    
+    @staticmethod
+    def _build_keyword_index(segment_texts: List[str]) -> Dict[str, List[int]]:
+        """构建分词到segment下标的倒排索引，只索引多字词（与关键词提取的过滤规则一致）"""
+        index = defaultdict(set)
+        for segment_idx, segment_text in enumerate(segment_texts):
+            if not segment_text:
+                continue
+            for word in jieba.lcut(segment_text):
+                if len(word) > 1:
+                    index[word].add(segment_idx)
+        # 下标排序，保持与原始segments顺序一致
+        return {word: sorted(indices) for word, indices in index.items()}
     
     def _ensure_absolute_path(self, path: str) -> str:
         """确保路径是绝对路径"""
-        if not path:
-            return path
-        if os.path.isabs(path):
-            return path
-        # 从环境变量获取基础目录，如果没有设置，使用默认值
-        base_dir = os.environ.get('VIDEO_BASE_DIR', '/home/jinpeng/multi-agent')
-        return os.path.join(base_dir, path)
+        return _abs_path(self.video_base_dir, path)
     
     def _calculate_similarity(self, text1: str, text2: str) -> float:
         """计算两段文本的相似度"""
+        if fuzz is not None:
+            return fuzz.ratio(text1, text2) / 100.0
         # 使用SequenceMatcher计算相似度
         return SequenceMatcher(None, text1, text2).ratio()
     
+    def _score_sentences(self, sentences: List[str]):
+        """
+        计算每个句子与所有segment的相似度
+        
+        返回:
+        相似度大于阈值的 (句子, segment下标, 相似度) 迭代器，按句子、segment顺序排列
+        """
+        if not sentences or not self.segment_texts:
+            return
+        
+        for sentence in sentences:
+            candidates = self._candidate_segments(sentence)
+            if not candidates:
+                continue
+            
+            if process is not None:
+                # 一次性计算句子与所有候选segment的相似度，低于阈值的得分为0
+                cutoff = SIMILARITY_THRESHOLD * 100
+                scores = process.cdist([sentence], [self.segment_texts[idx] for idx in candidates],
+                                       scorer=fuzz.ratio, score_cutoff=cutoff, workers=-1)[0]
+                for candidate_idx in np.flatnonzero(scores > cutoff):
+                    yield sentence, candidates[candidate_idx], float(scores[candidate_idx]) / 100.0
+                continue
+            
+            if batch_ratio is not None:
+                # 未安装rapidfuzz时，使用numba编译的最长公共子序列计算相似度
+                scores = batch_ratio(encode_text(sentence), self.segment_codes, self.segment_offsets,
+                                     np.asarray(candidates, dtype=np.int64))
+                for candidate_idx in np.flatnonzero(scores > SIMILARITY_THRESHOLD):
+                    yield sentence, candidates[candidate_idx], float(scores[candidate_idx])
+                continue
+            
+            for segment_idx in candidates:
+                similarity_score = self._calculate_similarity(sentence, self.segment_texts[segment_idx])
+                if similarity_score > SIMILARITY_THRESHOLD:
+                    yield sentence, segment_idx, similarity_score
+    
+    def _candidate_segments(self, sentence: str) -> List[int]:
+        """
+        预筛选可能与句子相似度超过阈值的segment下标
+        
+        相似度 = 2 * 公共子序列长度 / 两段文本总长度，不超过 2 * 较短长度 / 总长度，
+        且没有公共字符时为0，据此排除的segment一定不会超过阈值，不影响匹配结果
+        """
+        sentence_len = len(sentence)
+        lengths = self.segment_lengths
+        upper_bounds = 2 * np.minimum(lengths, sentence_len) / np.maximum(lengths + sentence_len, 1)
+        sentence_chars = frozenset(sentence)
+        return [
+            int(segment_idx) for segment_idx in np.flatnonzero(upper_bounds > SIMILARITY_THRESHOLD)
+            if not sentence_chars.isdisjoint(self.segment_charsets[segment_idx])
+        ]
+    
     def _split_text(self, text: str) -> List[str]:
         """将长文本分割成句子"""
-        # 使用标点符号分割文本
-        sentences = re.split(r'[，。！？,.!?;；\n]+', text)
-        # 过滤空句子
-        return [s.strip() for s in sentences if s.strip()]
+        # 使用标点符号分割文本，去除首尾空白的同时过滤空句子
+        return [s for s in (p.strip() for p in _SENTENCE_SPLIT.split(text)) if s]
     
     def _get_keywords(self, text: str, top_n: int = 10) -> List[str]:
         """从文本中提取关键词"""
         try:
-            # 使用jieba分词
-            words = jieba.lcut(text)
-            # 过滤停用词和单字词
-            filtered_words = [w for w in words if len(w) > 1]
-            # 返回前top_n个词
-            return filtered_words[:top_n]
+            # 使用jieba分词，过滤停用词和单字词，取到前top_n个词即停止
+            return list(islice((w for w in jieba.cut(text) if len(w) > 1), top_n))
         except:
             # 如果jieba不可用，简单地按空格分割
             words = text.split()
@@ -107,94 +243,74 @@ class TextMatchingTool(BaseTool):
             if not query_sentences:
                 query_sentences = [query_text]
             
-            # 对每个句子计算与所有segment的相似度
-            all_matches = []
+            # 每个segment只保留相似度最高的匹配，匹配中只记录segment下标，格式化结果时再取原始数据
+            best_by_path: Dict[str, Dict[str, Any]] = {}
+            match_count = 0
             
             # 记录每个视频的最佳匹配分数
             video_scores = defaultdict(float)
             
-            # 对每个查询句子
-            for sentence in query_sentences:
-                if len(sentence) < 3:  # 忽略过短的句子
-                    continue
-                    
-                # 计算与每个segment的相似度
-                for segment in self.segments:
-                    segment_text = segment.get("text", "")
-                    if not segment_text:
-                        continue
-                    
-                    # 计算相似度
-                    similarity_score = self._calculate_similarity(sentence, segment_text)
-                    
-                    # 如果相似度大于阈值，添加到结果中
-                    if similarity_score > 0.1:  # 设置一个较高的阈值，确保匹配质量
-                        match = {
-                            "segment": segment,
+            # 忽略过短的句子
+            valid_sentences = [sentence for sentence in query_sentences if len(sentence) >= 3]
+            
+            # 计算每个句子与每个segment的相似度，只保留大于阈值的匹配
+            segment_paths = self.segment_paths
+            segment_video_paths = self.segment_video_paths
+            for sentence, segment_idx, similarity_score in self._score_sentences(valid_sentences):
+                match_count += 1
+                
+                segment_path = segment_paths[segment_idx]
+                if segment_path:
+                    current = best_by_path.get(segment_path)
+                    if current is None or similarity_score > current["similarity_score"]:
+                        best_by_path[segment_path] = {
+                            "segment_idx": segment_idx,
                             "similarity_score": similarity_score,
                             "matched_sentence": sentence
                         }
-                        all_matches.append(match)
-                        
-                        # 更新视频的最佳匹配分数
-                        video_path = segment.get("video_path", "")
-                        if video_path and similarity_score > video_scores[video_path]:
-                            video_scores[video_path] = similarity_score
+                
+                # 更新视频的最佳匹配分数
+                video_path = segment_video_paths[segment_idx]
+                if video_path and similarity_score > video_scores[video_path]:
+                    video_scores[video_path] = similarity_score
             
             # 如果没有找到足够的匹配，降低阈值再次尝试
-            if len(all_matches) < limit:
+            if match_count < limit:
                 # 提取查询文本的关键词
                 keywords = self._get_keywords(query_text)
                 
                 for keyword in keywords:
                     if len(keyword) < 2:  # 忽略过短的关键词
                         continue
-                        
-                    for segment in self.segments:
-                        segment_text = segment.get("text", "")
-                        if not segment_text:
+                    
+                    # 通过倒排索引找到包含该关键词的segment
+                    for segment_idx in self.keyword_index.get(keyword, ()):
+                        # 检查是否已经添加过这个segment
+                        segment_path = segment_paths[segment_idx]
+                        if not segment_path or segment_path in best_by_path:
                             continue
                         
-                        # 如果关键词在segment文本中
-                        if keyword in segment_text:
-                            # 计算相似度
-                            similarity_score = 0.3  # 设置一个基础分数
-                            
-                            match = {
-                                "segment": segment,
-                                "similarity_score": similarity_score,
-                                "matched_sentence": keyword
-                            }
-                            
-                            # 检查是否已经添加过这个segment
-                            if not any(m["segment"].get("segment_path") == segment.get("segment_path") for m in all_matches):
-                                all_matches.append(match)
-                                
-                                # 更新视频的最佳匹配分数
-                                video_path = segment.get("video_path", "")
-                                if video_path and similarity_score > video_scores[video_path]:
-                                    video_scores[video_path] = similarity_score
-            
-            # 按相似度排序
-            all_matches.sort(key=lambda x: x["similarity_score"], reverse=True)
-            
-            # 去重：确保每个视频只选择最佳匹配的片段
-            unique_matches = []
-            seen_segments = set()
-            
-            for match in all_matches:
-                segment_path = match["segment"].get("segment_path", "")
-                if segment_path and segment_path not in seen_segments:
-                    unique_matches.append(match)
-                    seen_segments.add(segment_path)
+                        # 计算相似度
+                        similarity_score = 0.3  # 设置一个基础分数
+                        
+                        best_by_path[segment_path] = {
+                            "segment_idx": segment_idx,
+                            "similarity_score": similarity_score,
+                            "matched_sentence": keyword
+                        }
+                        
+                        # 更新视频的最佳匹配分数
+                        video_path = segment_video_paths[segment_idx]
+                        if video_path and similarity_score > video_scores[video_path]:
+                            video_scores[video_path] = similarity_score
             
-            # 取前limit个结果
-            top_results = unique_matches[:limit]
+            # 按相似度排序，取前limit个结果
+            top_results = sorted(best_by_path.values(), key=lambda x: x["similarity_score"], reverse=True)[:limit]
             
             # 格式化结果
             formatted_results = []
             for result in top_results:
-                segment = result["segment"]
+                segment = self.segments[result["segment_idx"]]
                 
                 # 获取视频路径并确保是绝对路径
                 video_path = segment.get("video_path", "")
@@ -1,10 +1,318 @@
 import os
-from openai import OpenAI
-from typing import Type
+import json
+import atexit
+import asyncio
+import hashlib
+import functools
+import tempfile
+import threading
+import concurrent.futures
+from pathlib import Path
+from openai import OpenAI, AsyncOpenAI
+from typing import Type, List, Tuple, Union, Dict
 from pydantic import BaseModel, Field
 from crewai.tools import BaseTool, tool
 import httpx
 
+try:
+    # 可选依赖：h2 用于 httpx 的 HTTP/2 支持
+    import h2
+except ImportError:
+    h2 = None
+
+try:
+    # 可选依赖：安装 openai[aiohttp] 后异步请求改用 aiohttp 传输，高并发下延迟更稳定；
+    # openai 的 aiohttp 传输依赖 httpx_aiohttp，仅有 aiohttp 时构造会失败
+    import httpx_aiohttp
+    from openai import DefaultAioHttpClient
+except ImportError:
+    DefaultAioHttpClient = None
+
+try:
+    # 可选依赖：blake3 用于更快地计算媒体文件内容哈希
+    import blake3
+except ImportError:
+    blake3 = None
+
+# 访问转录接口使用的代理
+OPENAI_PROXIES = {
+    "http://": "http://172.22.93.27:1081",
+    "https://": "https://172.22.93.27:1081"
+}
+
+# 连接池大小
+OPENAI_MAX_CONNECTIONS = 100
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 50
+
+# 批量转录时同时进行的最大请求数
+TRANSCRIPTION_MAX_CONCURRENCY = 8
+
+# 等待单个转录结果的最长秒数
+TRANSCRIPTION_TIMEOUT = 600
+
+# 转录使用的模型
+TRANSCRIPTION_MODEL = "whisper"
+
+# 转录结果缓存目录
+TRANSCRIPTION_CACHE_DIR = Path(os.environ.get('TRANSCRIPTION_CACHE_DIR', '~/.cache/transcription')).expanduser()
+
+# 计算文件哈希时每次读取的字节数
+TRANSCRIPTION_HASH_CHUNK_SIZE = 64 * 1024
+
+
+def _get_openai_config() -> Tuple[str, str]:
+    """读取 OpenAI API 配置"""
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY environment variable is not set")
+    
+    base_url = os.environ.get('OPENAI_BASE_URL')
+    if not base_url:
+        raise ValueError("OPENAI_BASE_URL environment variable is not set")
+    
+    return api_key, base_url
+
+
+def _http_limits() -> httpx.Limits:
+    """转录请求使用的连接池限制"""
+    return httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_client(api_key: str, base_url: str) -> OpenAI:
+    """按 (api_key, base_url) 复用同步客户端，连接在多次转录之间保持"""
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=httpx.Client(
+        http2=h2 is not None,
+        limits=_http_limits(),
+        proxies=OPENAI_PROXIES
+    ))
+
+
+def _create_async_http_client() -> httpx.AsyncClient:
+    """创建异步HTTP客户端，优先使用aiohttp传输，否则使用httpx（安装了h2时启用HTTP/2）"""
+    if DefaultAioHttpClient is not None:
+        try:
+            return DefaultAioHttpClient(limits=_http_limits(), proxies=OPENAI_PROXIES)
+        except RuntimeError as e:
+            print(f"无法使用aiohttp传输，改用httpx: {str(e)}")
+    return httpx.AsyncClient(
+        http2=h2 is not None,
+        limits=_http_limits(),
+        proxies=OPENAI_PROXIES
+    )
+
+
+def _create_async_client(api_key: str, base_url: str) -> AsyncOpenAI:
+    """创建异步客户端（异步连接绑定事件循环，只能在创建它的事件循环中使用）"""
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=_create_async_http_client())
+
+
+def _transcription_cache_key(video_path: str, language: str) -> str:
+    """分块计算文件内容哈希，与模型和语言一起作为转录结果缓存的键（128位）"""
+    hasher = blake3.blake3() if blake3 is not None else hashlib.blake2b(digest_size=16)
+    with open(video_path, "rb") as media_file:
+        while True:
+            chunk = media_file.read(TRANSCRIPTION_HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return f"{hasher.hexdigest()[:32]}_{TRANSCRIPTION_MODEL}_{language}"
+
+
+def _load_cached_transcription(cache_key: str):
+    """读取缓存的转录结果，未命中时返回 None"""
+    try:
+        return json.loads((TRANSCRIPTION_CACHE_DIR / f"{cache_key}.json").read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
+
+
+def _save_cached_transcription(cache_key: str, result: dict) -> None:
+    """原子地写入转录结果缓存"""
+    try:
+        TRANSCRIPTION_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=TRANSCRIPTION_CACHE_DIR,
+                                         suffix=".tmp", delete=False) as f:
+            json.dump(result, f, ensure_ascii=False)
+            tmp_path = f.name
+        os.replace(tmp_path, TRANSCRIPTION_CACHE_DIR / f"{cache_key}.json")
+    except OSError as e:
+        print(f"写入转录缓存失败: {str(e)}")
+
+
+def iter_segments(response):
+    """
+    逐个生成转录响应中的分段信息
+    
+    参数:
+    response: 转录接口的 verbose_json 响应
+    
+    返回:
+    分段字典的生成器，下游可以在全部分段生成前开始处理
+    """
+    for segment in response.segments:
+        yield {"id": segment.id, "start": segment.start, "end": segment.end, "text": segment.text}
+
+
+def _format_transcription(response) -> dict:
+    """将转录接口的响应转换为包含文本和时间戳的字典"""
+    return {
+        "text": response.text,
+        "segments": list(iter_segments(response))
+    }
+
+
+async def _transcribe_async(client: AsyncOpenAI, video_path: str, language: str) -> Union[dict, str]:
+    """使用异步客户端转录单个视频，相同内容和语言的文件直接返回缓存结果"""
+    if not os.path.exists(video_path):
+        return f"Error: Video file not found: {video_path}"
+    
+    try:
+        # 在线程池中计算文件哈希，不阻塞事件循环
+        loop = asyncio.get_running_loop()
+        cache_key = await loop.run_in_executor(None, _transcription_cache_key, video_path, language)
+        cached = await loop.run_in_executor(None, _load_cached_transcription, cache_key)
+        if cached is not None:
+            return cached
+        
+        with open(video_path, "rb") as audio_file:
+            response = await client.audio.transcriptions.create(
+                model=TRANSCRIPTION_MODEL,
+                file=audio_file,
+                language=language,
+                response_format="verbose_json"
+            )
+        result = _format_transcription(response)
+        await loop.run_in_executor(None, _save_cached_transcription, cache_key, result)
+        return result
+    except Exception as e:
+        return f"Error transcribing video: {str(e)}"
+
+
+def _transcribe_sync(video_path: str, language: str) -> Union[dict, str]:
+    """使用共享的同步客户端转录单个视频（转录调度器或异步客户端不可用时的备用路径）"""
+    try:
+        cache_key = _transcription_cache_key(video_path, language)
+        cached = _load_cached_transcription(cache_key)
+        if cached is not None:
+            return cached
+        
+        client = _get_client(*_get_openai_config())
+        with open(video_path, "rb") as audio_file:
+            response = client.audio.transcriptions.create(
+                model=TRANSCRIPTION_MODEL,
+                file=audio_file,
+                language=language,
+                response_format="verbose_json"
+            )
+        result = _format_transcription(response)
+        _save_cached_transcription(cache_key, result)
+        return result
+    except Exception as e:
+        return f"Error transcribing video: {str(e)}"
+
+
+async def transcribe_videos_async(video_paths: List[str], language: str = "zh",
+                                  max_concurrency: int = TRANSCRIPTION_MAX_CONCURRENCY) -> List[Union[dict, str]]:
+    """
+    并发转录多个视频，所有请求共用一个连接池
+    
+    参数:
+    video_paths: 视频文件路径列表
+    language: 视频主要语言
+    max_concurrency: 同时进行的最大请求数
+    
+    返回:
+    转录结果列表，与输入顺序一致；失败的视频返回错误信息
+    """
+    try:
+        api_key, base_url = _get_openai_config()
+    except ValueError as e:
+        return [f"Error transcribing video: {str(e)}"] * len(video_paths)
+    
+    semaphore = asyncio.Semaphore(max_concurrency)
+    
+    async with _create_async_client(api_key, base_url) as client:
+        async def transcribe_one(video_path: str):
+            async with semaphore:
+                return await _transcribe_async(client, video_path, language)
+        
+        return await asyncio.gather(*(transcribe_one(path) for path in video_paths))
+
+
+class TranscriptionDispatcher:
+    """
+    转录请求调度器
+    
+    在后台线程的常驻事件循环中发出转录请求，所有请求共用同一个异步客户端和连接池，
+    并通过信号量限制同时进行的请求数。进程内只有一个实例，通过 instance() 获取。
+    """
+    
+    _instance = None
+    _instance_lock = threading.Lock()
+    
+    def __init__(self, max_concurrency: int = TRANSCRIPTION_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        # 异步客户端绑定事件循环，后台循环常驻，因此可以按配置长期复用
+        self._clients: Dict[Tuple[str, str], AsyncOpenAI] = {}
+        
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="transcription-dispatcher", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        atexit.register(self._shutdown)
+    
+    @classmethod
+    def instance(cls) -> "TranscriptionDispatcher":
+        """获取进程内共享的调度器"""
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+    
+    async def _start(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+    
+    def submit(self, video_path: str, language: str = "zh") -> concurrent.futures.Future:
+        """
+        提交转录请求（可在任意线程调用）
+        
+        参数:
+        video_path: 视频文件路径
+        language: 视频主要语言
+        
+        返回:
+        转录结果的Future，结果与 TranscribeVideoTool._run 的返回值相同；
+        异步客户端无法创建时Future带有该异常，由调用方改用同步客户端
+        """
+        return asyncio.run_coroutine_threadsafe(self._dispatch(video_path, language), self._loop)
+    
+    async def _dispatch(self, video_path: str, language: str) -> Union[dict, str]:
+        async with self._semaphore:
+            client = self._get_client(*_get_openai_config())
+            try:
+                return await _transcribe_async(client, video_path, language)
+            except Exception as e:
+                return f"Error transcribing video: {str(e)}"
+    
+    def is_running(self) -> bool:
+        """后台事件循环是否仍在运行"""
+        return self._thread.is_alive() and self._loop.is_running()
+    
+    def _shutdown(self):
+        """进程退出时停止后台事件循环"""
+        if self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=1)
+    
+    def _get_client(self, api_key: str, base_url: str) -> AsyncOpenAI:
+        key = (api_key, base_url)
+        if key not in self._clients:
+            self._clients[key] = _create_async_client(api_key, base_url)
+        return self._clients[key]
+
+
 class TranscriptionInput(BaseModel):
     """语音转录工具的输入模式"""
     video_path: str = Field(..., description="视频文件的路径")
@@ -30,48 +338,44 @@ class TranscribeVideoTool(BaseTool):
             return f"Error: Video file not found: {video_path}"
         
         try:
-            # 设置 OpenAI API
-            api_key = os.environ.get('OPENAI_API_KEY')
-            if not api_key:
-                raise ValueError("OPENAI_API_KEY environment variable is not set")
-            
-            base_url = os.environ.get('OPENAI_BASE_URL')
-            if not base_url:
-                raise ValueError("OPENAI_BASE_URL environment variable is not set")
-            
-            client = OpenAI(api_key=api_key, base_url=base_url,http_client=httpx.Client(
-                proxies={
-                    "http://": "http://172.22.93.27:1081",
-                    "https://": "https://172.22.93.27:1081"
-                })
-            )
-            
-            # 打开音频文件
-            with open(video_path, "rb") as audio_file:
-                # 转录视频
-                response = client.audio.transcriptions.create(
-                    model="whisper",
-                    file=audio_file,
-                    language=language,
-                    response_format="verbose_json"
-                )
-            
-            # 提取结果
-            transcription = {
-                "text": response.text,
-                "segments": []
-            }
-            
-            # 提取分段信息
-            for segment in response.segments:
-                transcription["segments"].append({
-                    "id": segment.id,
-                    "start": segment.start,
-                    "end": segment.end,
-                    "text": segment.text
-                })
-            
-            return transcription
-            
+            # 交给转录调度器，与其他转录请求共用异步客户端和连接池
+            future = self._submit(video_path, language)
+        except Exception as e:
+            print(f"转录调度器不可用，改用同步客户端: {str(e)}")
+            return _transcribe_sync(video_path, language)
+        
+        try:
+            return future.result(timeout=TRANSCRIPTION_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            return f"Error transcribing video: timed out after {TRANSCRIPTION_TIMEOUT} seconds"
         except Exception as e:
-            return f"Error transcribing video: {str(e)}" 
\ No newline at end of file
+            print(f"异步转录失败，改用同步客户端: {str(e)}")
+            return _transcribe_sync(video_path, language)
+    
+    async def _arun(self, video_path: str, language: str = "zh") -> dict:
+        """异步版本的语音转录，参数与返回值同 _run"""
+        if not os.path.exists(video_path):
+            return f"Error: Video file not found: {video_path}"
+        
+        try:
+            future = self._submit(video_path, language)
+        except Exception as e:
+            print(f"转录调度器不可用，改用同步客户端: {str(e)}")
+            return await asyncio.to_thread(_transcribe_sync, video_path, language)
+        
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), TRANSCRIPTION_TIMEOUT)
+        except asyncio.TimeoutError:
+            return f"Error transcribing video: timed out after {TRANSCRIPTION_TIMEOUT} seconds"
+        except Exception as e:
+            print(f"异步转录失败，改用同步客户端: {str(e)}")
+            return await asyncio.to_thread(_transcribe_sync, video_path, language)
+    
+    @staticmethod
+    def _submit(video_path: str, language: str) -> concurrent.futures.Future:
+        """提交到转录调度器，调度器的事件循环已停止时抛出 RuntimeError"""
+        dispatcher = TranscriptionDispatcher.instance()
+        if not dispatcher.is_running():
+            raise RuntimeError("transcription dispatcher event loop is not running")
+        return dispatcher.submit(video_path, language)
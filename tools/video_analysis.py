@@ -1,16 +1,196 @@
 # tools/video_analysis.py
 import os
+import re
+import asyncio
 import cv2
-import tempfile
 import base64
+import shutil
+import hashlib
+import functools
+import tempfile
+import subprocess
 import openai
+import httpx
 from PIL import Image
 import io
 import numpy as np
-from typing import Optional, Type
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Type
 from pydantic import BaseModel, Field
 from crewai.tools import BaseTool, tool
 
+try:
+    # 可选依赖：h2 用于 httpx 的 HTTP/2 支持
+    import h2
+except ImportError:
+    h2 = None
+
+try:
+    # 可选依赖：安装 openai[aiohttp] 后异步请求改用 aiohttp 传输
+    # （openai 的 aiohttp 传输依赖 httpx_aiohttp，仅有 aiohttp 时构造会失败）
+    import httpx_aiohttp
+    from openai import DefaultAioHttpClient
+except ImportError:
+    DefaultAioHttpClient = None
+
+try:
+    # 可选依赖：PyAV 可在进程内解码视频帧
+    import av
+except ImportError:
+    av = None
+
+try:
+    # 可选依赖：blake3 用于更快地计算帧内容哈希
+    import blake3
+except ImportError:
+    blake3 = None
+
+# 保持的空闲连接数
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 20
+
+# 并行编码帧图像的线程数
+FRAME_ENCODE_WORKERS = 8
+
+# 在视频的不同位置取帧（占总帧数的比例）
+SAMPLE_FRAME_POSITIONS = np.array([0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5, 0.6, 0.65, 0.7, 0.8, 0.9],
+                                  dtype=np.float64)
+
+# 相邻样本帧相隔超过这么多秒的帧时直接定位，否则顺序grab()
+SAMPLE_SEEK_GAP_SECONDS = 2.0
+
+# 样本帧JPEG编码参数
+FRAME_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 85]
+
+# FFmpeg可执行文件路径，未安装时为None
+_FFMPEG = shutil.which("ffmpeg")
+
+# JPEG起始标记（SOI + 下一个标记的0xFF），用于切分image2pipe输出的连续JPEG
+_JPEG_SOI = re.compile(b'\xff\xd8\xff')
+
+# 帧分析使用的模型（需支持视觉）
+FRAME_ANALYSIS_MODEL = "gemini-1.5-flash"
+
+# 帧分析结果缓存目录
+FRAME_ANALYSIS_CACHE_DIR = Path(os.environ.get('FRAME_ANALYSIS_CACHE_DIR', '~/.cache/frame_analysis')).expanduser()
+
+# 帧分析的提示词
+FRAME_ANALYSIS_PROMPT = """
+            Please analyze these frames from a video and provide the following information:
+            1. Video type (e.g., vlog, tutorial, documentary, review, etc.)
+            2. Video quality (e.g., high-definition, low quality, professional, amateur)
+            3. Content description (what's shown in the frames)
+            4. Visual aesthetics (composition, lighting, colors)
+            5. Overall quality score (1-10) with justification
+            
+            Format the response as structured information that can be easily parsed.
+            """
+
+def _frame_analysis_cache_key(base64_images: List[str]) -> str:
+    """根据模型、提示词和帧内容计算帧分析结果缓存的键（128位）"""
+    hasher = blake3.blake3() if blake3 is not None else hashlib.blake2b(digest_size=16)
+    hasher.update(FRAME_ANALYSIS_MODEL.encode('utf-8'))
+    hasher.update(FRAME_ANALYSIS_PROMPT.encode('utf-8'))
+    for base64_image in base64_images:
+        hasher.update(base64_image.encode('ascii'))
+    return hasher.hexdigest()[:32]
+
+
+def _load_cached_analysis(cache_key: str) -> Optional[str]:
+    """读取缓存的帧分析结果，未命中时返回 None"""
+    try:
+        return (FRAME_ANALYSIS_CACHE_DIR / f"{cache_key}.txt").read_text(encoding='utf-8')
+    except OSError:
+        return None
+
+
+def _save_cached_analysis(cache_key: str, content: str) -> None:
+    """原子地写入帧分析结果缓存"""
+    try:
+        FRAME_ANALYSIS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=FRAME_ANALYSIS_CACHE_DIR,
+                                         suffix=".tmp", delete=False) as f:
+            f.write(content)
+            tmp_path = f.name
+        os.replace(tmp_path, FRAME_ANALYSIS_CACHE_DIR / f"{cache_key}.txt")
+    except OSError as e:
+        print(f"写入帧分析缓存失败: {str(e)}")
+
+
+def _sample_jpegs_ffmpeg(video_path: str, target_frames: List[int]) -> List[bytes]:
+    """
+    用一次FFmpeg顺序解码，按帧序号取出样本帧并直接输出JPEG数据
+    
+    参数:
+    video_path: 视频文件路径
+    target_frames: 需要的帧序号列表
+    
+    返回:
+    与target_frames对应的JPEG数据列表（超出实际帧数的序号被跳过），FFmpeg失败时返回空列表
+    """
+    unique_frames = sorted(set(target_frames))
+    select_expr = "+".join(f"eq(n,{frame_idx})" for frame_idx in unique_frames)
+    cmd = [
+        _FFMPEG, '-v', 'error',
+        '-i', video_path,
+        '-vf', f"select='{select_expr}'",
+        '-vsync', '0',
+        '-frames:v', str(len(unique_frames)),  # 取到最后一个样本帧即停止解码
+        '-f', 'image2pipe',
+        '-c:v', 'mjpeg',
+        '-q:v', '3',
+        'pipe:1'
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode != 0 or not result.stdout:
+        return []
+    
+    data = result.stdout
+    starts = [match.start() for match in _JPEG_SOI.finditer(data)]
+    jpegs = [data[start:end] for start, end in zip(starts, starts[1:] + [len(data)])]
+    
+    jpeg_by_frame = dict(zip(unique_frames, jpegs))
+    return [jpeg_by_frame[frame_idx] for frame_idx in target_frames if frame_idx in jpeg_by_frame]
+
+def _sample_frames_av(video_path: str, target_frames: List[int]) -> List[np.ndarray]:
+    """
+    用PyAV在进程内取出样本帧：每个样本帧先定位到之前最近的关键帧，再向后解码到该帧
+    
+    每个样本最多解码一个GOP，不必从头解码到最后一个样本帧；只有命中的帧才转换为BGR数组。
+    
+    参数:
+    video_path: 视频文件路径
+    target_frames: 需要的帧序号列表
+    
+    返回:
+    与target_frames对应的BGR帧列表（超出实际帧数的序号被跳过），解码失败时返回空列表
+    """
+    frames_by_index = {}
+    try:
+        with av.open(video_path) as container:
+            stream = container.streams.video[0]
+            stream.thread_type = "AUTO"
+            fps = float(stream.average_rate or stream.guessed_rate or 0)
+            if fps <= 0 or stream.time_base is None:
+                return []
+            time_base = float(stream.time_base)
+            start_pts = stream.start_time or 0
+            
+            for target in sorted(set(target_frames)):
+                container.seek(start_pts + round(target / fps / time_base), backward=True, stream=stream)
+                for frame in container.decode(stream):
+                    if frame.pts is None:
+                        continue
+                    # 按时间戳换算帧序号，取第一个不早于目标的帧
+                    if round((frame.pts - start_pts) * time_base * fps) >= target:
+                        frames_by_index[target] = frame.to_ndarray(format='bgr24')
+                        break
+    except Exception as e:
+        print(f"Warning: PyAV could not decode {video_path}: {str(e)}")
+        return []
+    
+    return [frames_by_index[idx] for idx in target_frames if idx in frames_by_index]
+
 class VideoPathInput(BaseModel):
     """视频路径输入模式"""
     video_path: str = Field(..., description="视频文件的路径")
@@ -18,8 +198,26 @@ class VideoPathInput(BaseModel):
 class VideoAnalysisTools:
     
     @staticmethod
+    @functools.lru_cache(maxsize=1)
     def setup_openai():
-        """设置 OpenAI API"""
+        """设置 OpenAI API（客户端在进程内共享，复用连接池）"""
+        api_key = os.environ.get('OPENAI_API_KEY')
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY environment variable is not set")
+        
+        base_url = os.environ.get('OPENAI_BASE_URL')
+        if not base_url:
+            raise ValueError("OPENAI_BASE_URL environment variable is not set")
+        
+        # 多帧图像请求体较大，安装了h2时使用HTTP/2
+        return openai.Client(api_key=api_key, base_url=base_url, http_client=httpx.Client(
+            http2=h2 is not None,
+            limits=httpx.Limits(max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS)
+        ))
+    
+    @staticmethod
+    def setup_async_openai():
+        """设置异步 OpenAI API，安装了 openai[aiohttp] 时使用 aiohttp 传输"""
         api_key = os.environ.get('OPENAI_API_KEY')
         if not api_key:
             raise ValueError("OPENAI_API_KEY environment variable is not set")
@@ -28,7 +226,15 @@ class VideoAnalysisTools:
         if not base_url:
             raise ValueError("OPENAI_BASE_URL environment variable is not set")
         
-        return openai.Client(api_key=api_key, base_url=base_url)
+        if DefaultAioHttpClient is not None:
+            try:
+                return openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=DefaultAioHttpClient())
+            except RuntimeError as e:
+                print(f"无法使用aiohttp传输，改用httpx: {str(e)}")
+        return openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=httpx.AsyncClient(
+            http2=h2 is not None,
+            limits=httpx.Limits(max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS)
+        ))
     
     @staticmethod
     def encode_image(image_path):
@@ -37,47 +243,118 @@ class VideoAnalysisTools:
             return base64.b64encode(image_file.read()).decode('utf-8')
     
     @staticmethod
-    def analyze_frames_with_openai(frame_paths):
-        """使用 OpenAI 分析视频帧"""
+    def encode_frame_ndarray(frame):
+        """将OpenCV帧直接在内存中编码为JPEG的 base64 字符串"""
+        _, buffer = cv2.imencode('.jpg', frame, FRAME_JPEG_PARAMS)
+        return base64.b64encode(buffer).decode('utf-8')
+    
+    @staticmethod
+    def encode_images(frame_paths):
+        """并行读取并编码多个帧图像（读取文件和base64编码都会释放GIL）"""
+        with ThreadPoolExecutor(max_workers=FRAME_ENCODE_WORKERS) as executor:
+            return list(executor.map(VideoAnalysisTools.encode_image, frame_paths))
+    
+    @staticmethod
+    def build_frame_messages(frame_paths=None, base64_images=None):
+        """
+        构建帧分析请求的消息列表
+        
+        参数:
+        frame_paths: 帧图像路径列表
+        base64_images: 已编码的帧图像 base64 字符串列表，提供时忽略frame_paths
+        """
+        # 准备图像数据
+        if base64_images is None:
+            base64_images = VideoAnalysisTools.encode_images(frame_paths)
+        image_contents = [
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
+            for base64_image in base64_images
+        ]
+        
+        # 构建消息内容
+        message_content = [{"type": "text", "text": FRAME_ANALYSIS_PROMPT}]
+        message_content.extend(image_contents)
+        
+        return [
+            {"role": "system", "content": "You are a professional video analyst."},
+            {"role": "user", "content": message_content}
+        ]
+    
+    @staticmethod
+    def analyze_frames_with_openai(frame_paths=None, base64_images=None):
+        """
+        使用 OpenAI 分析视频帧
+        
+        参数:
+        frame_paths: 帧图像路径列表
+        base64_images: 已编码的帧图像 base64 字符串列表，提供时忽略frame_paths
+        """
         try:
+            if base64_images is None:
+                base64_images = VideoAnalysisTools.encode_images(frame_paths)
+            
+            # 相同帧的分析结果直接使用缓存，不再重复请求
+            cache_key = _frame_analysis_cache_key(base64_images)
+            cached = _load_cached_analysis(cache_key)
+            if cached is not None:
+                return cached
+            
             client = VideoAnalysisTools.setup_openai()
             
-            # 准备图像数据
-            image_contents = []
-            for frame_path in frame_paths:
-                base64_image = VideoAnalysisTools.encode_image(frame_path)
-                image_contents.append({
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-                })
-            
-            # 构建提示
-            prompt = """
-            Please analyze these frames from a video and provide the following information:
-            1. Video type (e.g., vlog, tutorial, documentary, review, etc.)
-            2. Video quality (e.g., high-definition, low quality, professional, amateur)
-            3. Content description (what's shown in the frames)
-            4. Visual aesthetics (composition, lighting, colors)
-            5. Overall quality score (1-10) with justification
+            # 获取分析结果
+            response = client.chat.completions.create(
+                model=FRAME_ANALYSIS_MODEL,  # 使用支持视觉的模型
+                messages=VideoAnalysisTools.build_frame_messages(base64_images=base64_images),
+                max_tokens=1500
+            )
             
-            Format the response as structured information that can be easily parsed.
-            """
+            content = response.choices[0].message.content
+            if content:
+                _save_cached_analysis(cache_key, content)
+            return content
+            
+        except Exception as e:
+            return f"Error analyzing frames with OpenAI: {str(e)}"
+    
+    @staticmethod
+    async def analyze_frames_with_openai_async(frame_paths=None, client=None, base64_images=None):
+        """
+        异步使用 OpenAI 分析视频帧
+        
+        参数:
+        frame_paths: 帧图像路径列表
+        client: 复用的异步客户端，为空时创建新的客户端
+        base64_images: 已编码的帧图像 base64 字符串列表，提供时忽略frame_paths
+        
+        返回:
+        分析结果文本
+        """
+        try:
+            if base64_images is None:
+                base64_images = await asyncio.to_thread(VideoAnalysisTools.encode_images, frame_paths)
+            
+            # 相同帧的分析结果直接使用缓存，不再重复请求
+            cache_key = _frame_analysis_cache_key(base64_images)
+            cached = _load_cached_analysis(cache_key)
+            if cached is not None:
+                return cached
             
-            # 构建消息内容
-            message_content = [{"type": "text", "text": prompt}]
-            message_content.extend(image_contents)
+            if client is None:
+                async with VideoAnalysisTools.setup_async_openai() as client:
+                    return await VideoAnalysisTools.analyze_frames_with_openai_async(
+                        client=client, base64_images=base64_images)
             
             # 获取分析结果
-            response = client.chat.completions.create(
-                model="gemini-1.5-flash",  # 使用支持视觉的模型
-                messages=[
-                    {"role": "system", "content": "You are a professional video analyst."},
-                    {"role": "user", "content": message_content}
-                ],
+            response = await client.chat.completions.create(
+                model=FRAME_ANALYSIS_MODEL,  # 使用支持视觉的模型
+                messages=VideoAnalysisTools.build_frame_messages(base64_images=base64_images),
                 max_tokens=1500
             )
             
-            return response.choices[0].message.content
+            content = response.choices[0].message.content
+            if content:
+                _save_cached_analysis(cache_key, content)
+            return content
             
         except Exception as e:
             return f"Error analyzing frames with OpenAI: {str(e)}"
@@ -105,14 +382,48 @@ class GetVideoInfoTool(BaseTool):
             duration = frame_count / fps if fps > 0 else 0
             
             # 提取视频的代表性帧用于分析
-            frame_positions = [0.05,0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5, 0.6, 0.65, 0.7, 0.8,  0.9]  # 在视频的不同位置取帧
-            sample_frames = []
+            # 多个位置落在同一帧时（视频很短）只取一次
+            target_frames = np.unique((SAMPLE_FRAME_POSITIONS * frame_count).astype(np.int64)).tolist()
+            
+            # 安装了PyAV时在进程内逐个定位解码取出样本帧
+            base64_images = None
+            if av is not None and target_frames:
+                sample_frames = _sample_frames_av(video_path, target_frames)
+                if sample_frames:
+                    with ThreadPoolExecutor(max_workers=FRAME_ENCODE_WORKERS) as executor:
+                        base64_images = list(executor.map(VideoAnalysisTools.encode_frame_ndarray, sample_frames))
+            
+            # 否则用一次FFmpeg顺序解码取出所有样本帧，避免逐个定位时反复从关键帧解码
+            if base64_images is None and _FFMPEG:
+                jpeg_frames = _sample_jpegs_ffmpeg(video_path, target_frames)
+                if jpeg_frames:
+                    base64_images = [base64.b64encode(jpeg).decode('utf-8') for jpeg in jpeg_frames]
             
-            for pos in frame_positions:
-                cap.set(cv2.CAP_PROP_POS_FRAMES, int(frame_count * pos))
-                ret, frame = cap.read()
-                if ret:
-                    sample_frames.append(frame)
+            if base64_images is None:
+                # 相邻样本帧之间顺序grab()，间隔较大时直接定位，只在样本帧处取出图像
+                seek_gap = max(1, int(round((fps or 25) * SAMPLE_SEEK_GAP_SECONDS)))
+                frames_by_index = {}
+                frame_idx = 0
+                for target in target_frames:
+                    if target - frame_idx > seek_gap:
+                        cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+                        frame_idx = target
+                    grabbed = True
+                    while frame_idx <= target:
+                        grabbed = cap.grab()
+                        if not grabbed:
+                            break
+                        frame_idx += 1
+                    if not grabbed:
+                        break
+                    ret, frame = cap.retrieve()
+                    if ret:
+                        frames_by_index[target] = frame
+                sample_frames = [frames_by_index[idx] for idx in target_frames if idx in frames_by_index]
+                
+                # 在内存中将样本帧编码为JPEG，不经过临时文件
+                with ThreadPoolExecutor(max_workers=FRAME_ENCODE_WORKERS) as executor:
+                    base64_images = list(executor.map(VideoAnalysisTools.encode_frame_ndarray, sample_frames))
 
             cap.release()
             
@@ -125,19 +436,8 @@ class GetVideoInfoTool(BaseTool):
                 "fps": fps,
             }
             
-            # 使用临时文件保存样本帧
-            temp_frames = []
-            for i, frame in enumerate(sample_frames):
-                temp_file = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
-                cv2.imwrite(temp_file.name, frame)
-                temp_frames.append(temp_file.name)
-            
             # 分析样本帧
-            frame_analysis = VideoAnalysisTools.analyze_frames_with_openai(temp_frames)
-            
-            # 清理临时文件
-            for temp_file in temp_frames:
-                os.unlink(temp_file)
+            frame_analysis = VideoAnalysisTools.analyze_frames_with_openai(base64_images=base64_images)
             
             # 合并信息
             result = {
@@ -1,24 +1,99 @@
 import os
+import re
 import json
-import tempfile
-import subprocess
 import shutil
-from typing import Type, List, Dict, Any
+import functools
+import subprocess
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Type, List, Dict, Any, Optional
 from pydantic import BaseModel, Field
 from crewai.tools import BaseTool, tool
 
+# FFmpeg/FFprobe可执行文件路径，导入时查找一次，未安装时为None
+_FFMPEG = shutil.which("ffmpeg")
+_FFPROBE = shutil.which("ffprobe")
+
+# 重新编码切割时并行的FFmpeg进程数（每个libx264进程本身也会使用多线程）
+SPLIT_MAX_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+# 各H.264编码器的编码参数，按优先顺序排列，libx264作为兜底
+H264_ENCODER_ARGS = {
+    "h264_nvenc": ("-c:v", "h264_nvenc", "-preset", "p4", "-rc", "vbr", "-cq", "23"),
+    "h264_qsv": ("-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "23"),
+    "h264_videotoolbox": ("-c:v", "h264_videotoolbox", "-b:v", "6M"),
+    "libx264": ("-c:v", "libx264", "-preset", "ultrafast", "-crf", "23"),
+}
+
+# 切割命令中与分段无关的固定参数，在模块级构建一次
+_REENCODE_OUTPUT_ARGS = (
+    "-c:a", "aac",  # 音频编码
+    "-b:a", "128k",  # 音频比特率
+    "-avoid_negative_ts", "1",  # 避免负时间戳
+    "-async", "1",  # 音频同步
+    "-vsync", "1",  # 视频同步
+    "-movflags", "+faststart",  # 优化MP4文件结构
+)
+_COPY_OUTPUT_ARGS = (
+    "-c", "copy",
+    "-avoid_negative_ts", "1",
+    "-movflags", "+faststart",
+)
+_PROBE_STREAM_ARGS = (
+    "-v", "error",
+    "-select_streams", "v:0",
+    "-show_entries", "stream=codec_name,width,height,r_frame_rate,duration",
+    "-of", "json",
+)
+
+# 文件名中需要替换为下划线的字符（只保留字母数字、下划线、空格和连字符）
+_UNSAFE = re.compile(r'[^\w \-]')
+
+# 有效分段文件的最小字节数（小于此值视为没有写出音视频数据）
+MIN_SEGMENT_FILE_SIZE = 1024
+
+@functools.lru_cache(maxsize=1)
+def _detect_h264_encoder() -> str:
+    """检查ffmpeg支持的H.264编码器，优先使用硬件编码器，结果缓存"""
+    if _FFMPEG:
+        try:
+            result = subprocess.run(
+                [_FFMPEG, "-hide_banner", "-encoders"],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+            )
+            for encoder in H264_ENCODER_ARGS:
+                if encoder != "libx264" and f" {encoder} " in result.stdout:
+                    return encoder
+        except (subprocess.SubprocessError, OSError):
+            pass
+    return "libx264"
+
+# 在ffmpeg中列出但运行时编码失败的编码器，之后的分段直接使用libx264，不再先尝试
+_FAILED_H264_ENCODERS = set()
+
+def _h264_encoder_args(encoder: str) -> tuple:
+    """返回H.264编码器的编码参数，不支持的编码器抛出ValueError"""
+    try:
+        return H264_ENCODER_ARGS[encoder]
+    except KeyError:
+        raise ValueError(
+            f"Unsupported H.264 encoder: {encoder!r}. Expected one of: {', '.join(H264_ENCODER_ARGS)}"
+        ) from None
+
 class VideoEditingInput(BaseModel):
     """视频编辑工具的输入模式"""
     video_path: str = Field(..., description="视频文件的路径")
     segments: List[Dict[str, Any]] = Field(..., description="分段信息列表，每个分段包含start/start_time和end/end_time")
     output_dir: str = Field(..., description="输出目录")
+    reencode: bool = Field(True, description="是否重新编码；为False时使用流复制，速度快但起点对齐到前一个关键帧")
 
 class SplitVideoBySegmentsTool(BaseTool):
     name: str = "SplitVideoBySegments"
     description: str = "使用FFmpeg根据分段信息切割视频，支持start/end或start_time/end_time格式"
     args_schema: Type[BaseModel] = VideoEditingInput
+    encoder: str = Field(default="", description="重新编码使用的H.264编码器，为空时自动选择（硬件编码器优先）")
     
-    def _run(self, video_path: str, segments: List[Dict[str, Any]], output_dir: str) -> dict:
+    def _run(self, video_path: str, segments: List[Dict[str, Any]], output_dir: str, reencode: bool = True) -> dict:
         """
         使用FFmpeg根据分段信息切割视频
         
@@ -26,6 +101,7 @@ class SplitVideoBySegmentsTool(BaseTool):
         video_path: 视频文件路径
         segments: 分段信息列表，支持start/end或start_time/end_time格式
         output_dir: 输出目录
+        reencode: 是否重新编码；为False时使用流复制，起点对齐到前一个关键帧
         
         返回:
         切割后的视频文件信息
@@ -38,20 +114,11 @@ class SplitVideoBySegmentsTool(BaseTool):
         
         try:
             # 检查ffmpeg是否可用
-            try:
-                subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-            except (subprocess.SubprocessError, FileNotFoundError):
+            if not _FFMPEG:
                 return "Error: FFmpeg is not installed or not in PATH. Please install FFmpeg."
             
             # 获取视频信息
-            probe_cmd = [
-                "ffprobe",
-                "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "stream=codec_name,width,height,r_frame_rate,duration",
-                "-of", "json",
-                video_path
-            ]
+            probe_cmd = [_FFPROBE or "ffprobe", *_PROBE_STREAM_ARGS, video_path]
             
             probe_result = subprocess.run(
                 probe_cmd,
@@ -74,112 +141,37 @@ class SplitVideoBySegmentsTool(BaseTool):
             # 打印完整的分段数据用于调试
             print(f"Received segments: {json.dumps(segments, indent=2)}")
             
-            # 切割视频
-            output_files = []
+            # 重新编码时使用的编码器
+            encoder = self.encoder or _detect_h264_encoder()
+            if reencode:
+                _h264_encoder_args(encoder)
             
-            for i, segment in enumerate(segments):
-                # 兼容两种时间格式：start/end 和 start_time/end_time
-                start_time = segment.get("start", segment.get("start_time", 0))
-                end_time = segment.get("end", segment.get("end_time", 0))
-                title = segment.get("title", f"Segment {i+1}")
-                
-                print(f"Processing segment {i+1}: {json.dumps(segment, indent=2)}")
-                print(f"Extracted times: start={start_time}, end={end_time}")
-                
-                # 安全处理文件名
-                safe_title = "".join([c if c.isalnum() or c in [' ', '_', '-'] else '_' for c in title])
-                safe_title = safe_title.strip().replace(' ', '_')
-                
-                # 输出文件路径
-                output_file = os.path.join(output_dir, f"{i+1:02d}_{safe_title}.mp4")
-                
-                # 计算持续时间
-                duration = float(end_time) - float(start_time)
-                
-                if duration <= 0:
-                    print(f"Warning: Invalid segment duration for segment {i+1}: {duration} seconds. Skipping.")
-                    continue
-                
-                print(f"Processing segment {i+1}: start={start_time}, end={end_time}, duration={duration}")
-                
-                # 创建临时目录用于处理
-                temp_dir = tempfile.mkdtemp()
-                temp_output = os.path.join(temp_dir, "temp_output.mp4")
-                
-                try:
-                    # 使用FFmpeg切割视频 - 使用更可靠的参数
-                    cmd = [
-                        "ffmpeg",
-                        "-y",  # 覆盖输出文件
-                        "-ss", str(start_time),  # 开始时间
-                        "-i", video_path,  # 输入文件
-                        "-t", str(duration),  # 持续时间
-                        "-c:v", "libx264",  # 视频编码
-                        "-preset", "medium",  # 编码预设
-                        "-crf", "23",  # 质量因子
-                        "-c:a", "aac",  # 音频编码
-                        "-b:a", "128k",  # 音频比特率
-                        "-avoid_negative_ts", "1",  # 避免负时间戳
-                        "-async", "1",  # 音频同步
-                        "-vsync", "1",  # 视频同步
-                        "-movflags", "+faststart",  # 优化MP4文件结构
-                        temp_output  # 临时输出文件
-                    ]
-                    
-                    print(f"FFmpeg command: {' '.join(cmd)}")
-                    
-                    # 执行命令
-                    process = subprocess.run(
-                        cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True
-                    )
-                    
-                    if process.returncode != 0:
-                        print(f"Warning: Error cutting segment {i+1}:")
-                        print(f"Command: {' '.join(cmd)}")
-                        print(f"Error: {process.stderr}")
-                        continue
-                    
-                    # 验证输出文件是否有效
-                    validate_cmd = [
-                        "ffprobe",
-                        "-v", "error",
-                        "-select_streams", "v:0",
-                        "-show_entries", "stream=codec_type",
-                        "-of", "json",
-                        temp_output
-                    ]
-                    
-                    validate_result = subprocess.run(
-                        validate_cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True
-                    )
-                    
-                    if validate_result.returncode != 0:
-                        print(f"Warning: Generated segment {i+1} is invalid: {validate_result.stderr}")
-                        continue
-                    
-                    # 复制到最终输出位置
-                    shutil.copy2(temp_output, output_file)
-                    
-                    output_files.append({
-                        "segment_id": i + 1,
-                        "title": title,
-                        "start_time": start_time,
-                        "end_time": end_time,
-                        "duration": duration,
-                        "file_path": output_file
-                    })
-                    
-                    print(f"Successfully created segment {i+1}: {output_file}")
-                    
-                finally:
-                    # 清理临时目录
-                    shutil.rmtree(temp_dir, ignore_errors=True)
+            # 一次性提取所有分段的起止时间并校验（兼容 start/end 和 start_time/end_time 两种格式）
+            starts = np.array([float(s.get("start", s.get("start_time", 0))) for s in segments], dtype=np.float64)
+            ends = np.array([float(s.get("end", s.get("end_time", 0))) for s in segments], dtype=np.float64)
+            durations = ends - starts
+            valid = durations > 0
+            for i in np.flatnonzero(~valid).tolist():
+                print(f"Warning: Invalid segment duration for segment {i+1}: {durations[i]} seconds. Skipping.")
+            
+            # 流复制只能从关键帧开始，起点对齐到不晚于起始时间的最后一个关键帧
+            cut_starts = starts
+            if not reencode:
+                keyframes = np.asarray(self._probe_keyframes(video_path), dtype=np.float64)
+                if keyframes.size:
+                    keyframe_idx = np.searchsorted(keyframes, starts, side='right') - 1
+                    cut_starts = np.where(keyframe_idx >= 0, keyframes[np.maximum(keyframe_idx, 0)], starts)
+            
+            # 各分段相互独立，并行执行FFmpeg切割
+            max_workers = SPLIT_MAX_WORKERS if reencode else (os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(self._cut_one, segments[i], i, video_path, output_dir,
+                                    float(cut_starts[i]), float(ends[i]), reencode, encoder)
+                    for i in np.flatnonzero(valid).tolist()
+                ]
+                # 按分段顺序收集结果，跳过切割失败的分段
+                output_files = [result for result in (future.result() for future in futures) if result is not None]
             
             if not output_files:
                 return "Error: No valid segments were created. Check the segment times and video format."
@@ -190,8 +182,176 @@ class SplitVideoBySegmentsTool(BaseTool):
                 "output_directory": output_dir,
                 "video_info": video_info
             }
-            
+        
         except Exception as e:
             import traceback
             error_details = traceback.format_exc()
-            return f"Error splitting video: {str(e)}\n\nDetails:\n{error_details}" 
\ No newline at end of file
+            return f"Error splitting video: {str(e)}\n\nDetails:\n{error_details}"
+    
+    @staticmethod
+    def _probe_keyframes(video_path: str) -> List[float]:
+        """
+        获取视频流所有关键帧的时间（秒），升序排列
+        
+        参数:
+        video_path: 视频文件路径
+        
+        返回:
+        关键帧时间列表，获取失败时返回空列表
+        """
+        cmd = [
+            _FFPROBE or "ffprobe",
+            "-v", "error",
+            "-select_streams", "v:0",
+            "-skip_frame", "nokey",
+            "-show_entries", "frame=best_effort_timestamp_time",
+            "-of", "csv=p=0",
+            video_path
+        ]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        if result.returncode != 0:
+            print("Warning: Could not probe keyframes, stream copy will start at the requested times")
+            return []
+        
+        keyframes = []
+        for line in result.stdout.splitlines():
+            try:
+                keyframes.append(float(line.strip().rstrip(',')))
+            except ValueError:
+                continue
+        keyframes.sort()
+        return keyframes
+    
+    def _cut_one(self, segment: Dict[str, Any], i: int, video_path: str, output_dir: str,
+                 start_time: float, end_time: float, reencode: bool = True,
+                 encoder: str = "libx264") -> Optional[Dict[str, Any]]:
+        """
+        切割单个分段（起止时间已在 _run 中校验）
+        
+        参数:
+        segment: 分段信息
+        i: 分段序号（从0开始）
+        video_path: 视频文件路径
+        output_dir: 输出目录
+        start_time: 切割起始时间（秒），流复制时已对齐到关键帧
+        end_time: 结束时间（秒）
+        reencode: 是否重新编码
+        encoder: 重新编码时使用的H.264编码器（H264_ENCODER_ARGS中的键）
+        
+        返回:
+        切割成功时返回分段文件信息，否则返回None
+        """
+        title = segment.get("title", f"Segment {i+1}")
+        
+        print(f"Processing segment {i+1}: {json.dumps(segment, indent=2)}")
+        
+        # 安全处理文件名
+        safe_title = _UNSAFE.sub('_', title).strip().replace(' ', '_')
+        
+        # 输出文件路径
+        output_file = os.path.join(output_dir, f"{i+1:02d}_{safe_title}.mp4")
+        
+        # 计算持续时间
+        duration = end_time - start_time
+        
+        print(f"Processing segment {i+1}: start={start_time}, end={end_time}, duration={duration}")
+        
+        # 之前的分段已确认该编码器无法使用时，直接使用libx264
+        if encoder in _FAILED_H264_ENCODERS:
+            encoder = "libx264"
+        
+        cmd = self._build_cut_cmd(video_path, output_file, start_time, duration, encoder if reencode else None)
+        print(f"FFmpeg command: {' '.join(cmd)}")
+        
+        # 执行命令，标准输出直接丢弃，错误日志以字节保留
+        process = subprocess.run(
+            cmd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        
+        # 硬件编码器可能列出但实际不可用（如没有GPU），此时改用libx264重试
+        if process.returncode != 0 and reencode and encoder != "libx264":
+            print(f"Warning: Encoder {encoder} failed for segment {i+1}, retrying with libx264")
+            cmd = self._build_cut_cmd(video_path, output_file, start_time, duration, "libx264")
+            process = subprocess.run(
+                cmd,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE
+            )
+            if process.returncode == 0:
+                _FAILED_H264_ENCODERS.add(encoder)
+        
+        if process.returncode != 0:
+            print(f"Warning: Error cutting segment {i+1}:")
+            print(f"Command: {' '.join(cmd)}")
+            # 只在失败时解码FFmpeg的日志
+            print(f"Error: {process.stderr.decode('utf-8', errors='replace')}")
+            self._discard_output(output_file)
+            return None
+        
+        # 验证输出文件是否有效：FFmpeg已成功退出，只需确认输出文件不是空壳
+        output_size = os.path.getsize(output_file) if os.path.exists(output_file) else 0
+        if output_size <= MIN_SEGMENT_FILE_SIZE:
+            print(f"Warning: Generated segment {i+1} is invalid: output file is only {output_size} bytes")
+            self._discard_output(output_file)
+            return None
+        
+        print(f"Successfully created segment {i+1}: {output_file}")
+        
+        return {
+            "segment_id": i + 1,
+            "title": title,
+            "start_time": start_time,
+            "end_time": end_time,
+            "duration": duration,
+            "file_path": output_file
+        }
+    
+    @staticmethod
+    def _build_cut_cmd(video_path: str, output_file: str, start_time, duration: float,
+                       encoder: Optional[str]) -> List[str]:
+        """
+        构建切割单个分段的FFmpeg命令
+        
+        参数:
+        video_path: 视频文件路径
+        output_file: 输出文件路径
+        start_time: 开始时间（秒）
+        duration: 持续时间（秒）
+        encoder: H.264编码器，为None时使用流复制
+        
+        返回:
+        FFmpeg命令参数列表
+        """
+        if encoder is None:
+            # 流复制，不重新编码
+            return [
+                _FFMPEG,
+                "-y",
+                "-ss", str(start_time),
+                "-i", video_path,
+                "-t", str(duration),
+                *_COPY_OUTPUT_ARGS,
+                output_file
+            ]
+        
+        # 使用FFmpeg切割视频 - 使用更可靠的参数
+        return [
+            _FFMPEG,
+            "-y",  # 覆盖输出文件
+            "-ss", str(start_time),  # 开始时间
+            "-i", video_path,  # 输入文件
+            "-t", str(duration),  # 持续时间
+            *_h264_encoder_args(encoder),  # 视频编码
+            *_REENCODE_OUTPUT_ARGS,  # 音频编码与封装参数
+            output_file  # 直接输出到最终位置
+        ]
+    
+    @staticmethod
+    def _discard_output(output_file: str) -> None:
+        """删除切割失败时残留的输出文件"""
+        try:
+            os.unlink(output_file)
+        except FileNotFoundError:
+            pass
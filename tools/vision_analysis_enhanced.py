@@ -1,18 +1,252 @@
 import os
+import re
 import cv2
 import tempfile
 import base64
+import functools
 import openai
-from PIL import Image
-import io
+import httpx
 import numpy as np
 from typing import Optional, Type, List, Dict, Any
 from pydantic import BaseModel, Field
 from crewai.tools import BaseTool, tool
 import json
+import orjson
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    # 可选依赖：h2 用于 httpx 的 HTTP/2 支持
+    import h2
+except ImportError:
+    h2 = None
+
+try:
+    # 可选依赖：ffmpegcv 可通过 NVDEC 在GPU上解码并缩放
+    import ffmpegcv
+except ImportError:
+    ffmpegcv = None
+
+try:
+    # 可选依赖：PyTurboJPEG 使用 libjpeg-turbo 的SIMD路径编码JPEG
+    from turbojpeg import TurboJPEG, TJPF_BGR
+except ImportError:
+    TurboJPEG = None
+
+# 同时进行的视觉分析请求数
+VISION_MAX_CONCURRENCY = 8
+
+# 视觉分析请求的最大尝试次数及重试的初始等待秒数（每次翻倍），客户端不再叠加SDK的重试
+VISION_MAX_ATTEMPTS = 3
+VISION_RETRY_BASE_DELAY = 1.0
+
+# 相邻采样位置相隔超过这么多秒的帧时直接定位，否则顺序grab()（定位只需从前一个关键帧解码）
+SAMPLE_SEEK_GAP_SECONDS = 2.0
+
+# 后台解码线程最多预先准备好的批次数
+FRAME_PREFETCH_BATCHES = 2
+
+# 发送给视觉模型的图像长边上限（像素）、JPEG质量和细节级别
+VISION_MAX_IMAGE_SIZE = 768
+VISION_JPEG_QUALITY = 75
+VISION_IMAGE_DETAIL = "low"
+
+# 写入磁盘的帧文件JPEG质量
+FRAME_FILE_JPEG_QUALITY = 80
+
+# 按路径和修改时间缓存的已编码帧数量（每帧缩小后约几十KB）
+VISION_PAYLOAD_CACHE_SIZE = 1024
+
+# 文本响应中的帧标记，如"帧1"、"Frame 2"、"图片3"、"Image 4"
+_FRAME_MARKER_PATTERN = re.compile(r'(?:帧|Frame|图片|Image)\s*(\d+)')
+
+# 模型用json代码块包裹响应时提取其中的JSON
+_JSON_BLOCK_PATTERN = re.compile(r'```json\n(.*?)\n```', re.DOTALL)
+
+# 帧文件名中的时间戳，如"frame_012_34.50s.jpg"
+_FRAME_TIMESTAMP_PATTERN = re.compile(r'_(\d+\.\d+)s\.jpg$')
+
+# 共享HTTP客户端的连接池大小
+VISION_MAX_CONNECTIONS = 64
+VISION_MAX_KEEPALIVE_CONNECTIONS = 32
+
+# 可以重试的请求错误（网络错误、限流和服务端错误）
+_RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+def _create_completion_with_retry(client, **kwargs):
+    """发送对话请求，遇到网络错误、限流或服务端错误时按指数退避重试"""
+    for attempt in range(VISION_MAX_ATTEMPTS):
+        try:
+            return client.chat.completions.create(**kwargs)
+        except _RETRYABLE_ERRORS as e:
+            if attempt == VISION_MAX_ATTEMPTS - 1:
+                raise
+            delay = VISION_RETRY_BASE_DELAY * (2 ** attempt)
+            print(f"请求失败（{str(e)}），{delay:.0f}秒后重试")
+            time.sleep(delay)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_turbojpeg():
+    """获取共享的TurboJPEG实例，未安装PyTurboJPEG或找不到libturbojpeg时返回None"""
+    if TurboJPEG is None:
+        return None
+    try:
+        return TurboJPEG()
+    except Exception as e:
+        print(f"无法加载libturbojpeg，使用OpenCV编码JPEG: {str(e)}")
+        return None
+
+
+def _encode_jpeg(frame, quality: int) -> bytes:
+    """将BGR帧编码为JPEG数据，优先使用TurboJPEG，否则使用OpenCV"""
+    turbojpeg = _get_turbojpeg()
+    if turbojpeg is not None:
+        return turbojpeg.encode(frame, quality=quality, pixel_format=TJPF_BGR)
+    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
+
+
+@functools.lru_cache(maxsize=1)
+def _shared_http_client() -> httpx.Client:
+    """
+    所有视觉分析工具共用的HTTP客户端
+    
+    连接池在各工具实例和批次之间复用，避免重复的TCP/TLS握手；安装了h2时使用HTTP/2
+    """
+    kwargs = {}
+    # 设置代理（如果需要）
+    proxy_url = os.environ.get('HTTP_PROXY')
+    if proxy_url:
+        kwargs["proxies"] = {"http://": proxy_url, "https://": proxy_url}
+    return httpx.Client(
+        http2=h2 is not None,
+        limits=httpx.Limits(max_connections=VISION_MAX_CONNECTIONS,
+                            max_keepalive_connections=VISION_MAX_KEEPALIVE_CONNECTIONS),
+        # 多图请求生成较慢，沿用OpenAI SDK的默认超时
+        timeout=openai.DEFAULT_TIMEOUT,
+        **kwargs
+    )
+
+
+def _loads_json_response(content: str):
+    """
+    解析模型返回的JSON内容
+    
+    请求使用了JSON输出模式，通常可以直接解析；模型仍用json代码块包裹时再从代码块中提取
+    
+    返回:
+    解析后的对象，无法解析时返回None
+    """
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        pass
+    
+    json_match = _JSON_BLOCK_PATTERN.search(content)
+    if json_match:
+        try:
+            return json.loads(json_match.group(1))
+        except json.JSONDecodeError:
+            pass
+    return None
+
+
+def iter_frames(frames_result: Dict[str, Any]):
+    """
+    逐帧生成 ExtractVideoFrames 结果中的帧信息
+    
+    ExtractVideoFrames 按列返回帧信息（frame_ids、paths、timestamps等），
+    需要逐帧处理的调用方可以用此函数得到与以前相同的 {"frame_id", "path", "timestamp", "timestamp_formatted"} 字典
+    """
+    columns = [
+        ("frame_id", frames_result["frame_ids"]),
+        ("path", frames_result["paths"]),
+        ("timestamp", frames_result["timestamps"]),
+        ("timestamp_formatted", frames_result["timestamps_formatted"]),
+    ]
+    if "jpeg_bytes" in frames_result:
+        columns.append(("jpeg_bytes", frames_result["jpeg_bytes"]))
+    
+    keys = [key for key, _ in columns]
+    for values in zip(*(column for _, column in columns)):
+        yield dict(zip(keys, values))
+
+
+def _iter_sampled_frames(cap, frame_positions: List[int]):
+    """
+    推进解码器到各采样位置，只在命中采样位置时取出图像
+    
+    逐帧定位（CAP_PROP_POS_FRAMES）每次都会清空解码器并从前一个关键帧重新解码，因此相邻的
+    采样位置之间顺序grab()；与下一个采样位置相隔超过 SAMPLE_SEEK_GAP_SECONDS 时直接定位过去，
+    稀疏采样不必解码整个视频。
+    
+    参数:
+    cap: 已打开的cv2.VideoCapture
+    frame_positions: 升序排列的采样帧序号
+    
+    返回:
+    (采样序号, 帧序号, BGR帧) 的生成器；读取失败的采样位置被跳过
+    """
+    seek_gap = max(1, int(round((cap.get(cv2.CAP_PROP_FPS) or 25) * SAMPLE_SEEK_GAP_SECONDS)))
+    next_idx = 0
+    frame_idx = 0
+    while next_idx < len(frame_positions):
+        # 第一个采样位置之前以及采样位置之间的大段间隔都直接定位跳过
+        if frame_positions[next_idx] - frame_idx > seek_gap:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_positions[next_idx])
+            frame_idx = frame_positions[next_idx]
+        if not cap.grab():
+            break
+        if frame_idx == frame_positions[next_idx]:
+            ret, frame = cap.retrieve()
+            # 相同的采样位置只解码一次
+            while next_idx < len(frame_positions) and frame_positions[next_idx] == frame_idx:
+                if ret:
+                    yield next_idx, frame_idx, frame
+                next_idx += 1
+        frame_idx += 1
+
+def _iter_sampled_frames_nv(cap, frame_positions: List[int]):
+    """
+    与 _iter_sampled_frames 相同，但用于只支持顺序read()的 ffmpegcv 读取器
+    
+    返回:
+    (采样序号, 帧序号, BGR帧) 的生成器
+    """
+    next_idx = 0
+    frame_idx = 0
+    while next_idx < len(frame_positions):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        # 相同的采样位置只输出同一帧
+        while next_idx < len(frame_positions) and frame_positions[next_idx] == frame_idx:
+            yield next_idx, frame_idx, frame
+            next_idx += 1
+        frame_idx += 1
+
+def _open_capture_nv(video_path: str, width: int, height: int):
+    """
+    使用 ffmpegcv 的 NVDEC 解码打开视频，并在GPU上直接缩放到长边不超过 VISION_MAX_IMAGE_SIZE
+    
+    返回:
+    ffmpegcv读取器，GPU 解码不可用时返回 None
+    """
+    if ffmpegcv is None or width <= 0 or height <= 0:
+        return None
+    
+    scale = min(1.0, VISION_MAX_IMAGE_SIZE / max(width, height))
+    # NVDEC缩放要求偶数尺寸
+    size = (int(width * scale) // 2 * 2, int(height * scale) // 2 * 2)
+    try:
+        return ffmpegcv.VideoCaptureNV(video_path, pix_fmt='bgr24', resize=size, resize_keepratio=False)
+    except Exception as e:
+        print(f"GPU解码不可用，使用CPU解码: {str(e)}")
+        return None
 
 class VideoFrameExtractionInput(BaseModel):
     """视频帧提取工具的输入模式"""
@@ -20,11 +254,14 @@ class VideoFrameExtractionInput(BaseModel):
     frame_interval: int = Field(1, description="提取帧的时间间隔（秒）")
     max_frames: int = Field(60, description="最大提取帧数")
     sampling_strategy: str = Field("uniform", description="采样策略: uniform(均匀采样整个视频), front_loaded(前部密集采样)")
+    # return_encoded 只供进程内的Python调用方使用，不暴露给智能体（JPEG数据不应进入对话上下文）
 
 class FrameAnalysisInput(BaseModel):
     """帧分析工具的输入模式"""
     frame_paths: List[str] = Field(..., description="帧图像路径列表")
     batch_size: int = Field(15, description="每批处理的最大帧数")
+    # frames_data 只供进程内的Python调用方使用，智能体无法传递JPEG数据
+    timestamps: Optional[List[float]] = Field(None, description="与frame_paths一一对应的时间戳（秒），提供时不再从文件名解析")
 
 class VisionAnalysisTools:
     
@@ -45,14 +282,49 @@ class VisionAnalysisTools:
     def encode_image(image_path):
         """将图像编码为 base64 字符串"""
         with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+            return base64.b64encode(image_file.read()).decode('ascii')
+    
+    @staticmethod
+    def prepare_vision_payload(image_path):
+        """
+        将图像缩小到长边不超过 VISION_MAX_IMAGE_SIZE 并重新编码为JPEG，返回 base64 字符串
+        
+        原始帧可能是1080p或4K，直接上传会增加带宽、视觉token和模型延迟。
+        结果按路径和修改时间缓存，重复分析同一帧文件时不再读取和编码
+        """
+        return VisionAnalysisTools._prepare_vision_payload_cached(image_path, os.stat(image_path).st_mtime_ns)
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=VISION_PAYLOAD_CACHE_SIZE)
+    def _prepare_vision_payload_cached(image_path, mtime_ns):
+        image = cv2.imread(image_path)
+        if image is None:
+            # OpenCV无法读取时原样上传
+            return VisionAnalysisTools.encode_image(image_path)
+        return VisionAnalysisTools.encode_frame(image)
+    
+    @staticmethod
+    def encode_frame_jpeg(frame):
+        """将BGR帧缩小到长边不超过 VISION_MAX_IMAGE_SIZE，并在内存中编码为JPEG数据"""
+        height, width = frame.shape[:2]
+        scale = min(1.0, VISION_MAX_IMAGE_SIZE / max(height, width))
+        if scale < 1.0:
+            frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        
+        return _encode_jpeg(frame, VISION_JPEG_QUALITY)
+    
+    @staticmethod
+    def encode_frame(frame):
+        """将BGR帧缩小并编码为JPEG，返回 base64 字符串"""
+        return base64.b64encode(VisionAnalysisTools.encode_frame_jpeg(frame)).decode('ascii')
 
 class ExtractVideoFramesTool(BaseTool):
     name: str = "ExtractVideoFrames"
     description: str = "从视频中提取关键帧用于分析，支持均匀采样和前部密集采样"
     args_schema: Type[BaseModel] = VideoFrameExtractionInput
     
-    def _run(self, video_path: str, frame_interval: int = 5, max_frames: int = 60, sampling_strategy: str = "uniform") -> dict:
+    def _run(self, video_path: str, frame_interval: int = 5, max_frames: int = 60, sampling_strategy: str = "uniform",
+             return_encoded: bool = False) -> dict:
         """
         从视频中提取关键帧
         
@@ -61,16 +333,18 @@ class ExtractVideoFramesTool(BaseTool):
         frame_interval: 提取帧的时间间隔（秒）
         max_frames: 最大提取帧数
         sampling_strategy: 采样策略: uniform(均匀采样整个视频), front_loaded(前部密集采样)
+        return_encoded: 为True时不写入磁盘，各帧的JPEG数据放在jpeg_bytes列中，paths只是帧文件名
         
         返回:
-        提取的帧路径和时间戳
+        提取的帧路径和时间戳，按列存放（frame_ids、paths、timestamps、timestamps_formatted），
+        paths、jpeg_bytes和timestamps可直接作为 AnalyzeVideoFrames 的 frame_paths、frames_data和timestamps；逐帧访问可使用 iter_frames
         """
         if not os.path.exists(video_path):
             return f"Error: Video file not found: {video_path}"
         
         try:
-            # 创建临时目录存储帧
-            temp_dir = tempfile.mkdtemp()
+            # 创建临时目录存储帧（返回编码数据时不需要）
+            temp_dir = None if return_encoded else tempfile.mkdtemp()
             
             # 打开视频
             cap = cv2.VideoCapture(video_path)
@@ -83,8 +357,6 @@ class ExtractVideoFramesTool(BaseTool):
             duration = total_frames / fps
             
             # 根据采样策略确定帧位置
-            frame_positions = []
-            
             if sampling_strategy.lower() == "uniform":
                 # 均匀采样整个视频
                 if max_frames >= total_frames:
@@ -95,7 +367,7 @@ class ExtractVideoFramesTool(BaseTool):
                     step = total_frames / max_frames
                 
                 # 生成均匀分布的帧位置
-                frame_positions = [int(i * step) for i in range(min(max_frames, total_frames))]
+                frame_positions = np.floor(np.arange(min(max_frames, total_frames), dtype=np.float64) * step).astype(np.int64)
                 
             elif sampling_strategy.lower() == "front_loaded":
                 # 前部密集采样 (前半部分占用70%的采样点)
@@ -103,54 +375,63 @@ class ExtractVideoFramesTool(BaseTool):
                 back_frames = max_frames - front_frames
                 
                 # 前半部分密集采样
+                front = np.empty(0, dtype=np.int64)
                 if front_frames > 0:
                     front_step = (total_frames // 2) / front_frames
-                    frame_positions.extend([int(i * front_step) for i in range(front_frames)])
+                    front = np.floor(np.arange(front_frames, dtype=np.float64) * front_step).astype(np.int64)
                 
                 # 后半部分稀疏采样
+                back = np.empty(0, dtype=np.int64)
                 if back_frames > 0:
                     back_step = (total_frames - total_frames // 2) / back_frames
-                    frame_positions.extend([int(total_frames // 2 + i * back_step) for i in range(back_frames)])
+                    back = (total_frames // 2 + np.arange(back_frames, dtype=np.float64) * back_step).astype(np.int64)
+                
+                frame_positions = np.concatenate([front, back])
             else:
                 # 默认使用基于间隔的采样
                 frame_step = int(fps * frame_interval)
-                frame_positions = list(range(0, total_frames, frame_step))[:max_frames]
+                frame_positions = np.arange(0, total_frames, frame_step, dtype=np.int64)[:max_frames]
             
-            # 提取帧
-            frames_info = []
+            # 提取帧，各字段按列存放
+            frame_ids = []
+            frame_indices = []
+            paths = []
+            jpeg_bytes = []
             
-            for frame_count, frame_position in enumerate(frame_positions):
-                # 设置帧位置
-                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_position)
-                
-                # 读取帧
-                ret, frame = cap.read()
-                if not ret:
-                    continue
+            for frame_count, frame_position, frame in _iter_sampled_frames(cap, np.sort(frame_positions).tolist()):
+                frame_name = f"frame_{frame_count:03d}_{frame_position / fps:.2f}s.jpg"
                 
-                # 计算时间戳
-                timestamp = frame_position / fps
-                
-                # 保存帧
-                frame_path = os.path.join(temp_dir, f"frame_{frame_count:03d}_{timestamp:.2f}s.jpg")
-                cv2.imwrite(frame_path, frame)
+                if return_encoded:
+                    # 直接在内存中编码，交给帧分析工具使用
+                    paths.append(frame_name)
+                    jpeg_bytes.append(VisionAnalysisTools.encode_frame_jpeg(frame))
+                else:
+                    # 保存帧
+                    frame_path = os.path.join(temp_dir, frame_name)
+                    with open(frame_path, 'wb') as f:
+                        f.write(_encode_jpeg(frame, FRAME_FILE_JPEG_QUALITY))
+                    paths.append(frame_path)
                 
-                # 记录帧信息
-                frames_info.append({
-                    "frame_id": frame_count,
-                    "path": frame_path,
-                    "timestamp": timestamp,
-                    "timestamp_formatted": f"{int(timestamp // 60):02d}:{timestamp % 60:06.3f}"
-                })
+                frame_ids.append(frame_count)
+                frame_indices.append(frame_position)
             
             cap.release()
             
-            return {
-                "frames": frames_info,
-                "total_frames_extracted": len(frames_info),
+            # 一次性计算所有帧的时间戳
+            timestamps = np.asarray(frame_indices, dtype=np.float64) / fps
+            
+            result = {
+                "frame_ids": frame_ids,
+                "paths": paths,
+                "timestamps": timestamps.tolist(),
+                "timestamps_formatted": [f"{int(timestamp // 60):02d}:{timestamp % 60:06.3f}" for timestamp in timestamps],
+                "total_frames_extracted": len(frame_ids),
                 "video_duration": duration,
                 "temp_directory": temp_dir
             }
+            if return_encoded:
+                result["jpeg_bytes"] = jpeg_bytes
+            return result
             
         except Exception as e:
             return f"Error extracting frames: {str(e)}"
@@ -170,35 +451,32 @@ class AnalyzeVideoFramesTool(BaseTool):
         if not self._base_url:
             raise ValueError("OPENAI_BASE_URL environment variable is not set")
         
-        # 设置代理（如果需要）
-        proxy_url = os.environ.get('HTTP_PROXY')
-        self._http_client = None
-        if proxy_url:
-            import httpx
-            self._http_client = httpx.Client(proxies={"http://": proxy_url, "https://": proxy_url})
+        # 共用进程内的HTTP连接池
+        self._http_client = _shared_http_client()
         
-        # 初始化OpenAI客户端
+        # 初始化OpenAI客户端（重试由_create_completion_with_retry统一处理，关闭SDK自带的重试）
         self._client = openai.Client(
             api_key=self._api_key, 
             base_url=self._base_url,
-            http_client=self._http_client
+            http_client=self._http_client,
+            max_retries=0
         )
     
-    def _run(self, frame_paths: List[str], batch_size: int = 15) -> dict:
+    def _run(self, frame_paths: List[str], batch_size: int = 15, frames_data: Optional[List[bytes]] = None,
+             timestamps: Optional[List[float]] = None) -> dict:
         """
         分析视频帧内容
         
         参数:
         frame_paths: 帧图像路径列表
         batch_size: 每批处理的最大帧数
+        frames_data: 与frame_paths一一对应的JPEG数据（ExtractVideoFrames的return_encoded模式），提供时不再读取帧文件
+        timestamps: 与frame_paths一一对应的时间戳（ExtractVideoFrames返回的timestamps），提供时不再从文件名解析
         
         返回:
         分析结果
         """
         try:
-            # 使用类变量
-            client = self._client
-            
             # 强制限制批处理大小，确保不超过模型限制
             if batch_size > 15:
                 print(f"警告: 批处理大小 {batch_size} 超过推荐值 15，已自动调整")
@@ -206,102 +484,171 @@ class AnalyzeVideoFramesTool(BaseTool):
             
             # 分批处理帧
             all_frames_analysis = []
+            batches = [frame_paths[start:start + batch_size] for start in range(0, len(frame_paths), batch_size)]
+            data_batches = [frames_data[start:start + batch_size] if frames_data is not None else None
+                            for start in range(0, len(frame_paths), batch_size)]
+            time_batches = [timestamps[start:start + batch_size] if timestamps is not None else None
+                            for start in range(0, len(frame_paths), batch_size)]
             
             # 计算需要处理的批次数
-            num_batches = (len(frame_paths) + batch_size - 1) // batch_size
+            num_batches = len(batches)
             
             print(f"总共需要处理 {len(frame_paths)} 帧，分为 {num_batches} 批")
             
-            for batch_idx in range(num_batches):
-                # 获取当前批次的帧
-                start_idx = batch_idx * batch_size
-                end_idx = min(start_idx + batch_size, len(frame_paths))
-                current_batch = frame_paths[start_idx:end_idx]
-                
-                print(f"处理第 {batch_idx + 1}/{num_batches} 批帧，共 {len(current_batch)} 帧")
-                print(f"当前批次帧范围: {start_idx} 到 {end_idx-1}")
-                
-                # 构建批量请求
-                batch_content = []
-                batch_timestamps = []
-                
-                # 添加提示文本
-                batch_content.append({
-                    "type": "text", 
-                    "text": """分析以下视频帧的内容。对于每一帧，请提供以下信息:
-                    1. 主要内容: 描述帧中的主要对象、人物和活动
-                    2. 视觉特征: 分析构图、光线、颜色和视觉风格
-                    3. 场景类型: 判断这是什么类型的场景（如对话场景、动作场景、过渡场景等）
-                    4. 场景变化: 判断这个场景变化和上一帧相比是否属于同一个场景
-                    
-                    请按顺序分析每一帧，并清晰标明是哪一帧的分析结果。
-                    """
-                })
-                
-                # 添加所有图片
-                for frame_path in current_batch:
-                    # 获取文件名（用于识别）
-                    filename = os.path.basename(frame_path)
-                    
-                    # 提取时间戳（从文件名）
-                    timestamp = None
-                    if "_" in filename and "s.jpg" in filename:
-                        try:
-                            timestamp = float(filename.split("_")[-1].replace("s.jpg", ""))
-                        except:
-                            pass
-                    
-                    batch_timestamps.append({
-                        "path": frame_path,
-                        "filename": filename,
-                        "timestamp": timestamp
-                    })
-                    
-                    # 编码图片
-                    base64_image = VisionAnalysisTools.encode_image(frame_path)
-                    
-                    # 添加到批次内容
-                    batch_content.append({
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-                    })
-                
-                # 发送批量请求
-                print(f"发送批量请求，包含 {len(current_batch)} 张图片")
-                
-                response = client.chat.completions.create(
-                    model="gemini-1.5-flash",
-                    messages=[
-                        {"role": "system", "content": "你是一名专业的视频分析师，擅长分析视频帧内容。请为每一帧提供详细分析，并清晰标明是哪一帧的分析结果。输出结果必须是一个标准的JSON字符串，可以直接使用JSON.parse来解析成json格式。使用json代码块包裹"},
-                        {"role": "user", "content": batch_content}
-                    ],
-                    max_tokens=4000,
-                    temperature=0.1
+            # 各批次相互独立，并发发送请求；map按批次顺序返回结果
+            with ThreadPoolExecutor(max_workers=max(1, min(VISION_MAX_CONCURRENCY, num_batches))) as executor:
+                batch_results = executor.map(
+                    lambda batch_idx: self._analyze_batch(batch_idx, num_batches, batch_size, batches[batch_idx],
+                                                          data_batches[batch_idx], time_batches[batch_idx]),
+                    range(num_batches)
                 )
-                
-                # 解析批量响应
-                batch_response = response.choices[0].message.content
-                
-                # 尝试将响应分配给各个帧
-                frame_analyses = self._parse_batch_response(batch_response, batch_timestamps)
-                
-                # 将当前批次的分析结果添加到总结果中
-                all_frames_analysis.extend(frame_analyses)
-                
-                # 打印当前批次处理完成信息
-                print(f"批次 {batch_idx + 1}/{num_batches} 处理完成，已分析 {len(all_frames_analysis)}/{len(frame_paths)} 帧")
+                for batch_idx, frame_analyses in enumerate(batch_results):
+                    # 将当前批次的分析结果添加到总结果中
+                    all_frames_analysis.extend(frame_analyses)
+                    
+                    # 打印当前批次处理完成信息
+                    print(f"批次 {batch_idx + 1}/{num_batches} 处理完成，已分析 {len(all_frames_analysis)}/{len(frame_paths)} 帧")
             
             return {
                 "frames_analysis": all_frames_analysis,
                 "total_frames_analyzed": len(all_frames_analysis),
                 "batches_processed": num_batches
             }
-            
+        
         except Exception as e:
             import traceback
             error_details = traceback.format_exc()
             return f"Error analyzing frames: {str(e)}\n\nDetails:\n{error_details}"
     
+    def _analyze_batch(self, batch_idx: int, num_batches: int, batch_size: int, current_batch: List[str],
+                       batch_data: Optional[List[bytes]] = None,
+                       batch_times: Optional[List[float]] = None) -> List[Dict]:
+        """
+        分析一批帧
+        
+        参数:
+        batch_idx: 批次序号（从0开始）
+        num_batches: 总批次数
+        batch_size: 每批处理的最大帧数
+        current_batch: 当前批次的帧图像路径
+        batch_data: 当前批次已编码的JPEG数据，为None时从帧文件读取
+        batch_times: 当前批次各帧的时间戳，为None时从帧文件名解析
+        
+        返回:
+        当前批次各帧的分析结果列表
+        """
+        start_idx = batch_idx * batch_size
+        end_idx = start_idx + len(current_batch)
+        
+        print(f"处理第 {batch_idx + 1}/{num_batches} 批帧，共 {len(current_batch)} 帧")
+        print(f"当前批次帧范围: {start_idx} 到 {end_idx-1}")
+        
+        # 构建批量请求
+        batch_content = []
+        batch_timestamps = []
+        
+        # 添加提示文本
+        batch_content.append({
+            "type": "text", 
+            "text": """分析以下视频帧的内容。对于每一帧，请提供以下信息:
+            1. 主要内容: 描述帧中的主要对象、人物和活动
+            2. 视觉特征: 分析构图、光线、颜色和视觉风格
+            3. 场景类型: 判断这是什么类型的场景（如对话场景、动作场景、过渡场景等）
+            4. 场景变化: 判断这个场景变化和上一帧相比是否属于同一个场景
+            
+            帧序号按图片顺序从1开始。以JSON对象返回，格式如下:
+            {"frames": [{"index": 帧序号, "content": "主要内容", "features": "视觉特征", "scene_type": "场景类型", "scene_change": "场景变化"}]}
+            """
+        })
+        
+        # 添加所有图片
+        for frame_idx, frame_path in enumerate(current_batch):
+            # 获取文件名（用于识别）
+            filename = os.path.basename(frame_path)
+            
+            # 提取时间戳（未提供时从文件名解析）
+            if batch_times is not None:
+                timestamp = batch_times[frame_idx]
+            else:
+                match = _FRAME_TIMESTAMP_PATTERN.search(filename)
+                timestamp = float(match.group(1)) if match else None
+            
+            batch_timestamps.append({
+                "path": frame_path,
+                "filename": filename,
+                "timestamp": timestamp
+            })
+            
+            # 缩小并编码图片；已有编码数据时直接使用
+            if batch_data is not None:
+                base64_image = base64.b64encode(batch_data[frame_idx]).decode('ascii')
+            else:
+                base64_image = VisionAnalysisTools.prepare_vision_payload(frame_path)
+            
+            # 添加到批次内容
+            batch_content.append({
+                "type": "image_url",
+                "image_url": {"url": f"data:image/jpeg;base64,{base64_image}", "detail": VISION_IMAGE_DETAIL}
+            })
+        
+        # 发送批量请求
+        print(f"发送批量请求，包含 {len(current_batch)} 张图片")
+        
+        response = _create_completion_with_retry(
+            self._client,
+            model="gemini-1.5-flash",
+            messages=[
+                {"role": "system", "content": "你是一名专业的视频分析师，擅长分析视频帧内容。请为每一帧提供详细分析，用index标明帧序号。只输出JSON对象，不要输出其他内容。"},
+                {"role": "user", "content": batch_content}
+            ],
+            max_tokens=4000,
+            temperature=0.1,
+            response_format={"type": "json_object"}
+        )
+        
+        # 解析批量响应
+        batch_response = response.choices[0].message.content
+        
+        # 按帧序号将结构化结果分配给各个帧
+        frame_analyses = self._parse_structured_response(batch_response, batch_timestamps)
+        if frame_analyses is not None:
+            return frame_analyses
+        
+        # 模型没有返回有效JSON时，按文本标记分割响应
+        return self._parse_batch_response(batch_response, batch_timestamps)
+    
+    def _parse_structured_response(self, batch_response: str, batch_timestamps: List[Dict]) -> Optional[List[Dict]]:
+        """
+        解析JSON格式的批量响应，按帧序号分配给各个帧
+        
+        参数:
+        batch_response: 模型返回的JSON文本，格式为 {"frames": [{"index": 帧序号, ...}]}
+        batch_timestamps: 批次中各帧的时间戳信息
+        
+        返回:
+        各帧的分析结果列表，响应不是预期的JSON格式时返回None
+        """
+        parsed = _loads_json_response(batch_response)
+        if not isinstance(parsed, dict) or not isinstance(parsed.get("frames"), list):
+            return None
+        
+        analysis_by_index = {}
+        for frame in parsed["frames"]:
+            if isinstance(frame, dict) and isinstance(frame.get("index"), int):
+                analysis_by_index[frame["index"]] = frame
+        
+        frame_analyses = []
+        for i, frame_info in enumerate(batch_timestamps):
+            frame_analysis = {
+                "frame_path": frame_info["path"],
+                "timestamp": frame_info["timestamp"],
+                "analysis": analysis_by_index.get(i + 1)
+            }
+            if frame_analysis["analysis"] is None:
+                frame_analysis["warning"] = "模型未返回该帧的分析"
+            frame_analyses.append(frame_analysis)
+        return frame_analyses
+    
     def _parse_batch_response(self, batch_response: str, batch_timestamps: List[Dict]) -> List[Dict]:
         """
         解析批量响应，将其分配给各个帧
@@ -319,35 +666,24 @@ class AnalyzeVideoFramesTool(BaseTool):
             # 尝试通过帧号或时间戳标记来分割响应
             # 这是一个简单的实现，可能需要根据实际响应格式进行调整
             
-            # 首先尝试查找"帧1"、"帧2"等标记
-            frame_markers = []
-            for i in range(1, len(batch_timestamps) + 1):
-                markers = [
-                    f"帧 {i}",
-                    f"帧{i}",
-                    f"Frame {i}",
-                    f"Frame{i}",
-                    f"图片 {i}",
-                    f"图片{i}",
-                    f"Image {i}",
-                    f"Image{i}"
-                ]
-                for marker in markers:
-                    if marker in batch_response:
-                        frame_markers.append((i-1, marker, batch_response.find(marker)))
+            # 首先一次扫描查找"帧1"、"帧2"等标记，每帧取第一次出现的位置
+            first_positions = {}
+            for match in _FRAME_MARKER_PATTERN.finditer(batch_response):
+                frame_idx = int(match.group(1)) - 1
+                if 0 <= frame_idx < len(batch_timestamps) and frame_idx not in first_positions:
+                    first_positions[frame_idx] = match.start()
             
             # 按照在响应中的位置排序标记
-            frame_markers.sort(key=lambda x: x[2])
+            frame_markers = sorted(first_positions.items(), key=lambda x: x[1])
             
             # 如果找到了足够的标记，按标记分割响应
             if len(frame_markers) >= len(batch_timestamps):
                 for i in range(len(frame_markers)):
-                    frame_idx = frame_markers[i][0]
-                    start_pos = frame_markers[i][2]
+                    frame_idx, start_pos = frame_markers[i]
                     
                     # 确定结束位置
                     if i < len(frame_markers) - 1:
-                        end_pos = frame_markers[i+1][2]
+                        end_pos = frame_markers[i+1][1]
                     else:
                         end_pos = len(batch_response)
                     
@@ -380,14 +716,6 @@ class AnalyzeVideoFramesTool(BaseTool):
                         "analysis": analysis_text,
                         "warning": "自动分割响应，可能不准确"
                     })
-                
-                # 同时保存完整响应，以便手动检查
-                frame_analyses.append({
-                    "frame_path": "batch_complete_response",
-                    "timestamp": None,
-                    "analysis": batch_response,
-                    "is_complete_response": True
-                })
         
         except Exception as e:
             print(f"解析批量响应时出错: {str(e)}")
@@ -406,6 +734,7 @@ class AnalyzeVideoFramesTool(BaseTool):
 class BatchProcessingFramesTool(BaseTool):
     name: str = "BatchProcessingFrames"
     description: str = "从视频中提取帧并批量处理分析"
+    use_gpu_decode: bool = Field(default=False, description="是否使用NVDEC在GPU上解码并缩放帧（需要ffmpegcv和NVIDIA GPU，不可用时使用CPU解码）")
     
     def __init__(self):
         super().__init__()
@@ -418,18 +747,15 @@ class BatchProcessingFramesTool(BaseTool):
         if not self._base_url:
             raise ValueError("OPENAI_BASE_URL environment variable is not set")
         
-        # 设置代理（如果需要）
-        proxy_url = os.environ.get('HTTP_PROXY')
-        self._http_client = None
-        if proxy_url:
-            import httpx
-            self._http_client = httpx.Client(proxies={"http://": proxy_url, "https://": proxy_url})
+        # 共用进程内的HTTP连接池
+        self._http_client = _shared_http_client()
         
-        # 初始化OpenAI客户端
+        # 初始化OpenAI客户端（重试由_create_completion_with_retry统一处理，关闭SDK自带的重试）
         self._client = openai.Client(
             api_key=self._api_key, 
             base_url=self._base_url,
-            http_client=self._http_client
+            http_client=self._http_client,
+            max_retries=0
         )
         
         # 创建输出目录
@@ -478,48 +804,54 @@ class BatchProcessingFramesTool(BaseTool):
             
             print(f"将提取 {actual_frames} 帧，采样间隔: {step}")
             
-            # 提取帧
-            frames = []
-            frame_times = []
-            
-            for i in range(0, total_frames, step):
-                cap.set(cv2.CAP_PROP_POS_FRAMES, i)
-                ret, frame = cap.read()
-                if not ret:
-                    print(f"警告: 无法读取帧 {i}")
-                    continue
-                
-                # 转换为RGB（OpenCV使用BGR）
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                frames.append(frame_rgb)
-                
-                # 记录时间点
-                time_sec = i / fps if fps > 0 else 0
-                frame_times.append(time_sec)
-
-                if len(frames) >= max_frames:
-                    break
+            frame_positions = list(range(0, total_frames, step))[:max_frames]
+            num_batches = (len(frame_positions) + batch_size - 1) // batch_size
             
-            cap.release()
+            # 可选：在GPU上解码并缩放，CPU只负责JPEG编码
+            sampled_frames = None
+            if self.use_gpu_decode:
+                nv_cap = _open_capture_nv(video_path, int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                                          int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+                if nv_cap is not None:
+                    cap.release()
+                    cap = nv_cap
+                    sampled_frames = _iter_sampled_frames_nv(cap, frame_positions)
+            if sampled_frames is None:
+                sampled_frames = _iter_sampled_frames(cap, frame_positions)
             
-            print(f"成功提取 {len(frames)} 帧")
+            # 后台线程解码并编码帧，每凑满一批放入队列；主线程同时把已就绪的批次并发发给模型，
+            # 解码与API请求重叠进行，并发数由线程池大小限制
+            batch_queue = queue.Queue(maxsize=FRAME_PREFETCH_BATCHES)
+            producer = threading.Thread(
+                target=self._produce_batches,
+                args=(cap, sampled_frames, frame_positions, fps, batch_size, batch_queue),
+                daemon=True
+            )
+            producer.start()
             
-            # 批量处理
             all_results = []
-            
-            for batch_start in range(0, len(frames), batch_size):
-                batch_end = min(batch_start + batch_size, len(frames))
-                batch_frames = frames[batch_start:batch_end]
-                batch_times = frame_times[batch_start:batch_end]
-                
-                print(f"处理批次 {batch_start//batch_size + 1}/{(len(frames)-1)//batch_size + 1}, 帧 {batch_start}-{batch_end-1}")
+            frames_count = 0
+            with ThreadPoolExecutor(max_workers=max(1, min(VISION_MAX_CONCURRENCY, num_batches))) as executor:
+                futures = []
+                while True:
+                    item = batch_queue.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    
+                    batch_images, batch_times = item
+                    print(f"处理批次 {len(futures) + 1}/{num_batches}, 帧 {frames_count}-{frames_count + len(batch_images) - 1}")
+                    frames_count += len(batch_images)
+                    
+                    # 使用OpenAI分析批次
+                    futures.append(executor.submit(self._analyze_batch, batch_images, batch_times))
                 
-                # 使用OpenAI分析批次
-                batch_results = self._analyze_batch(batch_frames, batch_times)
-                all_results.extend(batch_results)
+                print(f"成功提取 {frames_count} 帧")
                 
-                # 短暂暂停，避免API限制
-                time.sleep(1)
+                # 按批次顺序收集结果
+                for future in futures:
+                    all_results.extend(future.result())
             
             # 保存结果到文件
             result_file = os.path.join(self._output_dir, f"frames_analysis_{Path(video_path).stem}_{int(time.time())}.json")
@@ -527,21 +859,22 @@ class BatchProcessingFramesTool(BaseTool):
             # 确保目录存在
             os.makedirs(os.path.dirname(result_file), exist_ok=True)
             
-            with open(result_file, 'w', encoding='utf-8') as f:
-                json.dump({
+            # 同步写入：返回的路径会交给其他工具和智能体读取，必须在返回前写完
+            with open(result_file, 'wb') as f:
+                f.write(orjson.dumps({
                     "video_path": video_path,
                     "total_frames": total_frames,
                     "fps": fps,
                     "duration": duration,
-                    "frames_analyzed": len(frames),
+                    "frames_analyzed": frames_count,
                     "frames_results": all_results
-                }, f, ensure_ascii=False, indent=2)
+                }, option=orjson.OPT_INDENT_2))
             
             print(f"分析结果已保存到: {result_file}")
             
             return {
                 "status": "success",
-                "frames_count": len(frames),
+                "frames_count": frames_count,
                 "result_file": result_file
             }
         except Exception as e:
@@ -554,12 +887,12 @@ class BatchProcessingFramesTool(BaseTool):
                 # 确保目录存在
                 os.makedirs(os.path.dirname(error_result_file), exist_ok=True)
                 
-                with open(error_result_file, 'w', encoding='utf-8') as f:
-                    json.dump({
+                with open(error_result_file, 'wb') as f:
+                    f.write(orjson.dumps({
                         "video_path": video_path,
                         "error": str(e),
                         "frames_results": []
-                    }, f, ensure_ascii=False, indent=2)
+                    }, option=orjson.OPT_INDENT_2))
                 
                 print(f"错误信息已保存到: {error_result_file}")
                 
@@ -572,8 +905,43 @@ class BatchProcessingFramesTool(BaseTool):
                 print(f"保存错误信息时出错: {str(save_error)}")
                 raise e
     
-    def _analyze_batch(self, frames: List[Any], times: List[float]) -> List[Dict[str, Any]]:
-        """分析一批帧"""
+    @staticmethod
+    def _produce_batches(cap, sampled_frames, frame_positions: List[int], fps: float, batch_size: int,
+                         batch_queue: queue.Queue):
+        """
+        后台解码线程：顺序解码采样帧并编码为JPEG，每凑满一批放入队列
+        
+        sampled_frames 为 _iter_sampled_frames 或 _iter_sampled_frames_nv 返回的生成器，结束后释放cap
+        
+        队列中的元素为 (JPEG数据列表, 时间点列表)；出错时放入异常对象，结束时放入None
+        """
+        try:
+            # 一次性计算所有采样位置的时间点
+            frame_times = np.asarray(frame_positions, dtype=np.float64) / fps if fps > 0 else np.zeros(len(frame_positions))
+            
+            images = []
+            times = []
+            for sample_idx, _, frame in sampled_frames:
+                # 解码后立即缩小并编码为JPEG，不保留原始分辨率的帧；保持BGR，由OpenCV直接编码
+                images.append(VisionAnalysisTools.encode_frame_jpeg(frame))
+                
+                # 记录时间点
+                times.append(float(frame_times[sample_idx]))
+                
+                if len(images) == batch_size:
+                    batch_queue.put((images, times))
+                    images = []
+                    times = []
+            if images:
+                batch_queue.put((images, times))
+        except Exception as e:
+            batch_queue.put(e)
+        finally:
+            cap.release()
+            batch_queue.put(None)
+    
+    def _analyze_batch(self, images: List[bytes], times: List[float]) -> List[Dict[str, Any]]:
+        """分析一批帧（images为已编码的JPEG数据）"""
         results = []
         
         try:
@@ -589,47 +957,32 @@ class BatchProcessingFramesTool(BaseTool):
             8. 画面中的文字和字幕信息
             9. 画面中的品牌信息（如果有）
             
-            以JSON格式返回，每帧一个对象，包裹在json代码块中，不要任何多余信息，否则无法解析。"""
+            以JSON对象返回，格式为 {"frames": [每帧一个对象，按图片顺序排列]}，不要任何多余信息，否则无法解析。"""
             
             # 准备消息内容
             content = [{"type": "text", "text": prompt}]
             
             # 添加图像
-            for frame in frames:
-                # 将numpy数组转换为PIL图像
-                pil_image = Image.fromarray(frame)
-                
-                # 调整图像大小，避免过大
-                max_size = 1024
-                if pil_image.width > max_size or pil_image.height > max_size:
-                    ratio = min(max_size / pil_image.width, max_size / pil_image.height)
-                    new_width = int(pil_image.width * ratio)
-                    new_height = int(pil_image.height * ratio)
-                    pil_image = pil_image.resize((new_width, new_height))
-                
-                # 将PIL图像转换为字节流
-                buffer = io.BytesIO()
-                pil_image.save(buffer, format="JPEG")
-                image_bytes = buffer.getvalue()
-                
-                # 编码为base64
-                base64_image = base64.b64encode(image_bytes).decode('utf-8')
+            for image_bytes in images:
+                base64_image = base64.b64encode(image_bytes).decode('ascii')
                 
                 # 添加到内容
                 content.append({
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
+                    "image_url": {"url": f"data:image/jpeg;base64,{base64_image}", "detail": VISION_IMAGE_DETAIL}
                 })
             
             # 发送请求到OpenAI
-            response = self._client.chat.completions.create(
+            response = _create_completion_with_retry(
+                self._client,
                 model="gemini-1.5-flash",  # 或使用其他支持视觉的模型
                 messages=[
-                    {"role": "system", "content": "你是一名专业的视频分析师，擅长分析视频帧内容。请以JSON格式返回分析结果。请务必输出json格式，不要输出其他格式，包裹在json代码块中。不要任何多余信息，否则无法解析。"},
+                    {"role": "system", "content": "你是一名专业的视频分析师，擅长分析视频帧内容。请以JSON格式返回分析结果。只输出JSON对象，不要任何多余信息，否则无法解析。"},
                     {"role": "user", "content": content}
                 ],
                 max_tokens=4000,
-                temperature=0.1
+                temperature=0.1,
+                response_format={"type": "json_object"}
             )
             
             # 解析响应
@@ -637,64 +990,10 @@ class BatchProcessingFramesTool(BaseTool):
                 # 获取响应文本
                 content = response.choices[0].message.content
                 
-                # 尝试多种方式提取和解析JSON
-                parsed_results = None
-                
-                # 方法1: 查找JSON代码块
-                import re
-                json_patterns = [
-                    r'```json\n(.*?)\n```',  # 标准markdown JSON块
-                    r'```\n(.*?)\n```',       # 无类型markdown代码块
-                    r'```(.*?)```',           # 无换行的markdown代码块
-                    r'{[\s\S]*}',             # 查找最外层的大括号内容
-                    r'\[[\s\S]*\]'            # 查找最外层的方括号内容
-                ]
-                
-                for pattern in json_patterns:
-                    json_match = re.search(pattern, content, re.DOTALL)
-                    if json_match:
-                        try:
-                            # 检查匹配组的数量
-                            if len(json_match.groups()) > 0:
-                                json_str = json_match.group(1)
-                            else:
-                                # 如果没有捕获组，使用整个匹配
-                                json_str = json_match.group(0)
-                            
-                            parsed_results = json.loads(json_str)
-                            print(f"成功使用模式 '{pattern}' 解析JSON")
-                            break
-                        except (json.JSONDecodeError, IndexError) as e:
-                            print(f"使用模式 '{pattern}' 解析JSON失败: {str(e)}")
-                            continue
-                
-                # 方法2: 尝试直接解析整个内容
-                if parsed_results is None:
-                    try:
-                        parsed_results = json.loads(content)
-                        print("成功直接解析整个内容为JSON")
-                    except json.JSONDecodeError:
-                        pass
-                
-                # 方法3: 尝试修复并解析可能被截断的JSON
-                if parsed_results is None:
-                    try:
-                        # 尝试修复常见的JSON截断问题
-                        fixed_content = content
-                        # 如果以逗号结尾，移除它
-                        fixed_content = re.sub(r',\s*$', '', fixed_content)
-                        # 如果缺少结束括号，添加它们
-                        if fixed_content.count('[') > fixed_content.count(']'):
-                            fixed_content += ']' * (fixed_content.count('[') - fixed_content.count(']'))
-                        if fixed_content.count('{') > fixed_content.count('}'):
-                            fixed_content += '}' * (fixed_content.count('{') - fixed_content.count('}'))
-                        
-                        parsed_results = json.loads(fixed_content)
-                        print("成功通过修复JSON格式解析内容")
-                    except json.JSONDecodeError:
-                        pass
+                # 解析JSON（JSON输出模式下通常可以直接解析）
+                parsed_results = _loads_json_response(content)
                 
-                # 如果所有方法都失败，记录详细错误并创建简单结果
+                # 如果无法解析，记录详细错误并创建简单结果
                 if parsed_results is None:
                     print(f"无法解析JSON响应，将创建简单结果")
                     print(f"原始响应内容: {content[:]}...")
@@ -1,15 +1,66 @@
 # utils/helpers.py
 import os
 import json
+import orjson
 import cv2
+import atexit
+import queue
+import threading
+from pathlib import Path
+
+# 后台写文件队列容量，队列满时写入方阻塞等待
+WRITE_QUEUE_SIZE = 8
+
+_WRITE_Q = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+_writer_lock = threading.Lock()
+_writer_thread = None
+# 后台写入失败的异常，由wait_for_pending_writes抛给调用方
+_write_errors = []
+
+def _writer_loop():
+    """后台线程：依次把队列中的数据写入文件"""
+    while True:
+        path, data = _WRITE_Q.get()
+        try:
+            Path(path).write_bytes(data)
+        except Exception as e:
+            print(f"后台写入文件 {path} 失败: {str(e)}")
+            _write_errors.append(e)
+        finally:
+            _WRITE_Q.task_done()
+
+def write_bytes_async(path, data):
+    """
+    将字节数据交给后台线程写入文件，调用方无需等待磁盘写入完成
+    
+    参数:
+    path: 输出文件路径
+    data: 要写入的字节数据
+    """
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_writer_loop, name="file-writer", daemon=True)
+            _writer_thread.start()
+            # 进程退出前等待队列中的文件全部写完
+            atexit.register(_WRITE_Q.join)
+    _WRITE_Q.put((path, data))
+
+def wait_for_pending_writes():
+    """阻塞直到所有已提交的后台写入完成，读取这些文件之前调用；有写入失败时抛出其中第一个异常"""
+    _WRITE_Q.join()
+    if _write_errors:
+        errors = _write_errors[:]
+        del _write_errors[:len(errors)]
+        raise errors[0]
 
 def save_metadata(metadata, filepath):
-    """将元数据保存为 JSON 文件"""
-    with open(filepath, 'w') as f:
-        json.dump(metadata, f, indent=2)
+    """将元数据保存为 JSON 文件（后台写入）"""
+    write_bytes_async(filepath, orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
 
 def load_metadata(filepath):
     """从 JSON 文件加载元数据"""
+    wait_for_pending_writes()
     with open(filepath, 'r') as f:
         return json.load(f)
 
@@ -3,16 +3,57 @@
 
 import os
 import json
+import orjson
+import shutil
 import subprocess
 import argparse
+import itertools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 from services.whisper_transcription import WhisperTranscriptionService
 
+try:
+    # 可选依赖：ijson 流式解析JSON索引，不必把全部历史片段读入内存
+    import ijson
+except ImportError:
+    ijson = None
+
+# 同时运行的ffmpeg切片进程数（流复制切片以I/O为主）
+CUT_MAX_WORKERS = min(16, os.cpu_count() or 4)
+
+# 单个ffmpeg进程最多输出的片段数（每个输出占用一个打开的文件）
+SEGMENTS_PER_FFMPEG = 32
+
+# 追加片段日志（JSONL）的写缓冲大小
+JSONL_BUFFER_SIZE = 1 << 16
+
+# ffmpeg可执行文件的绝对路径：subprocess只有在可执行文件带目录时才走posix_spawn，
+# 不会为每次切片fork已加载Whisper模型的整个进程
+FFMPEG_BINARY = shutil.which('ffmpeg') or 'ffmpeg'
+
+# 每个ffmpeg切片进程的线程数范围，默认按CPU核数平分给切片线程池
+FFMPEG_THREADS_RANGE = (1, 64)
+
+# 转录最多领先切片的视频数
+TRANSCRIBE_AHEAD = 2
+
+# 支持的视频文件扩展名
+VIDEO_EXTENSIONS = frozenset({'.mp4', '.avi', '.mov', '.mkv', '.flv', '.wmv'})
+
+def _parse_ffmpeg_threads(value: str) -> int:
+    """解析并校验ffmpeg线程数"""
+    threads = int(value)
+    if not FFMPEG_THREADS_RANGE[0] <= threads <= FFMPEG_THREADS_RANGE[1]:
+        raise ValueError(f"ffmpeg线程数必须在 {FFMPEG_THREADS_RANGE[0]} 到 {FFMPEG_THREADS_RANGE[1]} 之间: {value}")
+    return threads
+
 class VideoProcessor:
     """视频处理器：提取音频、转录和切片视频"""
     
-    def __init__(self, input_dir: str, output_dir: str, json_file: str):
+    def __init__(self, input_dir: str, output_dir: str, json_file: str, ffmpeg_threads: Optional[int] = None):
         """
         初始化视频处理器
         
@@ -20,11 +61,18 @@ class VideoProcessor:
         input_dir: 输入视频目录
         output_dir: 输出切片目录
         json_file: 输出JSON文件路径
+        ffmpeg_threads: 每个ffmpeg切片进程的线程数，未指定时读取环境变量VP_FFMPEG_THREADS，
+                        仍未设置则按CPU核数平分，避免切片线程池与ffmpeg内部线程叠加导致过度订阅
         """
         self.input_dir = Path(input_dir)
         self.output_dir = Path(output_dir)
         self.json_file = Path(json_file)
+        if ffmpeg_threads is None and os.environ.get('VP_FFMPEG_THREADS'):
+            ffmpeg_threads = _parse_ffmpeg_threads(os.environ['VP_FFMPEG_THREADS'])
+        self.ffmpeg_threads = ffmpeg_threads or max(1, (os.cpu_count() or CUT_MAX_WORKERS) // CUT_MAX_WORKERS)
         self.transcription_service = WhisperTranscriptionService()
+        # 并发切片时保护已处理路径集合及JSONL/JSON文件写入
+        self._json_lock = threading.Lock()
         
         # 确保输出目录存在
         self.output_dir.mkdir(parents=True, exist_ok=True)
@@ -32,21 +80,55 @@ class VideoProcessor:
         # 确保JSON文件所在目录存在
         self.json_file.parent.mkdir(parents=True, exist_ok=True)
         
-        # 初始化或加载JSON数据
-        if self.json_file.exists():
-            with open(self.json_file, 'r', encoding='utf-8') as f:
-                self.json_data = json.load(f)
+        # 处理过程中新片段只追加到JSONL，finalize时再与JSON中的历史片段合并；
+        # 上次运行中断时JSONL中残留的片段同样在finalize时合并
+        self.jsonl_file = self.json_file.with_suffix('.jsonl')
+        
+        # 已处理视频的路径集合：只保留路径，不在内存中保留全部历史片段
+        self._processed_paths = set(self._iter_saved_video_paths())
+        self._processed_paths.update(item.get('video_path') for item in self._iter_pending_segments())
+        # JSONL写入句柄在第一次追加片段时打开，finalize时关闭
+        self._jsonl = None
+    
+    def _iter_saved_video_paths(self):
+        """逐个返回JSON文件中已保存片段的视频路径"""
+        if not self.json_file.exists():
+            return
+        if ijson is not None:
+            with open(self.json_file, 'rb') as f:
+                yield from ijson.items(f, 'item.video_path')
         else:
-            self.json_data = []
+            for item in self._iter_saved_segments():
+                yield item.get('video_path')
+    
+    def _iter_saved_segments(self):
+        """逐个返回JSON文件中已保存的片段，有ijson时流式解析"""
+        if not self.json_file.exists():
+            return
+        with open(self.json_file, 'rb') as f:
+            if ijson is not None:
+                yield from ijson.items(f, 'item', use_float=True)
+            else:
+                yield from json.load(f)
+    
+    def _iter_pending_segments(self):
+        """逐个返回JSONL中尚未合并到JSON文件的片段"""
+        if not self.jsonl_file.exists():
+            return
+        with open(self.jsonl_file, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
     
     def get_video_files(self) -> List[Path]:
         """获取输入目录中的所有视频文件"""
-        video_extensions = ['.mp4', '.avi', '.mov', '.mkv', '.flv', '.wmv']
         video_files = []
         
-        for file in self.input_dir.iterdir():
-            if file.is_file() and file.suffix.lower() in video_extensions:
-                video_files.append(file)
+        # scandir返回的目录项自带文件类型，除符号链接外不需要逐个stat
+        with os.scandir(self.input_dir) as entries:
+            for entry in entries:
+                if os.path.splitext(entry.name)[1].lower() in VIDEO_EXTENSIONS and entry.is_file():
+                    video_files.append(Path(entry.path))
         
         return video_files
     
@@ -57,13 +139,30 @@ class VideoProcessor:
         参数:
         video_path: 视频文件路径
         """
+        try:
+            segments = self._transcribe_video(video_path)
+            if segments:
+                self._cut_segments(video_path, segments)
+        finally:
+            # 单独处理一个视频时同样把新片段合并写入JSON文件
+            self.finalize()
+    
+    def _transcribe_video(self, video_path: Path) -> Optional[List[Any]]:
+        """
+        转录单个视频
+        
+        参数:
+        video_path: 视频文件路径
+        
+        返回:
+        转录片段列表，视频已处理过、没有可转录内容或出错时返回None
+        """
         print(f"\n正在处理视频: {video_path.name}")
         
         # 检查是否已经处理过该视频
-        video_abs_path = str(video_path.absolute())
-        if any(item.get('video_path') == video_abs_path for item in self.json_data):
+        if str(video_path.absolute()) in self._processed_paths:
             print(f"视频 {video_path.name} 已经处理过，跳过")
-            return
+            return None
         
         try:
             # 转录视频
@@ -73,93 +172,179 @@ class VideoProcessor:
             segments = transcription.get('segments', [])
             if not segments:
                 print(f"视频 {video_path.name} 没有可转录的内容，跳过")
-                return
+                return None
             
-            # 为每个片段创建切片并保存信息
-            for i, segment in enumerate(segments):
-                # 处理不同格式的segment对象
-                if isinstance(segment, dict):
-                    segment_id = segment.get('id', i)
-                    start_time = segment.get('start', 0)
-                    end_time = segment.get('end', 0)
-                    text = segment.get('text', '')
-                else:
-                    # 如果segment不是字典，尝试访问其属性
-                    try:
-                        segment_id = getattr(segment, 'id', i)
-                        start_time = getattr(segment, 'start', 0)
-                        end_time = getattr(segment, 'end', 0)
-                        text = getattr(segment, 'text', '')
-                    except Exception as e:
-                        print(f"无法处理片段 {i}: {str(e)}")
-                        continue
-                
-                if not text or not isinstance(text, str) or not text.strip():
-                    continue
-                
-                # 创建切片文件名
-                output_filename = f"{video_path.stem}_segment_{segment_id}{video_path.suffix}"
-                output_path = self.output_dir / output_filename
-                
-                # 使用ffmpeg切片视频
-                self._cut_video(video_path, output_path, start_time, end_time)
-                
-                # 保存信息到JSON
-                segment_info = {
-                    'id': segment_id,
-                    'text': text,
-                    'start_time': start_time,
-                    'end_time': end_time,
-                    'video_path': str(video_path.absolute()),
-                    'segment_path': str(output_path.absolute())
-                }
-                
-                self.json_data.append(segment_info)
-                
-                # 每处理一个片段就保存一次JSON，防止中途出错丢失数据
-                self._save_json()
+            return segments
+            
+        except Exception as e:
+            print(f"处理视频 {video_path.name} 时出错: {str(e)}")
+            return None
+    
+    def _cut_segments(self, video_path: Path, segments: List[Any]) -> None:
+        """
+        按转录片段切片视频并记录片段信息
+        
+        参数:
+        video_path: 视频文件路径
+        segments: 转录片段列表
+        """
+        video_abs_path = str(video_path.absolute())
+        
+        try:
+            # 解析片段，跳过无文本的片段；按开始时间排序使每组覆盖连续的时间范围
+            segment_infos = [info for info in (self._segment_info(video_path, segment, i)
+                                               for i, segment in enumerate(segments))
+                             if info is not None]
+            segment_infos.sort(key=lambda info: info['start_time'])
+            
+            # 一个ffmpeg进程切出一组片段，各组并发执行
+            group_size = max(1, min(SEGMENTS_PER_FFMPEG, -(-len(segment_infos) // CUT_MAX_WORKERS)))
+            groups = [segment_infos[start:start + group_size] for start in range(0, len(segment_infos), group_size)]
+            
+            with ThreadPoolExecutor(max_workers=CUT_MAX_WORKERS) as executor:
+                futures = {executor.submit(self._cut_video, video_path, group): group for group in groups}
                 
-                print(f"已处理片段 {segment_id}: {text[:30]}...")
+                for future in as_completed(futures):
+                    future.result()
+                    
+                    with self._json_lock:
+                        self._processed_paths.add(video_abs_path)
+                        
+                        # 每切完一组片段就追加到JSONL，防止中途出错丢失数据
+                        if self._jsonl is None:
+                            self._jsonl = open(self.jsonl_file, 'ab', buffering=JSONL_BUFFER_SIZE)
+                        self._jsonl.write(b"".join(orjson.dumps(info) + b"\n" for info in futures[future]))
+                        self._jsonl.flush()
+                    
+                    for segment_info in futures[future]:
+                        print(f"已处理片段 {segment_info['id']}: {segment_info['text'][:30]}...")
             
             print(f"视频 {video_path.name} 处理完成")
             
         except Exception as e:
             print(f"处理视频 {video_path.name} 时出错: {str(e)}")
     
-    def _cut_video(self, input_path: Path, output_path: Path, start_time: float, end_time: float) -> None:
+    def _segment_info(self, video_path: Path, segment: Any, i: int) -> Optional[Dict[str, Any]]:
         """
-        使用ffmpeg切片视频
+        解析单个转录片段并确定其切片路径
         
         参数:
-        input_path: 输入视频路径
-        output_path: 输出视频路径
-        start_time: 开始时间（秒）
-        end_time: 结束时间（秒）
+        video_path: 视频文件路径
+        segment: 转录片段（字典或带属性的对象）
+        i: 片段序号
+        
+        返回:
+        片段信息字典，片段无文本或无法解析时返回None
+        """
+        # 处理不同格式的segment对象
+        if isinstance(segment, dict):
+            segment_id = segment.get('id', i)
+            start_time = segment.get('start', 0)
+            end_time = segment.get('end', 0)
+            text = segment.get('text', '')
+        else:
+            # 如果segment不是字典，尝试访问其属性
+            try:
+                segment_id = getattr(segment, 'id', i)
+                start_time = getattr(segment, 'start', 0)
+                end_time = getattr(segment, 'end', 0)
+                text = getattr(segment, 'text', '')
+            except Exception as e:
+                print(f"无法处理片段 {i}: {str(e)}")
+                return None
+        
+        if not text or not isinstance(text, str) or not text.strip():
+            return None
+        
+        # 创建切片文件名
+        output_filename = f"{video_path.stem}_segment_{segment_id}{video_path.suffix}"
+        output_path = self.output_dir / output_filename
+        
+        return {
+            'id': segment_id,
+            'text': text,
+            'start_time': start_time,
+            'end_time': end_time,
+            'video_path': str(video_path.absolute()),
+            'segment_path': str(output_path.absolute())
+        }
+    
+    def _cut_video(self, input_path: Path, segment_infos: List[Dict[str, Any]]) -> None:
         """
-        duration = end_time - start_time
+        使用一个ffmpeg进程切出多个片段：输入只打开和解复用一次，每个输出带各自的起止时间
         
+        参数:
+        input_path: 输入视频路径
+        segment_infos: 片段信息列表，使用其中的start_time、end_time和segment_path
+        """
+        # 输入端先跳到本组最早片段之前的关键帧，不再解复用之前的全部数据；
+        # 各输出的-ss相对于跳转点，切点与逐段切片时相同
+        seek_time = min(info['start_time'] for info in segment_infos)
         cmd = [
-            'ffmpeg', '-y',
-            '-i', str(input_path),
-            '-ss', str(start_time),
-            '-t', str(duration),
-            '-c:v', 'copy',
-            '-c:a', 'copy',
-            str(output_path)
+            FFMPEG_BINARY, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+            '-threads', str(self.ffmpeg_threads),
+            '-ss', str(seek_time),
+            '-i', str(input_path)
         ]
+        for info in segment_infos:
+            cmd += [
+                '-ss', str(info['start_time'] - seek_time),
+                '-t', str(info['end_time'] - info['start_time']),
+                '-c:v', 'copy',
+                '-c:a', 'copy',
+                '-avoid_negative_ts', 'make_zero',
+                info['segment_path']
+            ]
         
         try:
-            print(f"切片视频: {start_time:.2f}s - {end_time:.2f}s -> {output_path.name}")
-            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            print(f"切片视频: {segment_infos[0]['start_time']:.2f}s - {segment_infos[-1]['end_time']:.2f}s，"
+                  f"共 {len(segment_infos)} 个片段")
+            # 只保留stderr用于报错，stdout不接管道，避免管道写满阻塞；
+            # close_fds=False保持在posix_spawn路径上（Python创建的文件描述符默认不可继承）
+            subprocess.run(cmd, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, close_fds=False)
         except subprocess.CalledProcessError as e:
             print(f"切片视频时出错: {e}")
             print(f"错误输出: {e.stderr.decode() if e.stderr else 'None'}")
             raise
     
     def _save_json(self) -> None:
-        """保存JSON数据到文件"""
-        with open(self.json_file, 'w', encoding='utf-8') as f:
-            json.dump(self.json_data, f, ensure_ascii=False, indent=2)
+        """
+        将JSON中的历史片段和JSONL中的新片段逐条写入新的JSON文件
+        （先写临时文件再替换，避免写到一半的文件；格式与整体缩进序列化相同）
+        
+        按(video_path, id)去重：替换JSON后、清空JSONL前中断时，下次合并不会重复写入同一片段
+        """
+        tmp_file = self.json_file.with_suffix('.json.tmp')
+        seen = set()
+        with open(tmp_file, 'wb') as f:
+            f.write(b'[')
+            count = 0
+            for item in itertools.chain(self._iter_saved_segments(), self._iter_pending_segments()):
+                key = (item.get('video_path'), item.get('id'))
+                if key in seen:
+                    continue
+                seen.add(key)
+                f.write(b',\n  ' if count else b'\n  ')
+                f.write(orjson.dumps(item, option=orjson.OPT_INDENT_2).replace(b'\n', b'\n  '))
+                count += 1
+            f.write(b'\n]' if count else b']')
+        os.replace(tmp_file, self.json_file)
+    
+    def finalize(self) -> None:
+        """将JSONL中的新片段合并写入JSON文件，关闭并删除已合并的JSONL"""
+        with self._json_lock:
+            if self._jsonl is not None:
+                self._jsonl.close()
+                self._jsonl = None
+            
+            # 没有新片段且JSON文件已存在时无需重写
+            has_pending = self.jsonl_file.exists() and self.jsonl_file.stat().st_size > 0
+            if not has_pending and self.json_file.exists():
+                return
+            
+            self._save_json()
+            self.jsonl_file.unlink(missing_ok=True)
     
     def process_all_videos(self) -> None:
         """处理所有视频文件"""
@@ -171,8 +356,28 @@ class VideoProcessor:
         
         print(f"找到 {len(video_files)} 个视频文件，开始处理...")
         
-        for video_file in video_files:
-            self.process_video(video_file)
+        # 后台线程依次转录，主线程切片：切片当前视频时下一个视频已在转录
+        transcribed = queue.Queue(maxsize=TRANSCRIBE_AHEAD)
+        
+        def transcribe_all():
+            for video_file in video_files:
+                transcribed.put((video_file, self._transcribe_video(video_file)))
+            transcribed.put(None)
+        
+        transcribe_thread = threading.Thread(target=transcribe_all, daemon=True)
+        
+        try:
+            transcribe_thread.start()
+            while True:
+                item = transcribed.get()
+                if item is None:
+                    break
+                
+                video_file, segments = item
+                if segments:
+                    self._cut_segments(video_file, segments)
+        finally:
+            self.finalize()
         
         print(f"所有视频处理完成，结果已保存到 {self.json_file}")
 
@@ -186,10 +391,19 @@ def main():
                         help='输出切片目录')
     parser.add_argument('--json-file', type=str, default='/home/jinpeng/multi-agent/segments/segments_info.json',
                         help='输出JSON文件路径')
+    parser.add_argument('--ffmpeg-threads', type=str, default=None,
+                        help='每个ffmpeg切片进程的线程数（1-64），默认读取VP_FFMPEG_THREADS或按CPU核数平分')
     
     args = parser.parse_args()
     
-    processor = VideoProcessor(args.input_dir, args.output_dir, args.json_file)
+    ffmpeg_threads = None
+    if args.ffmpeg_threads is not None:
+        try:
+            ffmpeg_threads = _parse_ffmpeg_threads(args.ffmpeg_threads)
+        except ValueError as e:
+            parser.error(str(e))
+    
+    processor = VideoProcessor(args.input_dir, args.output_dir, args.json_file, ffmpeg_threads=ffmpeg_threads)
     processor.process_all_videos()
 
 
@@ -4,19 +4,24 @@ import os
 import sys
 import time
 import json
+import orjson
 import argparse
 import logging
+import signal
+import queue
 from typing import Dict, Any
 import threading
 import traceback
 import re
-from crewai import Task, Crew, Process
+import openai
 
 # 添加项目根目录到路径
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 
 # 导入任务处理相关模块
-from agents.requirement_parsing_agent import RequirementParsingAgent
+from agents.requirement_parsing_agent import (
+    REQUIREMENT_PARSING_BACKSTORY, REQUIREMENT_PARSING_MODEL, REQUIREMENT_PARSING_TEMPERATURE
+)
 from tools.ir_template_tool import IRTemplateTool
 from services.ir_video_processor import IRVideoProcessor
 # 替换为MongoDB任务管理服务
@@ -33,6 +38,116 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 任务进度写入MongoDB的最小间隔（秒），间隔内的多次更新只写最新一次
+PROGRESS_FLUSH_INTERVAL = 0.5
+
+# 没有任务时单次等待新任务的最长时间（秒），不超过stop()等待线程退出的时间
+TASK_WAIT_TIMEOUT = 5
+
+# 需求解析提示词
+IR_PARSING_PROMPT = """分析用户需求，生成标准化的视频制作中间表示(IR)。
+
+用户需求: {user_requirement}
+
+提供的内容:
+- 品牌: {brands}
+- 品类: {models}
+- 目标平台: {target_platforms}
+- 目标时长: {target_duration}秒
+
+你需要分析这些需求，并生成一个完整的IR数据结构，这是一个JSON格式的标准数据结构，
+必须包含以下所有主要部分:
+
+1. metadata（元数据）:
+   - project_id: 项目唯一标识符
+   - title: 项目标题
+   - created_at: 创建时间
+   - version: 版本号
+   - target_duration: 目标时长(秒)
+   - target_platforms: 目标平台数组
+   - brands: 品牌数组
+   - models: 品类数组
+   - style_keywords: 风格关键词数组
+   - target_audience: 目标受众
+   - user_input: 原始用户输入
+
+2. audio_design（音频设计）:
+   - voiceover: 配音设置，包含voice_settings和segments
+   - background_music: 背景音乐设置，包含tracks
+   - original_sound: 原始声音设置
+   - sound_effects: 音效设置
+   - audio_mix_strategy: 混音策略
+
+3. visual_structure（视觉结构）:
+   - segments: 视频分段数组，每个分段包含:
+     * id: 分段ID
+     * type: 分段类型(opening, body, closing等)
+     * start_time: 开始时间
+     * duration: 持续时间
+     * narration: 旁白设置
+     * visual_requirements: 视觉要求
+     * material_search_strategy: 素材搜索策略
+     * transition_in: 进入转场
+     * transition_out: 退出转场
+   - pacing_strategy: 节奏策略
+
+4. post_processing（后期处理）:
+   - color_grading_profile: 色彩校正配置文件
+   - aspect_ratio: 宽高比
+   - resolution: 分辨率
+   - subtitles: 字幕设置
+   - logo_overlay: Logo覆盖设置
+   - end_card: 结束卡片设置
+   - filters: 滤镜数组
+
+5. export_settings（导出设置）:
+   - formats: 导出格式数组
+   - quality_presets: 质量预设数组
+   - bitrate: 比特率
+
+对于不明确的部分，请根据汽车视频制作的最佳实践做出合理推断。
+最终输出必须是一个有效的JSON对象，包含以上所有主要部分。请直接返回JSON格式的IR数据，不要包含任何其他文本或解释。
+"""
+
+# LLM输出中用代码块包裹的JSON对象
+_JSON_FENCE_PATTERN = re.compile(r'```(?:json)?\s*(\{.*?\})\s*```', re.DOTALL)
+
+def _find_json_object(text: str):
+    """
+    单遍扫描找出文本中第一个括号配对完整的JSON对象，跳过字符串中的括号
+    
+    参数:
+    text: LLM输出文本
+    
+    返回:
+    JSON对象字符串，未找到时返回None
+    """
+    start = text.find('{')
+    if start < 0:
+        return None
+    
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
 class Worker:
     """工作机节点，负责从任务队列获取并处理任务"""
     
@@ -54,16 +169,26 @@ class Worker:
         
         # 初始化MongoDB任务管理器
         self.task_manager = TaskManagerService()
+        self.task_manager.prepare_task_queue()
         logger.info("已初始化MongoDB任务管理器")
         
         # 初始化处理服务
-        self.requirement_parser = RequirementParsingAgent.create()
+        self.llm_client = openai.OpenAI(
+            api_key=os.environ.get('OPENAI_API_KEY'),
+            base_url=os.environ.get('OPENAI_BASE_URL')
+        )
         self.ir_processor = IRVideoProcessor(output_dir=output_dir)
         
         # 工作状态
         self.running = False
         self.current_task_id = None
         self.worker_thread = None
+        
+        # 中间进度先进入队列，由后台线程合并后写入
+        self._progress_q = queue.Queue()
+        self._progress_event = threading.Event()
+        self._progress_lock = threading.Lock()
+        self._progress_thread = None
     
     def start(self):
         """启动工作机"""
@@ -72,6 +197,9 @@ class Worker:
             self.worker_thread = threading.Thread(target=self._worker_loop)
             self.worker_thread.daemon = True
             self.worker_thread.start()
+            self._progress_thread = threading.Thread(target=self._progress_loop)
+            self._progress_thread.daemon = True
+            self._progress_thread.start()
             logger.info("工作机线程已启动")
     
     def stop(self):
@@ -81,8 +209,55 @@ class Worker:
             self.running = False
             if self.worker_thread:
                 self.worker_thread.join(timeout=5)
+            if self._progress_thread:
+                self._progress_thread.join(timeout=5)
             logger.info("工作机已停止")
     
+    def _report_progress(self, task_id: str, status: str, progress: int = None):
+        """提交中间进度，不等待MongoDB写入"""
+        self._progress_q.put((task_id, status, progress))
+        self._progress_event.set()
+    
+    def _flush_progress(self, drop_task_id: str = None):
+        """
+        合并队列中的进度更新，每个任务只写最新一次；调用方需持有_progress_lock
+        
+        参数:
+        drop_task_id: 丢弃该任务的待写进度（即将写入终态时使用）
+        """
+        latest = {}
+        while True:
+            try:
+                task_id, status, progress = self._progress_q.get_nowait()
+            except queue.Empty:
+                break
+            latest[task_id] = (status, progress)
+        
+        latest.pop(drop_task_id, None)
+        for task_id, (status, progress) in latest.items():
+            self.task_manager.update_task_status(task_id, status, progress)
+    
+    def _progress_loop(self):
+        """后台线程：等待进度更新，最多每PROGRESS_FLUSH_INTERVAL秒写一次MongoDB"""
+        while self.running:
+            if not self._progress_event.wait(timeout=1):
+                continue
+            
+            # 等待一个间隔，把期间的更新合并为一次写入
+            time.sleep(PROGRESS_FLUSH_INTERVAL)
+            self._progress_event.clear()
+            try:
+                with self._progress_lock:
+                    self._flush_progress()
+            except Exception as e:
+                logger.error(f"写入任务进度时出错: {str(e)}")
+    
+    def _set_final_status(self, task_id: str, status: str, progress: int = None):
+        """同步写入任务终态，并丢弃该任务尚未写入的中间进度"""
+        with self._progress_lock:
+            self._flush_progress(drop_task_id=task_id)
+            self.task_manager.update_task_status(task_id, status, progress)
+    
     def _worker_loop(self):
         """工作循环，不断从队列获取任务并处理"""
         logger.info("开始工作循环")
@@ -97,28 +272,25 @@ class Worker:
                     self.current_task_id = task["_id"]  # MongoDB使用_id字段
                     logger.info(f"开始处理任务: {self.current_task_id}")
                     
-                    # 更新任务状态
-                    self.task_manager.update_task_status(self.current_task_id, "processing")
-                    
                     # 处理任务
                     result = self._process_task(task)
                     
                     # 更新任务结果
                     if result["success"]:
                         # 更新任务为已完成
-                        self.task_manager.update_task_status(self.current_task_id, "completed", 100)
+                        self._set_final_status(self.current_task_id, "completed", 100)
                         logger.info(f"任务处理成功: {self.current_task_id}")
                     else:
-                        self.task_manager.update_task_status(self.current_task_id, "failed")
+                        self._set_final_status(self.current_task_id, "failed")
                         logger.error(f"任务处理失败: {self.current_task_id} - {result.get('error', '未知错误')}")
                     
                     # 清除当前任务ID
                     self.current_task_id = None
                     
                 else:
-                    # 没有任务，等待一段时间
+                    # 没有任务，等待新任务出现
                     logger.info("没有待处理任务，等待中...")
-                    time.sleep(5)
+                    self.task_manager.wait_for_pending_task(TASK_WAIT_TIMEOUT)
             
             except Exception as e:
                 logger.error(f"工作循环中出错: {str(e)}")
@@ -126,25 +298,9 @@ class Worker:
                 time.sleep(10)  # 出错后等待更长时间
     
     def _get_next_task(self) -> Dict[str, Any]:
-        """获取下一个要处理的任务"""
-        try:
-            # 从MongoDB获取待处理任务
-            pending_tasks = self.task_manager.get_tasks(status="pending")
-            
-            # 如果有任务，返回第一个
-            if pending_tasks:
-                # 按优先级排序（如果配置中有优先级字段）
-                try:
-                    pending_tasks.sort(key=lambda t: self._get_priority_value(t.get("config", {}).get("priority", "normal")))
-                except Exception as e:
-                    logger.warning(f"任务排序出错: {str(e)}")
-            
-                return pending_tasks[0]
-            return None
-            
-        except Exception as e:
-            logger.error(f"获取任务时出错: {str(e)}")
-            return None
+        """领取下一个要处理的任务（领取时已标记为处理中），领取出错时抛出异常由工作循环退避"""
+        # 一次原子操作完成按优先级选择和状态更新，多个工作机不会领取同一任务
+        return self.task_manager.claim_next_task(self.worker_id)
     
     def _process_task(self, task: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -174,7 +330,7 @@ class Worker:
                 }
             
             # 更新进度
-            self.task_manager.update_task_status(self.current_task_id, "processing", 10)
+            self._report_progress(self.current_task_id, "processing", 10)
             
             # 1. 解析需求，生成IR
             logger.info("解析用户需求...")
@@ -194,127 +350,61 @@ class Worker:
                 # 设置用户输入
                 ir_data["metadata"]["user_input"] = user_requirement
 
-                # 调用需求解析Agent，使用Task+Crew执行模式
+                # 单步解析直接调用LLM（JSON模式），不经过Task+Crew编排
                 try:
-                    logger.info("调用需求解析Agent...")
+                    logger.info("调用LLM解析需求...")
                     
-                    # 创建解析需求的任务
-                    parse_requirement_task = Task(
-                        description=f"""分析用户需求，生成标准化的视频制作中间表示(IR)。
-                        
-                        用户需求: {user_requirement}
-                        
-                        提供的内容:
-                        - 品牌: {brands if brands else "未指定"}
-                        - 品类: {models if models else "未指定"}
-                        - 目标平台: {target_platforms if target_platforms else "未指定"}
-                        - 目标时长: {target_duration}秒
-                        
-                        你需要分析这些需求，并生成一个完整的IR数据结构，这是一个JSON格式的标准数据结构，
-                        必须包含以下所有主要部分:
-                        
-                        1. metadata（元数据）:
-                           - project_id: 项目唯一标识符
-                           - title: 项目标题
-                           - created_at: 创建时间
-                           - version: 版本号
-                           - target_duration: 目标时长(秒)
-                           - target_platforms: 目标平台数组
-                           - brands: 品牌数组
-                           - models: 品类数组
-                           - style_keywords: 风格关键词数组
-                           - target_audience: 目标受众
-                           - user_input: 原始用户输入
-                        
-                        2. audio_design（音频设计）:
-                           - voiceover: 配音设置，包含voice_settings和segments
-                           - background_music: 背景音乐设置，包含tracks
-                           - original_sound: 原始声音设置
-                           - sound_effects: 音效设置
-                           - audio_mix_strategy: 混音策略
-                        
-                        3. visual_structure（视觉结构）:
-                           - segments: 视频分段数组，每个分段包含:
-                             * id: 分段ID
-                             * type: 分段类型(opening, body, closing等)
-                             * start_time: 开始时间
-                             * duration: 持续时间
-                             * narration: 旁白设置
-                             * visual_requirements: 视觉要求
-                             * material_search_strategy: 素材搜索策略
-                             * transition_in: 进入转场
-                             * transition_out: 退出转场
-                           - pacing_strategy: 节奏策略
-                        
-                        4. post_processing（后期处理）:
-                           - color_grading_profile: 色彩校正配置文件
-                           - aspect_ratio: 宽高比
-                           - resolution: 分辨率
-                           - subtitles: 字幕设置
-                           - logo_overlay: Logo覆盖设置
-                           - end_card: 结束卡片设置
-                           - filters: 滤镜数组
-                        
-                        5. export_settings（导出设置）:
-                           - formats: 导出格式数组
-                           - quality_presets: 质量预设数组
-                           - bitrate: 比特率
-                        
-                        对于不明确的部分，请根据汽车视频制作的最佳实践做出合理推断。
-                        最终输出必须是一个有效的JSON对象，包含以上所有主要部分。
-                        """,
-                        expected_output="一个完整的、JSON格式的IR数据结构，包含所有必要的字段和详细信息，符合指定的五个主要部分的结构要求, 请直接返回JSON格式的IR数据,包裹在代码块里，不要包含任何其他文本或解释。",
-                        agent=self.requirement_parser
-                    )
-                    
-                    # 创建Crew
-                    requirement_crew = Crew(
-                        agents=[self.requirement_parser],
-                        tasks=[parse_requirement_task],
-                        verbose=True,
-                        process=Process.sequential
+                    response = self.llm_client.chat.completions.create(
+                        model=REQUIREMENT_PARSING_MODEL,
+                        temperature=REQUIREMENT_PARSING_TEMPERATURE,
+                        response_format={"type": "json_object"},
+                        messages=[
+                            {"role": "system", "content": REQUIREMENT_PARSING_BACKSTORY},
+                            {"role": "user", "content": IR_PARSING_PROMPT.format(
+                                user_requirement=user_requirement,
+                                brands=brands if brands else "未指定",
+                                models=models if models else "未指定",
+                                target_platforms=target_platforms if target_platforms else "未指定",
+                                target_duration=target_duration
+                            )}
+                        ]
                     )
-                    
-                    # 执行解析需求的任务
-                    requirement_result = requirement_crew.kickoff()
-                    output_text = str(requirement_result).strip()
+                    output_text = (response.choices[0].message.content or "").strip()
                     
                     # 解析返回结果 - 尝试从返回的文本中提取JSON
                     try:
                         # 寻找JSON对象 - 可能被包围在```json和```之间，或者直接是一个JSON对象
-                        json_match = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', output_text, re.DOTALL)
-                        if not json_match:
-                            # 尝试直接匹配JSON对象
-                            json_match = re.search(r'(\{.*\})', output_text, re.DOTALL)
+                        json_match = _JSON_FENCE_PATTERN.search(output_text)
+                        # 没有代码块时按括号配对查找JSON对象
+                        json_str = json_match.group(1) if json_match else _find_json_object(output_text)
                         
-                        if json_match:
-                            json_str = json_match.group(1)
-                            parsed_ir = json.loads(json_str)
+                        if json_str:
+                            parsed_ir = orjson.loads(json_str)
                             if parsed_ir and isinstance(parsed_ir, dict) and "metadata" in parsed_ir:
                                 ir_data = parsed_ir
                                 logger.info("需求解析完成，使用解析后的IR数据")
                             else:
                                 logger.warning("解析到的IR数据不完整，将继续使用基础模板")
                         else:
-                            logger.warning("Agent响应中未找到JSON格式的IR数据，将继续使用基础模板")
-                            logger.debug(f"Agent响应内容: {requirement_result}")
+                            logger.warning("LLM响应中未找到JSON格式的IR数据，将继续使用基础模板")
+                            logger.debug(f"LLM响应内容: {output_text}")
                     except json.JSONDecodeError as json_err:
                         logger.error(f"IR数据JSON解析错误: {json_err}")
                         logger.debug(f"尝试解析的内容: {output_text}")
                         logger.warning("由于JSON解析错误，将继续使用基础模板")
                 except Exception as agent_err:
-                    logger.error(f"需求解析Agent执行错误: {agent_err}", exc_info=True)
-                    logger.warning("由于Agent执行错误，将继续使用基础模板")
+                    logger.error(f"需求解析LLM调用错误: {agent_err}", exc_info=True)
+                    logger.warning("由于LLM调用错误，将继续使用基础模板")
 
             # 更新进度
-            self.task_manager.update_task_status(self.current_task_id, "processing", 20)
+            self._report_progress(self.current_task_id, "processing", 20)
             
             # 2. 处理IR，生成视频
             logger.info("执行视频处理...")
             processing_result = self.ir_processor.process_ir(ir_data)
             
             # 更新进度
-            self.task_manager.update_task_status(self.current_task_id, "processing", 90)
+            self._report_progress(self.current_task_id, "processing", 90)
             
             # 3. 返回结果
             return {
@@ -333,15 +423,6 @@ class Worker:
                 "success": False,
                 "error": str(e)
             }
-    
-    def _get_priority_value(self, priority: str) -> int:
-        """获取优先级数值"""
-        if priority == "high":
-            return 0
-        elif priority == "normal":
-            return 1
-        else:  # low
-            return 2
 
 def main():
     """主函数"""
@@ -355,13 +436,18 @@ def main():
     worker = Worker(worker_id=args.worker_id, output_dir=args.output_dir)
     worker.start()
     
-    try:
-        # 主线程保持运行
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        logger.info("接收到中断信号，正在停止...")
-        worker.stop()
+    # 主线程阻塞等待SIGINT/SIGTERM，空闲时不再周期性唤醒
+    stop_event = threading.Event()
+    
+    def handle_signal(signum, frame):
+        logger.info(f"接收到信号 {signal.Signals(signum).name}，正在停止...")
+        stop_event.set()
+    
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    
+    stop_event.wait()
+    worker.stop()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file